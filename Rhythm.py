@@ -1,154 +1,608 @@
 # -*- coding: utf-8 -*-
 import asyncio
-import datetime
+import collections
+import concurrent.futures
+import time
 
 from irc3.plugins.command import command
 from irc3.utils import IrcString
 from irc3 import event
 import irc3
 
+import archive
+import ballotfile
+import casemapping
+import eventlog
+import historyindex
+import mappinguserlist
+import metrics
+import outbound
+import scheduler
+import state
+import statelog
+import storage
+import votematch
+from votematch import AYE, NAY, ABSTAIN
+
 MOTION_RESULT_LIST = 'Ayes: {ayes}; Nays: {nays}; Abstains: {abstains}'
 MOTION_RESULT_COUNT = 'Ayes: {ayes}; Nays: {nays}; Abstains: {abstains}; TOTAL: {total}'
 MOTION_EXTERNAL_VOTES = '[+] External ayes: {ayes}; External nays: {nays}'
+MOTION_BALLOTS = '[+] Ballots: Ayes: {ayes}; Nays: {nays}; Abstains: {abstains}'
 
 MOTION_LAPSES_QUORUM = '*** Result: Motion lapses. Quorum of {quorum} not met.'
 MOTION_LAPSES_PC = '*** Result: Motion lapses. {in_favour:.2f}% in favour.'
 MOTION_CARRIES = '*** Result: Motion carries. {in_favour:.2f}% in favour.'
 
+# how many WHOIS queries !add sends at once
+WHOIS_BATCH = 10
+# rows of a ballot file read, and counted, at a time
+BALLOT_CHUNK = 1000
+# results !history and !voted show at a time
+HISTORY_PAGE = 5
+# per-nick vote buckets kept before full ones are pruned
+VOTE_BUCKETS = 1000
+
+
+def normalise_userhost(userhost):
+    """Return the form of ``user@host`` we key recognised lists by."""
+    username, _, host = userhost.rpartition('@')
+    return username + '@' + host.lower()
+
 
 @irc3.plugin
 class Motions(object):
 
     def __init__(self, bot):
+        bot.include('eventlog')
         bot.include('casemapping')
         bot.include('mappinguserlist')
+        bot.include('outbound')
+        bot.include('voicequeue')
+        bot.include('scheduler')
         bot.include('irc3.plugins.async')
         bot.include('irc3.plugins.core')
         self.bot = bot
         self.name = bot.config.get('name', 'motionbot')
         self.states = {}
-        self.db = None
+        self.store = None
+        self.log = eventlog.EventLogger('rhythm.motions')
+        self.out = bot.outbound
+        self.config = bot.config.get(__name__, {})
+        self.votes = votematch.VoteMatcher.from_config(self.config)
+        self.whois_timeout = float(self.config.get('whois_timeout', 10))
+        self.ballot_dir = self.config.get('ballot_dir')
+        # votes a second any one nick may send, with bursts of up to vote_burst
+        self.vote_rate = float(self.config.get('vote_rate', 1))
+        self.vote_burst = int(self.config.get('vote_burst', 5))
+        self.vote_buckets = {}
+        # prune full buckets once there are this many
+        self.vote_buckets_limit = VOTE_BUCKETS
+        # timed motions: how long before closing to remind, and how long
+        # after time is up votes still count
+        self.reminders = sorted(
+            (scheduler.parse_duration(r) for r in irc3.utils.as_list(
+                self.config.get('reminders', '5m 1m 10s'))), reverse=True)
+        self.grace = scheduler.parse_duration(self.config.get('grace', '5s'))
+        # casefolded channel -> the scheduler's timers for its motion
+        self.timers = {}
+        # linked meetings: home channel -> its link, and channel -> its home
+        self.links = {}
+        self.link_of = {}
+        self.bot.get_plugin(mappinguserlist.Userlist).subscribe(self.userlist_changed)
 
         # setup database if we're using one
         db_uri = self.bot.config.get('database', None)
         if db_uri:
-            from pymongo import MongoClient
-            self.db_client = MongoClient(db_uri)
-            self.db = self.db_client.motionbot
-            print('Using database')
-        else:
-            print('Not using database')
+            self.store = storage.from_uri(
+                db_uri, self.name, loop=self.bot.loop,
+                timeout=float(self.config.get('database_timeout', 5)),
+                threshold=int(self.config.get('database_failures', 3)),
+                reset_timeout=float(self.config.get('database_retry', 30)),
+                max_pending=int(self.config.get('database_queue', 10000)),
+                poll_interval=float(self.config.get('database_poll', 10)))
+            self.store.subscribe(self.recognised_changed)
+        self.log.info('database', uri=db_uri)
+
+        # keep a record of meetings if we've been given somewhere to put it
+        self.archive = None
+        if self.config.get('archive'):
+            self.archive = archive.Archive(self.config['archive'])
+
+        # and an index of it to search, kept up to date as it's searched
+        self.history_index = None
+        if self.archive and self.config.get('history'):
+            self.history_index = historyindex.HistoryIndex(self.config['history'])
+            # sqlite connections belong to one thread, so use exactly one
+            self.history_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        # keep meeting state across a crash or restart if we've somewhere to put it
+        self.statelog = None
+        self.restored = {}
+        if self.config.get('state_dir'):
+            self.statelog = statelog.StateLog(self.config['state_dir'])
+            self.restored = self.statelog.restore()
+            self.snapshot_interval = float(self.config.get('snapshot_interval', 60))
+            self.snapshot_future = None
+            self.bot.loop.call_later(1, self.sync_state)
+            self.bot.loop.call_later(self.snapshot_interval, self.snapshot_state)
+            self.log.info('state_restored', channels=len(self.restored))
 
     # channel permissions
     def is_voice(self, mask, target):
-        target = self.bot.casefold(target)
-        if not isinstance(mask, IrcString):
-            mask = IrcString(mask)
-        return mask.nick in self.bot.channels[target].modes['+']
+        return self.has_mode(mask, target, self.bot.isupport.voice_mask)
 
     def is_admin(self, mask, target):
-        target = self.bot.casefold(target)
+        return self.has_mode(mask, target, self.bot.isupport.admin_mask)
+
+    def has_mode(self, mask, target, modes):
         if not isinstance(mask, IrcString):
             mask = IrcString(mask)
+        casefold = self.bot.casefold
+        return self.bot.channels[casefold(target)].has_mode(casefold(mask.nick), modes)
 
-        # we consider halfop/op and above admins
-        prefixes = self.bot.config['server_config'].get('PREFIX', '(ov)@+')
-        prefixes = prefixes.split(')')[1]
-        admin_prefix_index = prefixes.index('%') if '%' in prefixes else prefixes.index('@')
-        admin_prefixes = prefixes[:admin_prefix_index + 1]
+    def can_vote(self, nick, target):
+        """Whether the user is voiced or an admin, in one lookup.
 
-        for prefix in admin_prefixes:
-            if mask.nick in self.bot.channels[target].modes[prefix]:
-                return True
-
-        return False
+        Both ``nick`` and ``target`` must already be casefolded.
+        """
+        isupport = self.bot.isupport
+        return self.bot.channels[target].has_mode(
+            nick, isupport.voice_mask | isupport.admin_mask)
 
     # channel info init
     @event(irc3.rfc.JOIN)
+    @metrics.timed
     def join_chan(self, mask=None, channel=None):
         """Upon joining a channel, keep track of the channel state."""
         channel = self.bot.casefold(channel)
-        if mask.nick == self.bot.nick:
-            self.states[channel] = {
-                'recognised': [],
-                'meeting': {
-                    'name': '',
-                    'started': False,
-                    'quorum': 0,
-                },
-                'motion': {
-                    'text': '',
-                    'put_by': '',
-                    'started': False,
-                    'votes': {},
-                },
-            }
+        nick = self.bot.casefold(mask.nick)
+        if nick == self.bot.casefold(self.bot.nick):
+            # a rejoin keeps what we had; after a restart, pick up where we left off
+            if channel not in self.states:
+                saved = self.restored.pop(channel, None)
+                self.states[channel] = (state.ChannelState.load(saved) if saved
+                                        else state.ChannelState())
+                if self.states[channel].meeting.link:
+                    self.restore_link(channel)
+            # a timed motion picks up where it was, whatever it missed while we were away
+            self.arm_motion(channel)
+
+            self.log.info('channel_joined', channel=channel)
+
+            # the recognised list is only read here, never again on user joins
+            if self.store:
+                self.bot.create_task(self.load_recognised(channel))
         else:
-            userhost = mask.split('!', 1)[1]
-            if userhost in self.states[channel]['recognised']:
-                nick = self.bot.casefold(mask.nick)
-                self.bot.mode(channel, '+v {}'.format(nick))
-
-            if self.db:
-                doc = self.db.recognised.find_one({
-                    'bot': self.name,
-                    'channel': channel,
-                })
-
-                if doc:
-                    self.states[channel]['recognised'] = doc['users']
-                else:
-                    self.db.recognised.insert_one({
-                        'bot': self.name,
-                        'channel': channel,
-                        'users': [],
-                    })
+            userhost = normalise_userhost(mask.split('!', 1)[1])
+            if userhost in self.states[channel].recognised:
+                self.bot.voicequeue.voice(channel, nick)
+                self.log.debug('recognised_join', channel=channel, nick=nick)
+
+    def reset_motion(self, channel):
+        self.disarm_motion(channel)
+        link = self.link_for(channel)
+        if link is not None:
+            link.tally.drop_channel(channel)
+        self.states[channel].motion = state.Motion()
+        self.journal_motion(channel, reset=True)
+
+    # linked meetings
+    def link_for(self, channel):
+        home = self.link_of.get(channel)
+        return self.links[home] if home is not None else None
+
+    def linked(self, channel):
+        """The channels sharing ``channel``'s meeting, its home first; or just ``channel``."""
+        link = self.link_for(channel)
+        if link is None:
+            return [channel]
+        return sorted(link.channels, key=lambda c: (c != link.home, c))
+
+    def run_from_home(self, channel):
+        """Turn away a meeting or motion command in a linked channel other than the home one."""
+        home = self.link_of.get(channel, channel)
+        if home != channel:
+            self.out.notice(channel, '*** This meeting is run from {}.'.format(home))
+            return True
+        return False
+
+    def voter_key(self, nick, mask=None):
+        """Who a voter is across linked channels: their user@host, or failing that their nick."""
+        if mask is None:
+            mask = self.bot.nicks.get(nick)
+        if isinstance(mask, str) and '!' in mask and '@' in mask:
+            return normalise_userhost(mask.split('!', 1)[1])
+        return nick
+
+    def add_to_link(self, link, channel):
+        """Make ``channel`` part of ``link``, counting any votes it has."""
+        link.channels.add(channel)
+        self.link_of[channel] = link.home
+        motion = self.states[channel].motion
+        # by the keys saved with the votes; after a restart there's no userlist yet
+        for votes in (motion.tally.votes, motion.tally.departed):
+            for nick, choice in votes.items():
+                key, when = motion.keys.get(nick) or (self.voter_key(nick), 0)
+                link.tally.cast(channel, nick, key, choice, when)
+        for nick in motion.tally.departed:
+            link.tally.depart(channel, nick)
+
+    def leave_link(self, channel):
+        link = self.link_for(channel)
+        link.tally.drop_channel(channel)
+        link.channels.discard(channel)
+        del self.link_of[channel]
+        if not link.channels:
+            del self.links[link.home]
+
+    def restore_link(self, channel):
+        """Put a channel back in its link after a restart; its home may come back later."""
+        home = self.states[channel].meeting.link
+        link = self.links.get(home)
+        if link is None:
+            link = self.links[home] = state.Link(home)
+        self.add_to_link(link, channel)
+
+    def link_channel(self, home, channel):
+        """Bring ``channel`` into the meeting run from ``home``, and its motion if there is one."""
+        link = self.links.get(home)
+        if link is None:
+            link = self.links[home] = state.Link(home)
+            self.states[home].meeting.link = home
+            self.journal_meeting(home)
+            self.add_to_link(link, home)
+
+        meeting = self.states[home].meeting
+        self.states[channel].meeting = state.Meeting(
+            id=meeting.id, name=meeting.name, started=True, quorum=meeting.quorum, link=home)
+        self.journal_meeting(channel)
+        source = self.states[home].motion
+        motion = self.states[channel].motion
+        motion.text = source.text
+        motion.put_by = source.put_by
+        motion.started = source.started
+        motion.closes_at = source.closes_at
+        self.journal_motion(channel)
+        self.add_to_link(link, channel)
+
+        self.log.info('channel_linked', channel=channel, home=home)
+        self.record(home, 'channel_linked', linked=channel)
+        self.out.notice(channel, '*** This channel has joined the meeting in {}.'.format(home))
+        if motion.started:
+            self.out.notice(channel, '*** MOTION: ' + motion.text)
+            self.out.notice(channel, '*** Please now respond either "aye", "nay" or "abstain" '
+                                     'to record a vote.')
+
+    def unlink_channel(self, channel):
+        """Take ``channel`` out of its linked meeting; its votes on the motion go."""
+        home = self.link_of[channel]
+        self.reset_motion(channel)
+        self.leave_link(channel)
+        self.states[channel].meeting = state.Meeting()
+        self.journal_meeting(channel)
+        self.log.info('channel_unlinked', channel=channel, home=home)
+        self.record(home, 'channel_unlinked', linked=channel)
+        self.out.notice(channel, '*** This channel has left the meeting in {}.'.format(home))
+
+        # a link of one is no link
+        if self.linked(home) == [home] and home in self.link_of:
+            self.leave_link(home)
+            self.states[home].meeting.link = ''
+            self.journal_meeting(home)
+
+    # timed motions
+    def arm_motion(self, channel):
+        """Schedule the reminders and close still to come for a timed motion."""
+        self.disarm_motion(channel)
+        motion = self.states[channel].motion
+        if not (motion.started and motion.closes_at):
+            return
+        # a linked meeting's motion is timed from its home channel
+        if self.link_of.get(channel, channel) != channel:
+            return
+
+        now = time.time()
+        schedule = self.bot.scheduler.call_at
+        timers = self.timers[channel] = []
+        for before in self.reminders:
+            when = motion.closes_at - before
+            if when > now:
+                timers.append(schedule(when, self.remind_motion, channel, motion, before))
+        timers.append(schedule(motion.closes_at, self.motion_time_up, channel, motion))
+
+    def disarm_motion(self, channel):
+        for timer in self.timers.pop(channel, ()):
+            timer.cancel()
+
+    def timer_applies(self, channel, motion):
+        """Whether a timer set for ``motion`` should still go off.
+
+        Not while we're out of the channel: the timers are set again from the
+        motion's deadline when we rejoin it, and anything we said meanwhile
+        would be lost.
+        """
+        return self.states[channel].motion is motion and channel in self.bot.channels
+
+    def remind_motion(self, channel, motion, before):
+        if not self.timer_applies(channel, motion):
+            return
+        counts = self.count_votes(channel)
+        quorum = self.states[channel].meeting.quorum
+        message = '*** {} left to vote on: {}. Votes so far: {}'.format(
+            scheduler.format_duration(before), motion.text, counts['total'])
+        if counts['total'] < quorum:
+            message += '; {} more needed for quorum'.format(quorum - counts['total'])
+        for linked in self.linked(channel):
+            self.out.notice(linked, message + '.')
+
+    def motion_time_up(self, channel, motion):
+        if not self.timer_applies(channel, motion):
+            return
+        closes_at = motion.closes_at + self.grace
+        if closes_at > time.time():
+            self.timers[channel] = [self.bot.scheduler.call_at(
+                closes_at, self.close_timed_motion, channel, motion)]
+            for linked in self.linked(channel):
+                self.out.notice(linked, '*** Time is up; votes cast in the next {} still '
+                                        'count.'.format(scheduler.format_duration(self.grace)))
+        else:
+            self.close_timed_motion(channel, motion)
+
+    def close_timed_motion(self, channel, motion):
+        if not self.timer_applies(channel, motion):
+            return
+        self.log.info('motion_timed_out', channel=channel, text=motion.text)
+        for linked in self.linked(channel):
+            self.out.notice(linked, '*** Voting has closed.', priority=outbound.RESULT)
+        self.close_motion(channel)
+
+    # crash-safe state
+    def journal(self, channel, op, **fields):
+        """Log a change to a channel's state, if we're keeping it."""
+        if self.statelog:
+            self.statelog.append(channel, op, **fields)
+
+    def journal_meeting(self, channel):
+        self.journal(channel, 'meeting', meeting=self.states[channel].meeting.dump())
+
+    def journal_motion(self, channel, reset=False):
+        self.journal(channel, 'motion', motion=self.states[channel].motion.header(),
+                     reset=reset)
+
+    def sync_state(self):
+        """fsync the state log, off the loop, every second."""
+        self.bot.loop.call_later(1, self.sync_state)
+        if self.statelog.wal is not None:
+            self.bot.loop.run_in_executor(None, self.statelog.sync)
+
+    def snapshot_state(self):
+        """Snapshot every channel's state and start a new log."""
+        self.bot.loop.call_later(self.snapshot_interval, self.snapshot_state)
+        if not self.statelog.dirty:
+            return
+        if self.snapshot_future is not None and not self.snapshot_future.done():
+            return
+
+        # rotating and copying on the loop means no change falls between them;
+        # only the slow part, writing it out, happens in the executor
+        seq = self.statelog.rotate()
+        channels = dict(self.restored)
+        for channel, channel_state in self.states.items():
+            channels[channel] = channel_state.dump()
+        self.snapshot_future = self.bot.loop.run_in_executor(
+            None, self.statelog.write_snapshot, seq, channels)
+
+    def SIGINT(self):
+        """irc3 calls this as the bot stops; write out what's still held back."""
+        if self.store:
+            self.store.shutdown()
+        if self.archive:
+            self.archive.close()
+
+    @asyncio.coroutine
+    def load_recognised(self, channel):
+        """Fetch a channel's recognised list from the store.
+
+        Returns the number of users, or None if the store is unavailable, in
+        which case we keep what we have and the store tells us to reload when
+        it's back.
+        """
+        try:
+            users = yield from self.store.get_recognised(channel)
+        except storage.StoreUnavailable as exc:
+            self.log.warning('recognised_unavailable', channel=channel, error=str(exc))
+            return None
+        self.states[channel].recognised = set(normalise_userhost(u) for u in users)
+        self.log.info('recognised_loaded', channel=channel, users=len(users))
+        return len(users)
+
+    def recognised_changed(self, channel):
+        """Reload a channel's recognised list when the store says it changed."""
+        if channel in self.states:
+            self.bot.create_task(self.load_recognised(channel))
 
     # op commands
     @command()
+    @metrics.timed
     @asyncio.coroutine
     def add(self, mask, target, args):
-        """Recognise a user.
+        """Recognise users; *voiced* adds everyone who is voiced.
 
-        %%add <nick>
+        %%add <nick>...
         """
         # we only care about ops and commands to channels
         if not (target.is_channel and self.is_admin(mask, target)):
             return
 
         channel = self.bot.casefold(target)
+        members = self.bot.channels[channel]
+        isupport = self.bot.isupport
 
-        # voice user
-        nick = args['<nick>'].lower()
-        if not (self.is_admin(nick, channel) or self.is_voice(nick, channel)):
+        nicks = []
+        for nick in args['<nick>']:
+            if nick == '*voiced*':
+                nicks.extend(n for n in members if members.has_mode(n, isupport.voice_mask))
+            else:
+                nicks.append(self.bot.casefold(nick))
+        # in the order given, once each
+        nicks = list(collections.OrderedDict.fromkeys(nicks))
+
+        # voice users
+        unvoiced = [nick for nick in nicks if nick in members and
+                    not members.has_mode(nick, isupport.voice_mask | isupport.admin_mask)]
+        if unvoiced:
             if self.is_admin(self.bot.nick, channel):
-                self.bot.mode(channel, '+v {}'.format(nick))
+                for nick in unvoiced:
+                    self.bot.voicequeue.voice(channel, nick)
+            else:
+                self.out.notice(channel, '*** I am not opped and cannot voice users.')
+
+        # add users to our recognised list
+        userhosts = yield from self.resolve_userhosts(nicks)
+
+        missing = [casemapping.display(nick) for nick in nicks if nick not in userhosts]
+        if missing:
+            self.out.notice(channel, '*** Could not add to recognised list: {}'.format(
+                ', '.join(missing)))
+
+        recognised = self.states[channel].recognised
+        added = [userhost for userhost in set(userhosts.values()) if userhost not in recognised]
+        recognised.update(added)
+        if self.store and added:
+            # one write for the lot
+            self.store.push_recognised(channel, *added)
+
+        if len(nicks) > 1:
+            self.out.notice(channel, '*** Recognised {} of {} users.'.format(
+                len(userhosts), len(nicks)))
+
+    @asyncio.coroutine
+    def resolve_userhosts(self, nicks):
+        """Return ``{nick: userhost}`` for the casefolded ``nicks`` we can find.
+
+        Userlist already knows the mask of anyone it has seen join or had a
+        WHO reply for; only the rest are looked up with WHOIS, a batch at a
+        time.
+        """
+        userhosts = {}
+        misses = []
+        for nick in nicks:
+            # NAMES only gives us the nick
+            known = self.bot.nicks.get(nick)
+            if isinstance(known, str) and '!' in known and '@' in known:
+                userhosts[nick] = normalise_userhost(known.split('!', 1)[1])
             else:
-                self.bot.notice(channel, '*** I am not opped and cannot voice user.')
+                misses.append(nick)
+
+        for i in range(0, len(misses), WHOIS_BATCH):
+            batch = misses[i:i + WHOIS_BATCH]
+            results = yield from asyncio.gather(*[
+                self.bot.async.whois(nick=nick, timeout=self.whois_timeout)
+                for nick in batch
+            ])
+            for nick, info in zip(batch, results):
+                if not info['success']:
+                    continue
+                userhost = '{username}@{host}'.format(**info)
+                userhosts[nick] = normalise_userhost(userhost)
+                # so the next lookup needn't ask
+                if nick in self.bot.nicks:
+                    self.bot.nicks[nick] = IrcString(
+                        casemapping.display(nick) + '!' + userhost)
+
+        self.log.debug('userhosts_resolved', found=len(userhosts),
+                       cached=len(nicks) - len(misses), asked=len(misses))
+        return userhosts
+
+    @command()
+    @metrics.timed
+    @asyncio.coroutine
+    def remove(self, mask, target, args):
+        """Stop recognising a user.
+
+        %%remove <nick>
+        """
+        # we only care about ops and commands to channels
+        if not (target.is_channel and self.is_admin(mask, target)):
+            return
+
+        channel = self.bot.casefold(target)
+
+        # users who have left can be removed by user@host instead
+        nick = args['<nick>']
+        if '@' in nick:
+            userhost = normalise_userhost(nick)
+        else:
+            nick = self.bot.casefold(nick)
+            userhosts = yield from self.resolve_userhosts([nick])
 
-        # add user to our recognised list
-        info = yield from self.bot.async.whois(nick=nick)
+            if nick not in userhosts:
+                self.out.notice(channel, '*** Could not find user to remove.')
+                return
+
+            userhost = userhosts[nick]
+
+        if userhost not in self.states[channel].recognised:
+            self.out.notice(channel, '*** User is not recognised.')
+            return
+
+        self.states[channel].recognised.discard(userhost)
+        if self.store:
+            self.store.pull_recognised(channel, userhost)
+
+        self.out.notice(channel, '*** No longer recognising {}.'.format(userhost))
+
+    @command()
+    @metrics.timed
+    @asyncio.coroutine
+    def resync(self, mask, target, args):
+        """Reload the recognised list from the database.
+
+        %%resync
+        """
+        # we only care about ops and commands to channels
+        if not (target.is_channel and self.is_admin(mask, target)):
+            return
+
+        channel = self.bot.casefold(target)
+
+        if not self.store:
+            self.out.notice(channel, '*** Not using a database.')
+            return
 
-        if not info['success']:
-            self.bot.notice(channel, '*** Could not add user to recognised list.')
+        count = yield from self.load_recognised(channel)
+        if count is None:
+            self.out.notice(channel, '*** Database unavailable; keeping the current list.')
             return
+        self.out.notice(channel, '*** Recognised list reloaded: {} users.'.format(count))
 
-        userhost = '{username}@{host}'.format(**info)
-        if userhost not in self.states[channel]['recognised']:
-            self.states[channel]['recognised'].append(userhost)
+    @command()
+    @metrics.timed
+    def database(self, mask, target, args):
+        """Show whether the database is reachable, and any writes waiting for it.
 
-            if self.db:
-                self.db.recognised.update_one({
-                        'bot': self.name,
-                        'channel': channel,
-                    }, {
-                        '$push': {
-                            'users': userhost,
-                        }
-                    }
-                )
+        %%database
+        """
+        # we only care about ops and commands to channels
+        if not (target.is_channel and self.is_admin(mask, target)):
+            return
+
+        channel = self.bot.casefold(target)
+
+        if not self.store:
+            self.out.notice(channel, '*** Not using a database.')
+            return
+
+        status = self.store.status()
+        if status['state'] == storage.CLOSED:
+            message = '*** Database OK'
+        else:
+            message = '*** Database unavailable ({state}), retrying in {retry_in:.0f}s: {last_error}'
+        message += '; queued writes: {queued}; dropped writes: {dropped}'
+        self.out.notice(channel, message.format(**status))
 
     @command()
+    @metrics.timed
     def quorum(self, mask, target, args):
         """Set or see the quorum for the current meeting.
 
@@ -166,17 +620,23 @@ class Motions(object):
                 try:
                     number = int(number)
                 except ValueError:
-                    self.bot.notice(target, '*** Quorum must be an integer')
+                    self.out.notice(target, '*** Quorum must be an integer')
                     return
 
-                self.states[target]['meeting']['quorum'] = number
-                self.bot.notice(target, '*** Quorum now set to: {}'.format(number))
+                if self.run_from_home(target):
+                    return
+                self.record(target, 'quorum', quorum=number)
+                for channel in self.linked(target):
+                    self.states[channel].meeting.quorum = number
+                    self.journal_meeting(channel)
+                    self.out.notice(channel, '*** Quorum now set to: {}'.format(number))
 
         else:
-            current_number = self.states[target]['meeting']['quorum']
-            self.bot.notice(target, '*** Quorum is: {}'.format(current_number))
+            current_number = self.states[target].meeting.quorum
+            self.out.notice(target, '*** Quorum is: {}'.format(current_number))
 
     @command()
+    @metrics.timed
     def meeting(self, mask, target, args):
         """Set or see the name for the current meeting.
 
@@ -190,15 +650,19 @@ class Motions(object):
         target = self.bot.casefold(target)
 
         if name:
-            if self.is_admin(mask, target):
-                self.states[target]['meeting']['name'] = name
-                self.bot.notice(target, '*** Meeting: ' + name)
+            if self.is_admin(mask, target) and not self.run_from_home(target):
+                self.record(target, 'meeting_named', name=name)
+                for channel in self.linked(target):
+                    self.states[channel].meeting.name = name
+                    self.journal_meeting(channel)
+                    self.out.notice(channel, '*** Meeting: ' + name)
 
         else:
-            current_name = self.states[target]['meeting']['name']
-            self.bot.notice(target, '*** Current meeting: ' + current_name)
+            current_name = self.states[target].meeting.name
+            self.out.notice(target, '*** Current meeting: ' + current_name)
 
     @command()
+    @metrics.timed
     def motion(self, mask, target, args):
         """Set or see the text for the current motion.
 
@@ -212,16 +676,19 @@ class Motions(object):
         target = self.bot.casefold(target)
 
         if text:
-            if self.is_admin(mask, target):
-                self.states[target]['motion']['text'] = text
-                self.states[target]['motion']['put_by'] = mask.nick
-                self.bot.notice(target, '*** Motion: ' + text)
+            if self.is_admin(mask, target) and not self.run_from_home(target):
+                for channel in self.linked(target):
+                    self.states[channel].motion.text = text
+                    self.states[channel].motion.put_by = mask.nick
+                    self.journal_motion(channel)
+                    self.out.notice(channel, '*** Motion: ' + text)
 
         else:
-            current_text = self.states[target]['motion']['text']
-            self.bot.notice(target, '*** Current motion: ' + current_text)
+            current_text = self.states[target].motion.text
+            self.out.notice(target, '*** Current motion: ' + current_text)
 
     @command()
+    @metrics.timed
     def ayes(self, mask, target, args):
         """Set external ayes for the current motion.
 
@@ -233,17 +700,19 @@ class Motions(object):
 
         target = self.bot.casefold(target)
 
-        if not self.states[target]['meeting']['started']:
-            self.bot.notice(target, '*** No meeting started.')
+        if not self.states[target].meeting.started:
+            self.out.notice(target, '*** No meeting started.')
             return
-        if not self.states[target]['motion']['started']:
-            self.bot.notice(target, '*** No motion started.')
+        if not self.states[target].motion.started:
+            self.out.notice(target, '*** No motion started.')
             return
 
-        self.states[target]['motion']['extra_ayes'] = int(args['<votes>'])
-        self.bot.notice(target, '*** Extra ayes: ' + args['<votes>'])
+        self.states[target].motion.extra_ayes = int(args['<votes>'])
+        self.journal_motion(target)
+        self.out.notice(target, '*** Extra ayes: ' + args['<votes>'])
 
     @command()
+    @metrics.timed
     def nays(self, mask, target, args):
         """Set external nays for the current motion.
 
@@ -255,44 +724,287 @@ class Motions(object):
 
         target = self.bot.casefold(target)
 
-        if not self.states[target]['meeting']['started']:
-            self.bot.notice(target, '*** No meeting started.')
+        if not self.states[target].meeting.started:
+            self.out.notice(target, '*** No meeting started.')
             return
-        if not self.states[target]['motion']['started']:
-            self.bot.notice(target, '*** No motion started.')
+        if not self.states[target].motion.started:
+            self.out.notice(target, '*** No motion started.')
             return
 
-        self.states[target]['motion']['extra_nays'] = int(args['<votes>'])
-        self.bot.notice(target, '*** Extra nays: ' + args['<votes>'])
+        self.states[target].motion.extra_nays = int(args['<votes>'])
+        self.journal_motion(target)
+        self.out.notice(target, '*** Extra nays: ' + args['<votes>'])
+
+    def cast_ballots(self, channel, ballots):
+        """Count ballots in the channel's motion; returns how many were counted.
+
+        A delegate who has voted in the channel keeps that vote, and their
+        ballot is skipped.
+        """
+        motion_tally = self.states[channel].motion.tally
+        casefold = self.bot.casefold
+        cast = {}
+        for delegate, choice in ballots:
+            delegate = casefold(delegate)
+            if motion_tally.cast_ballot(delegate, choice):
+                cast[delegate] = votematch.NAMES[choice]
+        if cast:
+            self.journal(channel, 'ballots', ballots=cast)
+        return len(cast)
 
     @command()
+    @metrics.timed
+    def ballot(self, mask, target, args):
+        """Count ballots cast outside the channel, given as delegate:vote.
+
+        %%ballot <ballot>...
+        """
+        # we only care about ops and commands to channels
+        if not (target.is_channel and self.is_admin(mask, target)):
+            return
+
+        target = self.bot.casefold(target)
+
+        if not self.states[target].motion.started:
+            self.out.notice(target, '*** No motion started.')
+            return
+
+        ballots = []
+        invalid = []
+        for entry in args['<ballot>']:
+            ballot = ballotfile.parse_entry(entry, self.votes)
+            if ballot is None:
+                invalid.append(entry)
+            else:
+                ballots.append(ballot)
+
+        counted = self.cast_ballots(target, ballots)
+        self.out.notice(target, '*** Ballots counted: {}; already voted here: {}'.format(
+            counted, len(ballots) - counted))
+        if invalid:
+            self.out.notice(target, '*** Not understood: ' + ', '.join(invalid))
+
+    @command()
+    @metrics.timed
+    @asyncio.coroutine
+    def ballots(self, mask, target, args):
+        """Import ballots from a CSV or JSON lines file in the ballot directory.
+
+        %%ballots <file>
+        """
+        # we only care about ops and commands to channels
+        if not (target.is_channel and self.is_admin(mask, target)):
+            return
+
+        target = self.bot.casefold(target)
+
+        if not self.ballot_dir:
+            self.out.notice(target, '*** No ballot directory configured.')
+            return
+        motion = self.states[target].motion
+        if not motion.started:
+            self.out.notice(target, '*** No motion started.')
+            return
+
+        # the file is read in the executor, a chunk at a time, and each chunk
+        # counted on the loop; votes keep being handled in between
+        loop = self.bot.loop
+        name = args['<file>']
+        try:
+            path = ballotfile.resolve(self.ballot_dir, name)
+            reader = yield from loop.run_in_executor(
+                None, ballotfile.BallotReader, path, self.votes)
+        except (ballotfile.BallotError, OSError) as exc:
+            self.out.notice(target, '*** Cannot read {}: {}'.format(name, exc))
+            return
+
+        read = counted = 0
+        try:
+            while not reader.done:
+                ballots = yield from loop.run_in_executor(None, reader.read, BALLOT_CHUNK)
+                if self.states[target].motion is not motion:
+                    self.out.notice(target, '*** The motion ended; stopped importing '
+                                            '{} after {} ballots.'.format(name, counted))
+                    return
+                read += len(ballots)
+                counted += self.cast_ballots(target, ballots)
+        except ballotfile.BallotError as exc:
+            self.out.notice(target, '*** Stopped importing {} after {} ballots: {}'.format(
+                name, counted, exc))
+            return
+        finally:
+            reader.close()
+
+        self.log.info('ballots_imported', channel=target, file=name, counted=counted,
+                      skipped=read - counted, invalid=reader.invalid)
+        self.out.notice(target, '*** Ballots counted from {}: {}; already voted here: {}; '
+                                'not understood: {}'.format(name, counted, read - counted,
+                                                            reader.invalid))
+        self.out.notice(target, '*** Running tally: ' +
+                        MOTION_RESULT_COUNT.format(**self.count_votes(target)))
+
+    @command()
+    @metrics.timed
     def start(self, mask, target, args):
-        """Start a meeting or motion.
+        """Start a meeting or motion; a motion given a time, like 5m, closes by itself.
 
-        %%start [meeting|motion]
+        %%start [meeting|motion] [<duration>]
         """
         # we only care about ops and commands to channels
         if not (target.is_channel and self.is_admin(mask, target)):
             return
 
         target = self.bot.casefold(target)
+        if self.run_from_home(target):
+            return
 
         if args['meeting']:
-            self.states[target]['meeting']['started'] = True
-            self.bot.notice(target, '*** Meeting started.')
+            meeting = self.states[target].meeting
+            if not meeting.started:
+                meeting.id = '{}-{}'.format(target, int(time.time()))
+                meeting.started = True
+                self.journal_meeting(target)
+                self.record(target, 'meeting_started', name=meeting.name,
+                            quorum=meeting.quorum)
+            self.log.info('meeting_started', channel=target, name=meeting.name)
+            self.out.notice(target, '*** Meeting started.')
 
         elif args['motion']:
-            if not self.states[target]['meeting']['started']:
-                self.bot.notice(target, '*** No meeting started.')
+            if not self.states[target].meeting.started:
+                self.out.notice(target, '*** No meeting started.')
                 return
 
-            self.states[target]['motion']['started'] = True
-            self.bot.notice(target, '*** MOTION: ' + self.states[target]['motion']['text'])
-            self.bot.notice(target, '*** Put by: ' + self.states[target]['motion']['put_by'])
-            self.bot.notice(target, '*** Please now respond either "aye", "nay" or "abstain" '
-                                    'to record a vote.')
+            duration = None
+            if args['<duration>']:
+                try:
+                    duration = scheduler.parse_duration(args['<duration>'])
+                except ValueError as exc:
+                    self.out.notice(target, '*** ' + str(exc))
+                    return
+
+            closes_at = self.states[target].motion.closes_at
+            if duration:
+                closes_at = time.time() + duration
+            for channel in self.linked(target):
+                motion = self.states[channel].motion
+                motion.started = True
+                motion.closes_at = closes_at
+                self.journal_motion(channel)
+                self.out.notice(channel, '*** MOTION: ' + motion.text)
+                self.out.notice(channel, '*** Put by: ' + motion.put_by)
+                self.out.notice(channel, '*** Please now respond either "aye", "nay" or '
+                                         '"abstain" to record a vote.')
+                if closes_at:
+                    self.out.notice(channel, '*** Voting closes in {}.'.format(
+                        scheduler.format_duration(closes_at - time.time())))
+            self.arm_motion(target)
+            motion = self.states[target].motion
+            self.log.info('motion_started', channel=target, text=motion.text,
+                          put_by=motion.put_by, closes_at=closes_at,
+                          channels=len(self.linked(target)))
+
+    def record(self, channel, kind, **fields):
+        """Write a record about the channel's current meeting to the archive."""
+        meeting = self.states[channel].meeting
+        if self.archive and meeting.started:
+            self.archive.write(kind, meeting=meeting.id, channel=channel, **fields)
+
+    def count_votes(self, channel):
+        """Return the running counts for a channel's motion, external votes included."""
+        link = self.link_for(channel)
+        if link is None:
+            motion = self.states[channel].motion
+            counts = {
+                'ayes': motion.tally.count(AYE) + motion.extra_ayes,
+                'nays': motion.tally.count(NAY) + motion.extra_nays,
+                'abstains': motion.tally.count(ABSTAIN),
+            }
+        else:
+            # voters once each across the link, then each channel's ballots
+            # and external votes, which are its own
+            counts = {
+                'ayes': link.tally.count(AYE),
+                'nays': link.tally.count(NAY),
+                'abstains': link.tally.count(ABSTAIN),
+            }
+            for linked in link.channels:
+                motion = self.states[linked].motion
+                ballots = motion.tally.ballot_tally
+                counts['ayes'] += ballots[AYE] + motion.extra_ayes
+                counts['nays'] += ballots[NAY] + motion.extra_nays
+                counts['abstains'] += ballots[ABSTAIN]
+        counts['total'] = sum(counts.values())
+        return counts
+
+    @command()
+    @metrics.timed
+    def tally(self, mask, target, args):
+        """Show the running count for the current motion.
+
+        %%tally
+        """
+        # we only care about commands to channels
+        if not target.is_channel:
+            return
+
+        target = self.bot.casefold(target)
+
+        if not self.states[target].motion.started:
+            self.out.notice(target, '*** No motion started.')
+            return
+
+        message = '*** Running tally: ' + MOTION_RESULT_COUNT.format(**self.count_votes(target))
+        closes_at = self.states[target].motion.closes_at
+        if closes_at:
+            message += '; voting closes in ' + scheduler.format_duration(
+                max(0, closes_at - time.time()))
+        self.out.notice(target, message)
 
     @command()
+    @metrics.timed
+    def queue(self, mask, target, args):
+        """Show outbound message queue statistics.
+
+        %%queue
+        """
+        # we only care about ops and commands to channels
+        if not (target.is_channel and self.is_admin(mask, target)):
+            return
+
+        stats = self.out.stats()
+        self.out.notice(self.bot.casefold(target), (
+            '*** Queued: {depth[0]} results, {depth[1]} normal, {depth[2]} courtesy; '
+            'lines sent: {sent}; messages coalesced: {coalesced}; '
+            'latency p50/max: {latency_p50:.2f}s/{latency_max:.2f}s'
+        ).format(**stats))
+
+    @command()
+    @metrics.timed
+    def suppressed(self, mask, target, args):
+        """Show how many votes on the current motion were ignored, and why.
+
+        %%suppressed
+        """
+        # we only care about ops and commands to channels
+        if not (target.is_channel and self.is_admin(mask, target)):
+            return
+
+        channel = self.bot.casefold(target)
+        motion = self.states[channel].motion
+        if not motion.started:
+            self.out.notice(channel, '*** No motion started.')
+            return
+
+        suppressed = motion.suppressed or collections.Counter()
+        self.out.notice(channel, (
+            '*** Votes ignored: {rate_limited} over the rate limit, {not_recognised} more from '
+            'unrecognised users, {repeated} repeats; unrecognised users told: {told}'
+        ).format(rate_limited=suppressed['rate_limited'],
+                 not_recognised=suppressed['not_recognised'],
+                 repeated=suppressed['repeated'], told=len(motion.rejected or ())))
+
+    @command()
+    @metrics.timed
     def cancel(self, mask, target, args):
         """Cancel a motion.
 
@@ -303,18 +1015,86 @@ class Motions(object):
             return
 
         channel = self.bot.casefold(target)
+        if self.run_from_home(channel):
+            return
 
         if args['motion']:
-            self.states[channel]['motion'] = {
-                'text': '',
-                'put_by': '',
-                'started': False,
-                'votes': {},
-            }
+            self.record(channel, 'motion_cancelled',
+                        text=self.states[channel].motion.text)
+            for linked in self.linked(channel):
+                self.reset_motion(linked)
+                self.out.notice(linked, '*** Motion cancelled.')
+
+    @command()
+    @metrics.timed
+    def link(self, mask, target, args):
+        """Run this channel's meeting in other channels too, under one quorum and tally.
+
+        %%link [<channel>...]
+        """
+        if not target.is_channel:
+            return
 
-            self.bot.notice(channel, '*** Motion cancelled.')
+        home = self.bot.casefold(target)
+        channels = [self.bot.casefold(irc3.utils.as_channel(channel))
+                    for channel in args['<channel>']]
+        if channels:
+            if not self.is_admin(mask, home) or self.run_from_home(home):
+                return
+            if not self.states[home].meeting.started:
+                self.out.notice(home, '*** No meeting started.')
+                return
+
+            for channel in channels:
+                if channel == home:
+                    continue
+                if channel not in self.states or channel not in self.bot.channels:
+                    problem = 'I am not in {}.'
+                elif not self.is_admin(mask, channel):
+                    problem = 'You are not an operator in {}.'
+                elif channel in self.link_of:
+                    problem = '{} is already in a linked meeting.'
+                elif self.states[channel].meeting.started:
+                    problem = '{} has a meeting of its own.'
+                else:
+                    self.link_channel(home, channel)
+                    continue
+                self.out.notice(home, '*** ' + problem.format(channel))
+
+        if home in self.link_of:
+            self.out.notice(home, '*** Linked channels: ' + ', '.join(self.linked(home)))
+        else:
+            self.out.notice(home, '*** This meeting is not linked.')
+
+    @command()
+    @metrics.timed
+    def unlink(self, mask, target, args):
+        """Take channels, or all of them, out of this channel's linked meeting.
+
+        %%unlink [<channel>...]
+        """
+        # we only care about ops and commands to channels
+        if not (target.is_channel and self.is_admin(mask, target)):
+            return
+
+        home = self.bot.casefold(target)
+        if self.run_from_home(home):
+            return
+        if home not in self.link_of:
+            self.out.notice(home, '*** This meeting is not linked.')
+            return
+
+        channels = ([self.bot.casefold(irc3.utils.as_channel(channel))
+                     for channel in args['<channel>']] or self.linked(home)[1:])
+        for channel in channels:
+            if channel == home or self.link_of.get(channel) != home:
+                self.out.notice(home, '*** {} is not linked to this meeting.'.format(channel))
+            else:
+                self.unlink_channel(channel)
+        self.out.notice(home, '*** Linked channels: ' + ', '.join(self.linked(home)))
 
     @command()
+    @metrics.timed
     def stop(self, mask, target, args):
         """Stop a meeting or motion.
 
@@ -325,140 +1105,310 @@ class Motions(object):
             return
 
         channel = self.bot.casefold(target)
+        if self.run_from_home(channel):
+            return
 
         if args['meeting']:
-            if not self.states[channel]['meeting']['started']:
-                self.bot.notice(channel, '*** No meeting started.')
+            if not self.states[channel].meeting.started:
+                self.out.notice(channel, '*** No meeting started.')
                 return
 
-            # XXX - save the meeting data
+            for linked in self.linked(channel)[1:]:
+                self.unlink_channel(linked)
+            self.record(channel, 'meeting_stopped')
 
-            self.states[channel]['meeting'] = {
-                'name': '',
-                'started': False,
-                'quorum': 0,
-            }
-            self.states[channel]['motion'] = {
-                'text': '',
-                'put_by': '',
-                'started': False,
-                'votes': {},
-            }
+            self.states[channel].meeting = state.Meeting()
+            self.journal_meeting(channel)
+            self.reset_motion(channel)
 
-            self.bot.notice(channel, '*** Meeting ended.')
+            self.log.info('meeting_stopped', channel=channel)
+            self.out.notice(channel, '*** Meeting ended.')
 
         elif args['motion']:
-            if not self.states[channel]['motion']['started']:
-                self.bot.notice(channel, '*** There is no motion to stop.')
+            if not self.states[channel].motion.started:
+                self.out.notice(channel, '*** There is no motion to stop.')
                 return
+            self.close_motion(channel)
 
-            # construct aye/nay list
-            ayes = []
-            nays = []
-            abstains = []
+    def close_motion(self, channel):
+        """Announce a motion's votes and result, archive it and clear it.
 
-            for nick, vote in self.states[channel]['motion']['votes'].items():
-                # user left channel
-                if nick not in self.bot.channels[channel]:
-                    continue
+        A linked meeting's motion closes in all its channels, with one result.
+        """
+        channels = self.linked(channel)
+        motions = [self.states[linked].motion for linked in channels]
+        motion = motions[0]
+        counts = self.count_votes(channel)
+
+        def results(message):
+            for linked in channels:
+                self.out.notice(linked, message, priority=outbound.RESULT)
+
+        def voters(choice):
+            nicks = set()
+            for linked_motion in motions:
+                nicks.update(linked_motion.tally.voters(choice))
+            return ', '.join(map(casemapping.display, sorted(nicks))) or 'none'
+
+        results('*** Votes')
+        results(MOTION_RESULT_LIST.format(**{
+            'ayes': voters(AYE),
+            'nays': voters(NAY),
+            'abstains': voters(ABSTAIN),
+        }))
+
+        extra_ayes = sum(linked_motion.extra_ayes for linked_motion in motions)
+        extra_nays = sum(linked_motion.extra_nays for linked_motion in motions)
+        if extra_ayes or extra_nays:
+            results(MOTION_EXTERNAL_VOTES.format(**{
+                'ayes': extra_ayes,
+                'nays': extra_nays,
+            }))
 
-                if vote is True:
-                    ayes.append(nick)
-                elif vote is False:
-                    nays.append(nick)
-                else:
-                    abstains.append(nick)
+        if any(linked_motion.tally.ballots for linked_motion in motions):
+            ballot_counts = [sum(counted) for counted in zip(
+                *(linked_motion.tally.ballot_counts() for linked_motion in motions))]
+            results(MOTION_BALLOTS.format(**{
+                'ayes': ballot_counts[AYE],
+                'nays': ballot_counts[NAY],
+                'abstains': ballot_counts[ABSTAIN],
+            }))
 
-            # count it up
-            extra_ayes = self.states[channel]['motion'].get('extra_ayes', 0)
-            extra_nays = self.states[channel]['motion'].get('extra_nays', 0)
+        aye_count = counts['ayes']
+        nay_count = counts['nays']
+        total = counts['total']
+        quorum = self.states[channel].meeting.quorum
 
-            aye_count = len(ayes) + extra_ayes
-            nay_count = len(nays) + extra_nays
-            abstain_count = len(abstains)
+        votes = {}
+        ballots = {}
+        for linked_motion in motions:
+            saved = linked_motion.tally.dump()
+            votes.update(saved['votes'])
+            ballots.update(saved['ballots'])
 
-            self.bot.notice(channel, '*** Votes')
-            self.bot.notice(channel, MOTION_RESULT_LIST.format(**{
-                'ayes': ', '.join(ayes) if ayes else 'none',
-                'nays': ', '.join(nays) if nays else 'none',
-                'abstains': ', '.join(abstains) if abstains else 'none',
-            }))
+        self.log.info('motion_stopped', channel=channel, quorum=quorum, votes=votes,
+                      **counts)
 
-            if extra_ayes or extra_nays:
-                self.bot.notice(channel, MOTION_EXTERNAL_VOTES.format(**{
-                    'ayes': extra_ayes,
-                    'nays': extra_nays,
-                }))
-
-            total = aye_count + nay_count + abstain_count
-            quorum = self.states[channel]['meeting']['quorum']
-
-            self.bot.notice(channel, '*** Tally')
-            self.bot.notice(channel, MOTION_RESULT_COUNT.format(**{
-                'ayes': aye_count,
-                'nays': nay_count,
-                'abstains': abstain_count,
-                'total': total,
-            }))
+        results('*** Tally')
+        results(MOTION_RESULT_COUNT.format(**counts))
 
-            pc_in_favour = (aye_count / (aye_count + nay_count) * 100)
+        # nobody may have voted either way
+        if aye_count + nay_count:
+            pc_in_favour = aye_count / (aye_count + nay_count) * 100
+        else:
+            pc_in_favour = 0.0
+
+        if total < quorum:
+            result = 'lapsed, quorum not met'
+            results(MOTION_LAPSES_QUORUM.format(quorum=quorum))
+        elif (aye_count - nay_count) > 0:
+            result = 'carried'
+            results(MOTION_CARRIES.format(in_favour=pc_in_favour))
+        else:
+            result = 'lapsed'
+            results(MOTION_LAPSES_PC.format(in_favour=pc_in_favour))
+
+        fields = dict(counts)
+        if len(channels) > 1:
+            fields['channels'] = channels
+        self.record(channel, 'motion', text=motion.text, put_by=motion.put_by,
+                    votes=votes, ballots=ballots, extra_ayes=extra_ayes,
+                    extra_nays=extra_nays, quorum=quorum, in_favour=pc_in_favour,
+                    result=result, **fields)
+
+        link = self.link_for(channel)
+        if link is not None:
+            # so resetting each channel needn't take its votes out one by one
+            link.new_motion()
+        for linked in channels:
+            self.reset_motion(linked)
 
-            if total < quorum:
-                self.bot.notice(channel, MOTION_LAPSES_QUORUM.format(quorum=quorum))
-            elif (aye_count - nay_count) > 0:
-                self.bot.notice(channel, MOTION_CARRIES.format(in_favour=pc_in_favour))
-            else:
-                self.bot.notice(channel, MOTION_LAPSES_PC.format(in_favour=pc_in_favour))
+    # everyone commands
+    @asyncio.coroutine
+    def search_history(self, method, *args, **kwargs):
+        """Bring the history index up to date, then return a page of a query on it."""
+        def run():
+            self.history_index.update(self.archive.path)
+            return list(getattr(self.history_index, method)(*args, **kwargs))
+        return (yield from self.bot.loop.run_in_executor(self.history_executor, run))
+
+    def show_history(self, nick, lines, page, more):
+        """Send a page of results privately, saying how to get the next one."""
+        if not lines:
+            self.out.notice(nick, '*** Nothing found.', priority=outbound.COURTESY)
+            return
+        for line in lines:
+            self.out.notice(nick, line, priority=outbound.COURTESY)
+        if more:
+            self.out.notice(nick, '*** More with --page={}'.format(page + 1),
+                            priority=outbound.COURTESY)
+
+    def history_options(self, nick, args):
+        """Return the page and start date given to !history or !voted, or None."""
+        try:
+            page = max(1, int(args['--page'] or 1))
+            since = historyindex.parse_since(args['--since']) if args['--since'] else None
+        except ValueError as exc:
+            self.out.notice(nick, '*** ' + str(exc), priority=outbound.COURTESY)
+            return None
+        return page, since
 
-            self.states[channel]['motion'] = {
-                'text': '',
-                'put_by': '',
-                'started': False,
-                'votes': {},
-            }
+    @command()
+    @metrics.timed
+    @asyncio.coroutine
+    def history(self, mask, target, args):
+        """Search past motions for words; dates look like 2024-06-30 or 365d.
+
+        %%history [--since=<date>] [--page=<n>] <words>...
+        """
+        if self.history_index is None:
+            self.out.notice(mask.nick, '*** No history is kept.', priority=outbound.COURTESY)
+            return
+        options = self.history_options(mask.nick, args)
+        if options is None:
+            return
+        page, since = options
+
+        # one more than a page, to know whether there's another
+        motions = yield from self.search_history(
+            'search', args['<words>'], since=since, limit=HISTORY_PAGE + 1,
+            offset=(page - 1) * HISTORY_PAGE)
+        lines = [historyindex.format_motion(motion) for motion in motions[:HISTORY_PAGE]]
+        self.show_history(mask.nick, lines, page, len(motions) > HISTORY_PAGE)
+
+    @command()
+    @metrics.timed
+    @asyncio.coroutine
+    def voted(self, mask, target, args):
+        """Show how someone voted, optionally on motions with the given words.
+
+        %%voted [--since=<date>] [--page=<n>] <nick> [<words>...]
+        """
+        if self.history_index is None:
+            self.out.notice(mask.nick, '*** No history is kept.', priority=outbound.COURTESY)
+            return
+        options = self.history_options(mask.nick, args)
+        if options is None:
+            return
+        page, since = options
+
+        votes = yield from self.search_history(
+            'voted', str(self.bot.casefold(args['<nick>'])), args['<words>'], since=since,
+            limit=HISTORY_PAGE + 1, offset=(page - 1) * HISTORY_PAGE)
+        lines = [historyindex.format_vote(vote) for vote in votes[:HISTORY_PAGE]]
+        self.show_history(mask.nick, lines, page, len(votes) > HISTORY_PAGE)
 
-    # everyone commands
     @irc3.event(irc3.rfc.PRIVMSG)
+    @metrics.timed
     def aye_nay_abstain(self, mask, event, target, data):
         """Accept aye/nay/abstain in regards to a motion."""
         # we only care about messages to channels
         if not target.is_channel:
             return
 
+        # most messages are chatter, so turn them away before doing any work
         target = self.bot.casefold(target)
-        nick = self.bot.casefold(mask.nick)
-
-        cmd = data.casefold().split()[0]
-
-        if not self.states[target]['motion']['started'] or cmd not in ('aye', 'nay', 'abstain'):
+        channel_state = self.states.get(target)
+        if channel_state is None or not channel_state.motion.started:
             return
 
-        if not (self.is_voice(mask, target) or self.is_admin(mask, target)):
-            self.bot.privmsg(nick, 'You are not recognised; your vote has not been '
-                             'counted. If this a mistake, inform the operators.')
+        cmd = self.votes.match(data)
+        if cmd is None:
             return
 
-        if cmd == 'aye':
-            self.states[target]['motion']['votes'][nick] = True
-
-        elif cmd == 'nay':
-            self.states[target]['motion']['votes'][nick] = False
+        nick = self.bot.casefold(mask.nick)
+        motion = channel_state.motion
 
-        elif cmd == 'abstain':
-            self.states[target]['motion']['votes'][nick] = None
+        # someone flooding votes costs a bucket lookup per line, and gets nothing back
+        if not self.take_vote_token(nick):
+            self.suppress_vote(target, motion, 'rate_limited')
+            return
 
-    @irc3.event(irc3.rfc.NEW_NICK)
-    def track_nick(self, nick, new_nick):
-        """Track nick changes in regard to all motions."""
-        old_nick = self.bot.casefold(nick.nick)
-        new_nick = self.bot.casefold(new_nick)
-        for channel in self.states:
-            if old_nick in self.states[channel]['motion']['votes']:
-                self.states[channel]['motion']['votes'][new_nick] = self.states[channel]['motion']['votes'][old_nick]
-                del self.states[channel]['motion']['votes'][old_nick]
+        if not self.can_vote(nick, target):
+            # told once per motion; they may yet be voiced, so they're still checked
+            if not motion.reject(nick):
+                self.suppress_vote(target, motion, 'not_recognised')
+                return
+            self.log.info('vote_rejected', channel=target, nick=nick)
+            self.out.privmsg(mask.nick, 'You are not recognised; your vote has not been '
+                             'counted. If this a mistake, inform the operators.',
+                             priority=outbound.COURTESY)
+            return
 
-    # This is just to help me debug, it prints everything, every event
-    @event(r'(?P<message>.*)')
-    def debug(self, message=None):
-        print(datetime.datetime.now().strftime("[%H:%M:%S]"), message)
-        print('   ', self.states)
+        motion_tally = motion.tally
+        link = self.link_for(target)
+        if motion_tally.votes.get(nick) == cmd:
+            # a repeat changes nothing, unless the voter has since voted
+            # differently in another linked channel
+            key = motion.keys[nick][0] if nick in motion.keys else nick
+            if link is None or link.tally.choices.get(key) == cmd:
+                self.suppress_vote(target, motion, 'repeated')
+                return
+        key = self.voter_key(nick, mask)
+        when = time.time()
+        motion.keep_key(nick, key, when)
+        motion_tally.cast(nick, cmd)
+        self.journal(target, 'vote', nick=nick, choice=votematch.NAMES[cmd], key=key, when=when)
+        if link is not None:
+            link.tally.cast(target, nick, key, cmd, when)
+        metrics.votes.inc(target)
+        self.log.debug('vote', channel=target, nick=nick, vote=votematch.NAMES[cmd])
+
+    def take_vote_token(self, nick):
+        """Take a token from a nick's vote bucket; False if it has none left."""
+        now = self.bot.loop.time()
+        bucket = self.vote_buckets.get(nick)
+        if bucket is None:
+            if len(self.vote_buckets) >= self.vote_buckets_limit:
+                # buckets which have refilled would be recreated full anyway. in
+                # a mass vote few have, so wait for twice as many as are left
+                # before looking again, rather than scanning for every new voter
+                for other, old in list(self.vote_buckets.items()):
+                    old.refill(now)
+                    if old.tokens >= old.burst:
+                        del self.vote_buckets[other]
+                self.vote_buckets_limit = max(VOTE_BUCKETS, 2 * len(self.vote_buckets))
+            bucket = self.vote_buckets[nick] = outbound.TokenBucket(
+                self.vote_rate, self.vote_burst, now)
+        if bucket.wait(now):
+            return False
+        bucket.take(now)
+        return True
+
+    def suppress_vote(self, channel, motion, reason):
+        motion.suppress(reason)
+        metrics.votes_suppressed.inc(channel, reason)
+
+    def userlist_changed(self, event, nick, channels, new_nick=None):
+        """Keep motion tallies in step with users joining, leaving and renaming.
+
+        Userlist hands us casefolded nicks, the same keys the tallies use.
+        """
+        for channel in channels:
+            channel_state = self.states.get(channel)
+            if channel_state is None or not channel_state.motion.started:
+                continue
+
+            # only log changes which touch a vote; most joins and parts don't
+            motion_tally = channel_state.motion.tally
+            link = self.link_for(channel)
+            if event == 'join':
+                if nick in motion_tally.departed:
+                    motion_tally.rejoin(nick)
+                    self.journal(channel, 'rejoin', nick=nick)
+                    if link is not None:
+                        link.tally.rejoin(channel, nick)
+            elif event == 'nick':
+                if nick in motion_tally.votes or nick in motion_tally.departed:
+                    motion_tally.rename(nick, new_nick)
+                    keys = channel_state.motion.keys
+                    if nick in keys:
+                        keys[new_nick] = keys.pop(nick)
+                    self.journal(channel, 'rename', nick=nick, new_nick=new_nick)
+                    if link is not None:
+                        link.tally.rename(channel, nick, new_nick)
+            elif nick in motion_tally.votes:
+                motion_tally.depart(nick)
+                self.journal(channel, 'depart', nick=nick)
+                if link is not None:
+                    link.tally.depart(channel, nick)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Append-only archive of meetings, motions and their results.
+
+Records are JSON lines. The bot hands them to a background writer thread,
+which writes whatever has queued up and fsyncs once per batch, so recording
+a result never waits on the disk. A record is written as soon as the writer
+is free; those queued while it was busy go out together in the next batch.
+The bot closes the archive as it stops, so nothing queued is lost.
+
+Export a meeting's minutes with::
+
+    python archive.py meetings.jsonl              # list meetings
+    python archive.py meetings.jsonl <meeting>    # print its minutes
+"""
+import collections
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # not on windows; there's no sharding there either
+    fcntl = None
+
+# tells the writer thread to finish up
+_CLOSE = object()
+
+
+class Archive(object):
+    """Appends records to a JSONL file from a background thread."""
+
+    def __init__(self, path, batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='archive')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, kind, **fields):
+        """Queue a record; returns immediately."""
+        fields['kind'] = kind
+        fields.setdefault('ts', time.time())
+        self.queue.put(fields)
+
+    def close(self):
+        """Write out everything queued and stop the writer thread."""
+        self.queue.put(_CLOSE)
+        self.thread.join()
+
+    def _batch(self):
+        # wait for one record, then take whatever else is already waiting
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not _CLOSE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        with open(self.path, 'a', encoding='utf-8') as fd:
+            while True:
+                batch = self._batch()
+                lines = ''.join(json.dumps(record, sort_keys=True) + '\n'
+                                for record in batch if record is not _CLOSE)
+                # sharded bots share the file; keep each batch's lines together
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    fd.write(lines)
+                    fd.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(fd, fcntl.LOCK_UN)
+                os.fsync(fd.fileno())
+                if batch[-1] is _CLOSE:
+                    return
+
+
+def read(path):
+    """Yield every record in an archive, one line at a time."""
+    with open(path, encoding='utf-8') as fd:
+        for line in fd:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def meetings(path):
+    """Return the ``meeting_started`` record of every meeting, with the name
+    it was last given."""
+    started = collections.OrderedDict()
+    for record in read(path):
+        if record['kind'] == 'meeting_started':
+            started[record['meeting']] = record
+        elif record['kind'] == 'meeting_named' and record['meeting'] in started:
+            started[record['meeting']]['name'] = record['name']
+    return list(started.values())
+
+
+def meeting_records(path, meeting):
+    """Yield the records belonging to one meeting."""
+    for record in read(path):
+        if record.get('meeting') == meeting:
+            yield record
+
+
+def _when(ts):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))
+
+
+def minutes(records):
+    """Turn a meeting's records into lines of minutes."""
+    for record in records:
+        kind = record['kind']
+        if kind == 'meeting_started':
+            yield 'Meeting: {} ({})'.format(record['name'] or 'unnamed', record['channel'])
+            yield 'Started: {} UTC'.format(_when(record['ts']))
+        elif kind == 'meeting_named':
+            yield '[{}] Meeting named: {}'.format(_when(record['ts']), record['name'])
+        elif kind == 'quorum':
+            yield '[{}] Quorum set to {}'.format(_when(record['ts']), record['quorum'])
+        elif kind == 'channel_linked':
+            yield '[{}] Linked: {}'.format(_when(record['ts']), record['linked'])
+        elif kind == 'channel_unlinked':
+            yield '[{}] Unlinked: {}'.format(_when(record['ts']), record['linked'])
+        elif kind == 'motion_cancelled':
+            yield '[{}] Motion cancelled: {}'.format(_when(record['ts']), record['text'])
+        elif kind == 'motion':
+            yield ''
+            yield 'Motion: {}'.format(record['text'])
+            yield '  Put by: {}'.format(record['put_by'])
+            if record.get('channels'):
+                yield '  Channels: {}'.format(', '.join(record['channels']))
+            for choice in ('aye', 'nay', 'abstain'):
+                voters = sorted(n for n, v in record['votes'].items() if v == choice)
+                yield '  {}: {}'.format(choice.capitalize() + 's', ', '.join(voters) or 'none')
+            if record['extra_ayes'] or record['extra_nays']:
+                yield '  External ayes: {extra_ayes}; external nays: {extra_nays}'.format(**record)
+            ballots = record.get('ballots')
+            if ballots:
+                for choice in ('aye', 'nay', 'abstain'):
+                    delegates = sorted(n for n, v in ballots.items() if v == choice)
+                    yield '  Ballots, {}: {}'.format(choice + 's', ', '.join(delegates) or 'none')
+            yield '  Tally: {ayes} ayes, {nays} nays, {abstains} abstains (quorum {quorum})'.format(
+                **record)
+            yield '  Result: {}'.format(record['result'])
+        elif kind == 'meeting_stopped':
+            yield ''
+            yield 'Closed: {} UTC'.format(_when(record['ts']))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or len(argv) > 2:
+        print('usage: python archive.py <archive> [<meeting>]')
+        return 1
+
+    if len(argv) == 1:
+        for record in meetings(argv[0]):
+            print('{meeting}  {name}'.format(**record))
+    else:
+        for line in minutes(meeting_records(*argv)):
+            print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
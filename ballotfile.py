@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Read ballots cast outside the channel: proxies, postal votes, delegates in the room.
+
+A ballot file is either CSV, one ``delegate,vote`` row per ballot (a header
+row is skipped), or JSON lines, one ``{"delegate": ..., "vote": ...}`` object
+per ballot. Votes are written with the same words the bot accepts in the
+channel.
+
+Files are read a chunk at a time, so a large one is never held in memory all
+at once, and each chunk can be read in an executor::
+
+    reader = BallotReader(path, matcher)
+    while not reader.done:
+        for delegate, vote in reader.read(1000):
+            ...
+    reader.close()
+"""
+import csv
+import itertools
+import json
+import os
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl'}
+
+
+class BallotError(Exception):
+    """A ballot file which can't be read."""
+
+
+def parse(delegate, vote, matcher):
+    """Return ``(delegate, vote)``, or None if either is unusable."""
+    if not (isinstance(delegate, str) and isinstance(vote, str)):
+        return None
+    delegate = delegate.strip()
+    choice = matcher.words.get(vote.strip().casefold())
+    if not delegate or choice is None:
+        return None
+    return delegate, choice
+
+
+def parse_entry(entry, matcher):
+    """Parse a ``delegate:vote`` (or ``delegate=vote``) pair, as typed in the channel."""
+    for separator in (':', '='):
+        if separator in entry:
+            delegate, _, vote = entry.rpartition(separator)
+            return parse(delegate, vote, matcher)
+    return None
+
+
+def resolve(directory, name):
+    """Return the path of ballot file ``name``, which must be inside ``directory``."""
+    directory = os.path.realpath(directory)
+    path = os.path.realpath(os.path.join(directory, name))
+    if not path.startswith(directory + os.sep):
+        raise BallotError('ballot files must be in the ballot directory')
+    return path
+
+
+class BallotReader(object):
+    """Reads ballots from a file, a chunk at a time. Blocking."""
+
+    def __init__(self, path, matcher):
+        fmt = FORMATS.get(os.path.splitext(path)[1].lower())
+        if fmt is None:
+            raise BallotError('unknown ballot file type; use .csv or .jsonl')
+        self.matcher = matcher
+        self.fd = open(path, encoding='utf-8', newline='')
+        self.rows = self._csv() if fmt == 'csv' else self._jsonl()
+        # rows which weren't a ballot we could read
+        self.invalid = 0
+        self.done = False
+
+    def _csv(self):
+        for number, row in enumerate(csv.reader(self.fd)):
+            if not row:
+                continue
+            ballot = parse(row[0], row[1], self.matcher) if len(row) >= 2 else None
+            if ballot is None and number == 0:
+                # a header
+                continue
+            yield ballot
+
+    def _jsonl(self):
+        for line in self.fd:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                yield None
+                continue
+            if not isinstance(entry, dict):
+                yield None
+                continue
+            yield parse(entry.get('delegate'), entry.get('vote'), self.matcher)
+
+    def read(self, size):
+        """Read up to ``size`` rows, returning the ballots among them."""
+        ballots = []
+        rows = 0
+        try:
+            for ballot in itertools.islice(self.rows, size):
+                rows += 1
+                if ballot is None:
+                    self.invalid += 1
+                else:
+                    ballots.append(ballot)
+        except (csv.Error, UnicodeDecodeError) as exc:
+            self.done = True
+            raise BallotError(str(exc))
+        if rows < size:
+            self.done = True
+        return ballots
+
+    def close(self):
+        self.fd.close()
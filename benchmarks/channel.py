@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Compare the bitmask Channel with the old set-of-sets Channel.
+
+    python benchmarks/channel.py [--users 5000]
+
+Prints the memory held by a populated channel and the time taken by the
+operations Userlist and Motions perform on it.
+"""
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mappinguserlist import Channel, mode_mask  # noqa: E402
+
+PREFIXES = '~&@%+'
+
+
+class LegacyChannel(set):
+    """The Channel implementation before the bitmask rewrite."""
+
+    def __init__(self):
+        set.__init__(self)
+        self.modes = defaultdict(set)
+        self.topic = None
+
+    def add(self, item, modes=''):
+        set.add(self, item)
+        for mode in modes:
+            self.modes[mode].add(item)
+
+    def remove(self, item):
+        set.remove(self, item)
+        for items in self.modes.values():
+            if item in items:
+                items.remove(item)
+
+    def rename(self, item, new_item):
+        for nicknames in self.modes.values():
+            if item in nicknames:
+                nicknames.add(new_item)
+        self.remove(item)
+        self.add(new_item)
+
+    def has_mode(self, item, modes):
+        for mode in modes:
+            if item in self.modes[mode]:
+                return True
+        return False
+
+
+def nicklist(users):
+    # mostly plain users, some voiced, a handful of ops
+    nicks = []
+    for i in range(users):
+        if i % 50 == 0:
+            modes = '@'
+        elif i % 3 == 0:
+            modes = '+'
+        else:
+            modes = ''
+        nicks.append(('user{}'.format(i), modes))
+    return nicks
+
+
+def populate(cls, nicks):
+    channel = cls()
+    for nick, modes in nicks:
+        channel.add(nick, modes=modes)
+    return channel
+
+
+def memory(cls, nicks):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    channel = populate(cls, nicks)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del channel
+    return after - before
+
+
+def operations(cls, nicks):
+    if cls is Channel:
+        allowed = mode_mask('~&@%+')
+    else:
+        allowed = PREFIXES
+
+    def check():
+        channel = populate(cls, nicks)
+        has_mode = channel.has_mode
+        for nick, _ in nicks:
+            has_mode(nick, allowed)
+
+    def rename():
+        channel = populate(cls, nicks)
+        for nick, _ in nicks:
+            channel.rename(nick, nick + '_')
+
+    def remove():
+        channel = populate(cls, nicks)
+        for nick, _ in nicks:
+            channel.remove(nick)
+
+    return (
+        ('populate', lambda: populate(cls, nicks)),
+        ('populate+check', check),
+        ('populate+rename', rename),
+        ('populate+remove', remove),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    options = parser.parse_args()
+
+    nicks = nicklist(options.users)
+    for cls in (LegacyChannel, Channel):
+        print('{} ({} users)'.format(cls.__name__, options.users))
+        print('  {:16} {:>10,} bytes'.format('memory', memory(cls, nicks)))
+        for name, func in operations(cls, nicks):
+            best = min(timeit.repeat(func, number=1, repeat=options.repeat))
+            print('  {:16} {:>10.2f} ms'.format(name, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
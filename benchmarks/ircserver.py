@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""A small stand-in IRC server, for running bots end to end on one machine.
+
+    python benchmarks/ircserver.py [--port 6667]
+
+It speaks enough of the protocol for Rhythm and its users: registration,
+PING, JOIN, PART, QUIT, NICK, PRIVMSG, NOTICE, channel MODE for ops and
+voices, NAMES, WHO and WHOIS. The first to join a channel is its op. There
+are no services, limits or flood control.
+"""
+import argparse
+import asyncio
+import sys
+
+SERVER = 'irc.localhost'
+ISUPPORT = ('PREFIX=(ov)@+ CHANTYPES=#& CHANMODES=b,k,l,imnst MODES=4 '
+            'CASEMAPPING=rfc1459 NICKLEN=30')
+RFC1459 = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~',
+                        'abcdefghijklmnopqrstuvwxyz{}|^')
+PREFIXES = {'o': '@', 'v': '+'}
+
+
+def fold(name):
+    return name.translate(RFC1459)
+
+
+class Client(object):
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.nick = None
+        self.user = None
+        self.host = writer.get_extra_info('peername')[0]
+        self.registered = False
+        # folded channel names
+        self.channels = set()
+
+    @property
+    def mask(self):
+        return '{}!{}@{}'.format(self.nick, self.user, self.host)
+
+    def send(self, line):
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+
+    def reply(self, numeric, *params):
+        """Send a numeric; the last parameter is the trailing one."""
+        params = list(params)
+        params[-1] = ':' + params[-1]
+        self.send(':{} {} {} {}'.format(SERVER, numeric, self.nick or '*', ' '.join(params)))
+
+
+class Channel(object):
+
+    def __init__(self, name):
+        self.name = name
+        # folded nick -> client
+        self.members = {}
+        # folded nick -> set of 'o'/'v'
+        self.modes = {}
+
+    def prefix(self, nick):
+        modes = self.modes.get(nick, ())
+        return ''.join(PREFIXES[mode] for mode in 'ov' if mode in modes)
+
+    def broadcast(self, line, exclude=None):
+        for client in self.members.values():
+            if client is not exclude:
+                client.send(line)
+
+
+class Server(object):
+
+    def __init__(self, host='127.0.0.1', port=6667, loop=None):
+        self.host = host
+        self.port = port
+        self.loop = loop or asyncio.get_event_loop()
+        # folded nick -> client, folded name -> channel
+        self.clients = {}
+        self.channels = {}
+
+    @asyncio.coroutine
+    def start(self):
+        self.server = yield from asyncio.start_server(
+            self.serve, self.host, self.port, loop=self.loop)
+        # port 0 picks a free one
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    def close(self):
+        self.server.close()
+
+    @asyncio.coroutine
+    def serve(self, reader, writer):
+        client = Client(self, reader, writer)
+        try:
+            while True:
+                line = yield from reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').rstrip('\r\n')
+                if line:
+                    self.handle(client, line)
+        except ConnectionError:
+            pass
+        finally:
+            self.quit(client, 'Connection closed')
+            writer.close()
+
+    def handle(self, client, line):
+        if line.startswith(':'):
+            line = line.split(' ', 1)[1] if ' ' in line else ''
+        head, _, trailing = line.partition(' :')
+        params = head.split()
+        if not params:
+            return
+        if _:
+            params.append(trailing)
+        command = params.pop(0).upper()
+        if not client.registered and command not in ('NICK', 'USER', 'PING', 'CAP', 'PASS'):
+            return
+        handler = getattr(self, 'on_' + command.lower(), None)
+        if handler is not None and (params or command == 'QUIT'):
+            handler(client, *params)
+
+    # registration
+    def on_nick(self, client, nick, *rest):
+        folded = fold(nick)
+        if folded in self.clients and self.clients[folded] is not client:
+            client.reply('433', nick, 'Nickname is already in use')
+            return
+        if client.registered:
+            line = ':{} NICK :{}'.format(client.mask, nick)
+            seen = {client}
+            client.send(line)
+            for name in client.channels:
+                channel = self.channels[name]
+                for member in channel.members.values():
+                    if member not in seen:
+                        seen.add(member)
+                        member.send(line)
+                channel.members[folded] = channel.members.pop(fold(client.nick))
+                channel.modes[folded] = channel.modes.pop(fold(client.nick))
+            del self.clients[fold(client.nick)]
+        client.nick = nick
+        self.clients[folded] = client
+        self.register(client)
+
+    def on_user(self, client, user, *rest):
+        client.user = user
+        self.register(client)
+
+    def register(self, client):
+        if client.registered or not (client.nick and client.user):
+            return
+        client.registered = True
+        client.reply('001', 'Welcome to the stand-in network ' + client.mask)
+        client.reply('005', *(ISUPPORT.split() + ['are supported by this server']))
+        client.reply('422', 'MOTD File is missing')
+
+    def on_ping(self, client, token, *rest):
+        client.send(':{} PONG {} :{}'.format(SERVER, SERVER, token))
+
+    # channels
+    def on_join(self, client, names, *rest):
+        for name in names.split(','):
+            folded = fold(name)
+            if folded in client.channels or not name.startswith(('#', '&')):
+                continue
+            channel = self.channels.get(folded)
+            if channel is None:
+                channel = self.channels[folded] = Channel(name)
+            nick = fold(client.nick)
+            channel.members[nick] = client
+            channel.modes[nick] = set() if len(channel.members) > 1 else {'o'}
+            client.channels.add(folded)
+            channel.broadcast(':{} JOIN {}'.format(client.mask, channel.name))
+            self.on_names(client, channel.name)
+
+    def on_part(self, client, names, message='', *rest):
+        for name in names.split(','):
+            channel = self.channels.get(fold(name))
+            if channel is None or fold(name) not in client.channels:
+                continue
+            channel.broadcast(':{} PART {} :{}'.format(client.mask, channel.name, message))
+            self.leave(client, channel)
+
+    def leave(self, client, channel):
+        nick = fold(client.nick)
+        channel.members.pop(nick, None)
+        channel.modes.pop(nick, None)
+        client.channels.discard(fold(channel.name))
+        if not channel.members:
+            del self.channels[fold(channel.name)]
+
+    def quit(self, client, message='', *rest):
+        if client.nick is None or self.clients.get(fold(client.nick)) is not client:
+            return
+        line = ':{} QUIT :{}'.format(client.mask, message)
+        seen = {client}
+        for name in list(client.channels):
+            channel = self.channels[name]
+            for member in channel.members.values():
+                if member not in seen:
+                    seen.add(member)
+                    member.send(line)
+            self.leave(client, channel)
+        del self.clients[fold(client.nick)]
+
+    def on_quit(self, client, message='', *rest):
+        self.quit(client, message)
+        client.writer.close()
+
+    def on_names(self, client, name, *rest):
+        channel = self.channels.get(fold(name))
+        if channel is not None:
+            names = [channel.prefix(nick) + member.nick
+                     for nick, member in channel.members.items()]
+            for i in range(0, len(names), 50):
+                client.reply('353', '=', channel.name, ' '.join(names[i:i + 50]))
+        client.reply('366', name, 'End of /NAMES list.')
+
+    def on_mode(self, client, target, modes=None, *args):
+        channel = self.channels.get(fold(target))
+        if channel is None:
+            # user modes; nothing to do
+            return
+        if modes is None:
+            client.reply('324', channel.name, '+nt')
+            return
+        if 'o' not in channel.modes.get(fold(client.nick), ()):
+            client.reply('482', channel.name, "You're not channel operator")
+            return
+
+        args = list(args)
+        applied = []
+        sign = '+'
+        for char in modes:
+            if char in '+-':
+                sign = char
+            elif char in PREFIXES and args:
+                nick = args.pop(0)
+                if fold(nick) in channel.members:
+                    modes_of = channel.modes[fold(nick)]
+                    if sign == '+':
+                        modes_of.add(char)
+                    else:
+                        modes_of.discard(char)
+                    applied.append((sign, char, nick))
+        if applied:
+            flags = ''
+            last = None
+            for sign, char, _ in applied:
+                flags += char if sign == last else sign + char
+                last = sign
+            channel.broadcast(':{} MODE {} {} {}'.format(
+                client.mask, channel.name, flags, ' '.join(nick for _, _, nick in applied)))
+
+    def on_who(self, client, name, *rest):
+        channel = self.channels.get(fold(name))
+        if channel is not None:
+            for nick, member in channel.members.items():
+                client.reply('352', channel.name, member.user, member.host, SERVER,
+                             member.nick, 'H' + channel.prefix(nick), '0 ' + member.nick)
+        client.reply('315', name, 'End of /WHO list.')
+
+    def on_whois(self, client, nick, *rest):
+        target = self.clients.get(fold(nick))
+        if target is None:
+            client.reply('401', nick, 'No such nick/channel')
+        else:
+            client.reply('311', target.nick, target.user, target.host, '*', target.nick)
+        client.reply('318', nick, 'End of /WHOIS list.')
+
+    # messages
+    def on_privmsg(self, client, target, text=None, *rest, command='PRIVMSG'):
+        if text is None:
+            return
+        line = ':{} {} {} :{}'.format(client.mask, command, target, text)
+        channel = self.channels.get(fold(target))
+        if channel is not None:
+            channel.broadcast(line, exclude=client)
+            return
+        recipient = self.clients.get(fold(target))
+        if recipient is not None:
+            recipient.send(line)
+        elif command == 'PRIVMSG':
+            client.reply('401', target, 'No such nick/channel')
+
+    def on_notice(self, client, target, text=None, *rest):
+        self.on_privmsg(client, target, text, command='NOTICE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6667)
+    options = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(Server(options.host, options.port, loop).start())
+    print('listening on {}:{}'.format(options.host, options.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
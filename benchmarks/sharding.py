@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""Run sharded bots end to end against a stand-in IRC server.
+
+    python benchmarks/sharding.py [--workers 2] [--quiet 4] [--voters 50]
+    python benchmarks/sharding.py --workers 1      # everything on one loop
+
+Starts ``benchmarks/ircserver.py`` in this process, writes a config with a
+``[shard]`` section and an sqlite database, and runs ``shard.py`` on it.
+Once every channel has a bot, a chair starts a motion in ``#busy`` and
+voters flood it with votes, while the chair asks for ``!tally`` in each
+quiet channel every half second and times the reply.
+
+Checks that every channel has exactly one bot, before the flood and after
+it, whatever channels the coordinator moved in between, and reports the
+p50/p99/max ``!tally`` latency in the quiet channels. Run it with
+``--workers 1`` to compare against a single bot.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ircserver  # noqa: E402
+
+BOT = 'Rhythm'
+CHAIR = 'chair'
+CONFIG = """[bot]
+nick = {bot}
+realname = {bot}
+host = 127.0.0.1
+port = {irc_port}
+includes =
+    irc3.plugins.command
+    Rhythm
+autojoins =
+{autojoins}
+name = motionbot
+database = sqlite:///{tmp}/rhythm.db
+
+[irc3.plugins.command]
+cmd = !
+
+[Rhythm]
+archive = {tmp}/meetings.jsonl
+
+[outbound]
+# don't let the bot's own rate limits stand in for its latency
+rate = 1000
+burst = 1000
+target_rate = 1000
+target_burst = 1000
+
+[shard]
+workers = {workers}
+port = {shard_port}
+interval = {interval}
+assignments = {tmp}/shards.json
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(ordered, pc):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pc / 100))]
+
+
+class Client(object):
+    """A user: sends lines, and hands bot notices to whoever's waiting."""
+
+    def __init__(self, nick, port, loop):
+        self.nick = nick
+        self.port = port
+        self.loop = loop
+        # channel -> future for the next notice a bot sends there
+        self.waiting = {}
+
+    @asyncio.coroutine
+    def connect(self):
+        self.reader, self.writer = yield from asyncio.open_connection(
+            '127.0.0.1', self.port, loop=self.loop)
+        self.send('NICK ' + self.nick)
+        self.send('USER {0} 0 * :{0}'.format(self.nick))
+        self.loop.create_task(self.read())
+
+    def send(self, line):
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+
+    @asyncio.coroutine
+    def read(self):
+        while True:
+            line = yield from self.reader.readline()
+            if not line:
+                return
+            parts = line.decode('utf-8', 'replace').split(' ', 3)
+            if len(parts) == 4 and parts[1] == 'NOTICE' and parts[0][1:].startswith(BOT):
+                channel = ircserver.fold(parts[2])
+                future = self.waiting.pop(channel, None)
+                if future is not None and not future.done():
+                    future.set_result(time.perf_counter())
+
+    @asyncio.coroutine
+    def ask(self, channel, timeout):
+        """Send ``!tally`` to a channel; return seconds to the reply, or None."""
+        future = self.waiting[ircserver.fold(channel)] = asyncio.Future(loop=self.loop)
+        started = time.perf_counter()
+        self.send('PRIVMSG {} :!tally'.format(channel))
+        try:
+            answered = yield from asyncio.wait_for(future, timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            return None
+        return answered - started
+
+
+def bots(server, channel):
+    channel = server.channels.get(ircserver.fold(channel))
+    if channel is None:
+        return []
+    return sorted(client.nick for client in channel.members.values()
+                  if client.nick.startswith(BOT))
+
+
+def check(server, channels):
+    """Return the channels which haven't got exactly one bot."""
+    wrong = {}
+    for channel in channels:
+        present = bots(server, channel)
+        if len(present) != 1:
+            wrong[channel] = present
+    return wrong
+
+
+@asyncio.coroutine
+def settle(server, channels, timeout, loop):
+    deadline = time.monotonic() + timeout
+    while check(server, channels) and time.monotonic() < deadline:
+        yield from asyncio.sleep(0.2, loop=loop)
+    return check(server, channels)
+
+
+@asyncio.coroutine
+def flood(voters, rate, duration, loop):
+    """Have voters change their votes in #busy at ``rate`` lines a second."""
+    votes = itertools.cycle(('aye', 'nay', 'abstain'))
+    turns = itertools.cycle(voters)
+    deadline = loop.time() + duration
+    sent = 0
+    started = loop.time()
+    while loop.time() < deadline:
+        due = int((loop.time() - started) * rate)
+        for voter in itertools.islice(turns, due - sent):
+            voter.send('PRIVMSG #busy :' + next(votes))
+        sent = due
+        yield from asyncio.sleep(0.01, loop=loop)
+    return sent
+
+
+@asyncio.coroutine
+def probe(chair, channels, duration, loop):
+    """Ask for ``!tally`` in each quiet channel every half second."""
+    latencies = []
+    timeouts = 0
+    deadline = loop.time() + duration
+    while loop.time() < deadline:
+        results = yield from asyncio.gather(
+            *[chair.ask(channel, 5) for channel in channels], loop=loop)
+        latencies.extend(r for r in results if r is not None)
+        timeouts += sum(1 for r in results if r is None)
+        yield from asyncio.sleep(0.5, loop=loop)
+    return sorted(latencies), timeouts
+
+
+@asyncio.coroutine
+def run(options, tmp, loop):
+    server = yield from ircserver.Server(port=0, loop=loop).start()
+    quiet = ['#quiet{}'.format(i) for i in range(options.quiet)]
+    channels = ['#busy'] + quiet
+
+    # the chair gets there first, so it's an op everywhere
+    chair = Client(CHAIR, server.port, loop)
+    yield from chair.connect()
+    chair.send('JOIN ' + ','.join(channels))
+
+    path = os.path.join(tmp, 'config.ini')
+    with open(path, 'w', encoding='utf-8') as fd:
+        fd.write(CONFIG.format(
+            bot=BOT, irc_port=server.port, tmp=tmp, workers=options.workers,
+            shard_port=free_port(), interval=options.interval,
+            autojoins='\n'.join('    ' + c.lstrip('#') for c in channels)))
+    log = open(os.path.join(tmp, 'shard.log'), 'w')
+    coordinator = subprocess.Popen([sys.executable, 'shard.py', path], cwd=ROOT,
+                                   stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wrong = yield from settle(server, channels, 60, loop)
+        if wrong:
+            print('channels without exactly one bot: {}'.format(wrong))
+            return 1
+        print('placed: ' + ', '.join('{} {}'.format(c, bots(server, c)[0]) for c in channels))
+
+        voters = [Client('voter{}'.format(i), server.port, loop)
+                  for i in range(options.voters)]
+        for voter in voters:
+            yield from voter.connect()
+            voter.send('JOIN #busy')
+        yield from asyncio.sleep(1, loop=loop)
+        nicks = [voter.nick for voter in voters]
+        for i in range(0, len(nicks), 4):
+            chair.send('MODE #busy +{} {}'.format('v' * len(nicks[i:i + 4]),
+                                                  ' '.join(nicks[i:i + 4])))
+        for line in ('!start meeting', '!motion we adopt the budget', '!start motion'):
+            chair.send('PRIVMSG #busy :' + line)
+        yield from asyncio.sleep(1, loop=loop)
+
+        sent, (latencies, timeouts) = yield from asyncio.gather(
+            flood(voters, options.rate, options.duration, loop),
+            probe(chair, quiet, options.duration, loop), loop=loop)
+
+        # let any move in flight finish before checking again
+        wrong = yield from settle(server, channels, options.interval * 2, loop)
+        with open(os.path.join(tmp, 'shards.json'), encoding='utf-8') as fd:
+            assignment = json.load(fd)
+
+        print('workers: {}; votes sent: {:,} in {}s'.format(
+            options.workers, sent, options.duration))
+        print('assignment afterwards: {}'.format(json.dumps(assignment, sort_keys=True)))
+        if latencies:
+            print('!tally in quiet channels: p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms '
+                  '({} replies, {} timed out)'.format(
+                      percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3,
+                      latencies[-1] * 1e3, len(latencies), timeouts))
+        else:
+            print('!tally in quiet channels: no replies ({} timed out)'.format(timeouts))
+        if wrong:
+            print('channels without exactly one bot: {}'.format(wrong))
+            return 1
+        return 0
+    finally:
+        coordinator.send_signal(signal.SIGINT)
+        coordinator.wait()
+        log.close()
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--quiet', type=int, default=4, help='quiet channels')
+    parser.add_argument('--voters', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=2000, help='votes per second in #busy')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of flooding')
+    parser.add_argument('--interval', type=float, default=2,
+                        help="the coordinator's rebalancing interval")
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the config, database and coordinator's log")
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='rhythm-shard-')
+    loop = asyncio.get_event_loop()
+    try:
+        return loop.run_until_complete(run(options, tmp, loop))
+    finally:
+        if options.keep:
+            print('files kept in ' + tmp)
+        else:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Compare the __slots__ channel state with the old nested dicts.
+
+    python benchmarks/state.py [--channels 10000] [--voters 1000]
+
+Prints the memory held by every channel's state and the time taken by the
+lookups Motions makes for each message and vote. The vote and count passes
+only go over the first 100 channels.
+"""
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import state  # noqa: E402
+from votematch import AYE, NAY, ABSTAIN  # noqa: E402
+
+LEGACY_VOTES = (True, False, None)
+VOTES = (AYE, NAY, ABSTAIN)
+
+
+def legacy_state():
+    """A channel's state before the __slots__ classes, as join_chan made it."""
+    return {
+        'recognised': [],
+        'meeting': {
+            'name': '',
+            'started': True,
+            'quorum': 0,
+        },
+        'motion': {
+            'text': '',
+            'put_by': '',
+            'started': True,
+            'votes': {},
+        },
+    }
+
+
+def legacy_populate(channels, voters):
+    states = {}
+    for c in range(channels):
+        channel_state = states['#channel{}'.format(c)] = legacy_state()
+        votes = channel_state['motion']['votes']
+        for i, nick in enumerate(voters):
+            votes[nick] = LEGACY_VOTES[i % 3]
+    return states
+
+
+def populate(channels, voters):
+    states = {}
+    for c in range(channels):
+        channel_state = states['#channel{}'.format(c)] = state.ChannelState()
+        channel_state.meeting.started = channel_state.motion.started = True
+        cast = channel_state.motion.tally.cast
+        for i, nick in enumerate(voters):
+            cast(nick, VOTES[i % 3])
+    return states
+
+
+def memory(func, *args):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func(*args)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def legacy_operations(states, targets, sample, voters):
+    def chatter():
+        # every channel message checks for a running motion
+        for target in targets:
+            states[target]['motion']['started']
+
+    def vote():
+        # what aye_nay_abstain did for each vote
+        for target in sample:
+            for nick in voters:
+                states[target]['motion']['votes'][nick] = True
+
+    def count():
+        # there were no running counts; !stop went over the votes
+        for target in sample:
+            votes = states[target]['motion']['votes'].values()
+            sum(1 for vote in votes if vote is True), sum(1 for vote in votes if vote is False)
+
+    return (('chatter', chatter), ('vote', vote), ('count', count))
+
+
+def operations(states, targets, sample, voters):
+    def chatter():
+        for target in targets:
+            states[target].motion.started
+
+    def vote():
+        for target in sample:
+            for nick in voters:
+                states[target].motion.tally.cast(nick, AYE)
+
+    def count():
+        for target in sample:
+            tally = states[target].motion.tally
+            tally.count(AYE), tally.count(NAY)
+
+    return (('chatter', chatter), ('vote', vote), ('count', count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=10000)
+    parser.add_argument('--voters', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    options = parser.parse_args()
+
+    voters = ['user{}'.format(i) for i in range(options.voters)]
+
+    for name, build, ops in (('nested dicts', legacy_populate, legacy_operations),
+                             ('ChannelState', populate, operations)):
+        print('{} ({} channels, {} voters each)'.format(
+            name, options.channels, options.voters))
+        print('  {:16} {:>14,} bytes'.format(
+            'memory, no votes', memory(build, options.channels, [])))
+        print('  {:16} {:>14,} bytes'.format(
+            'memory, voted', memory(build, options.channels, voters)))
+
+        states = build(options.channels, voters)
+        targets = list(states)
+        sample = targets[:100]
+        for op, func in ops(states, targets, sample, voters):
+            best = min(timeit.repeat(func, number=1, repeat=options.repeat))
+            if op == 'chatter':
+                per = len(targets)
+            elif op == 'vote':
+                per = len(sample) * len(voters)
+            else:
+                per = len(sample)
+            print('  {:16} {:>14.1f} ns/op'.format(op, best / per * 1e9))
+        del states
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""Drive the bot's plugins with synthetic IRC traffic.
+
+    python benchmarks/traffic.py [--users 2000] [--channels 20]
+    python benchmarks/traffic.py --compare benchmarks/baseline.json
+    python benchmarks/traffic.py --save benchmarks/baseline.json
+
+Each scenario feeds raw server lines to an ``irc3.testing.IrcBot`` running
+the real command, Rhythm, mappinguserlist and casemapping plugins, and
+reports lines handled per second, the p50/p99 time to handle one line and
+the peak RSS, each the best of ``--repeat`` runs.
+Scenarios run in their own process so their peak RSS is their own.
+
+``--save`` writes the results as a baseline; ``--compare`` checks them
+against one and exits non-zero if any scenario got slower, or bigger, by
+more than ``--tolerance``. benchmarks/baseline.json is the baseline for the
+default settings, with the Python and machine it was taken on; timings
+only compare on similar hardware, so take a fresh one with ``--save``
+before comparing elsewhere, and commit it when a change is meant to move
+the numbers.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BOT = 'motionbot'
+OP = 'chair'
+WORDS = ('the', 'motion', 'seems', 'fine', 'but', 'I', 'would', 'like', 'to',
+         'hear', 'more', 'about', 'budget', 'before', 'we', 'vote', 'on', 'it')
+VOTES = ('aye', 'nay', 'abstain', 'Aye', 'yes', 'no')
+
+
+def channel_names(options):
+    return ['#channel{}'.format(c) for c in range(options.channels)]
+
+
+def nicks(options):
+    return ['user{}'.format(i) for i in range(options.users)]
+
+
+def mask(nick):
+    return '{0}!{0}@{0}.example.org'.format(nick)
+
+
+def welcome():
+    """What a server says before any channel traffic."""
+    yield ':irc.example.org 001 {} :Welcome'.format(BOT)
+    yield (':irc.example.org 005 {} PREFIX=(qaohv)~&@%+ CHANTYPES=# '
+           'CHANMODES=beI,k,l,imnpst MODES=4 CASEMAPPING=rfc1459 '
+           ':are supported by this server').format(BOT)
+
+
+def bot_joins(channels, members=(), modes=''):
+    """The bot joining each channel, and the names it's sent there."""
+    for channel in channels:
+        yield ':{} JOIN {}'.format(mask(BOT), channel)
+        names = ['@' + OP, '@' + BOT] + [modes + nick for nick in members]
+        # servers split NAMES replies to fit the line length
+        for i in range(0, len(names), 50):
+            yield ':irc.example.org 353 {} = {} :{}'.format(
+                BOT, channel, ' '.join(names[i:i + 50]))
+        yield ':irc.example.org 366 {} {} :End of /NAMES list.'.format(BOT, channel)
+
+
+def start_motion(channels):
+    for channel in channels:
+        for command in ('!start meeting', '!motion we adopt the budget', '!start motion'):
+            yield ':{} PRIVMSG {} :{}'.format(mask(OP), channel, command)
+
+
+# scenarios: each returns (setup lines, timed lines)
+def join_storm(options):
+    channels = channel_names(options)
+    setup = list(bot_joins(channels))
+    lines = [':{} JOIN {}'.format(mask(nick), channel)
+             for nick in nicks(options) for channel in channels]
+    return setup, lines
+
+
+def netsplit(options):
+    channels = channel_names(options)
+    setup = list(bot_joins(channels, nicks(options)))
+    lines = [':{} QUIT :*.net *.split'.format(mask(nick)) for nick in nicks(options)]
+    return setup, lines
+
+
+def nick_burst(options):
+    channels = channel_names(options)
+    setup = list(bot_joins(channels, nicks(options)))
+    lines = [':{} NICK {}_'.format(mask(nick), nick) for nick in nicks(options)]
+    lines += [':{} NICK {}'.format(mask(nick + '_'), nick) for nick in nicks(options)]
+    return setup, lines
+
+
+def chatter(options):
+    channels = channel_names(options)
+    setup = list(bot_joins(channels, nicks(options), '+'))
+    setup += list(start_motion(channels))
+    lines = []
+    for i, nick in enumerate(nicks(options)):
+        for c, channel in enumerate(channels):
+            text = ' '.join(WORDS[(i + c) % len(WORDS):] + WORDS[:(i + c) % len(WORDS)])
+            lines.append(':{} PRIVMSG {} :{}'.format(mask(nick), channel, text))
+    return setup, lines
+
+
+def mass_vote(options):
+    channels = channel_names(options)
+    setup = list(bot_joins(channels, nicks(options), '+'))
+    setup += list(start_motion(channels))
+    lines = []
+    for i, nick in enumerate(nicks(options)):
+        for channel in channels:
+            lines.append(':{} PRIVMSG {} :{}'.format(
+                mask(nick), channel, VOTES[i % len(VOTES)]))
+    return setup, lines
+
+
+SCENARIOS = (
+    ('join_storm', join_storm),
+    ('netsplit', netsplit),
+    ('nick_burst', nick_burst),
+    ('chatter', chatter),
+    ('mass_vote', mass_vote),
+)
+
+
+def percentile(ordered, pc):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pc / 100))]
+
+
+def run_scenario(name, options):
+    """Run one scenario in this process and return its results."""
+    from irc3.testing import IrcBot
+    import Rhythm
+
+    setup, lines = dict(SCENARIOS)[name](options)
+    # every user votes once in every channel at once; that's voting, not a
+    # flood, so it shouldn't run into the per-nick vote rate limit
+    bot = IrcBot(nick=BOT, includes=['irc3.plugins.command', 'Rhythm'],
+                 Rhythm={'vote_burst': str(options.channels)})
+    for line in welcome():
+        bot.dispatch(line)
+    for line in setup:
+        bot.dispatch(line)
+
+    # without its motions running, a scenario only times the early return
+    # for a channel with none
+    states = bot.get_plugin(Rhythm.Motions).states
+    for line in setup:
+        if line.endswith(' :!start motion'):
+            channel = bot.casefold(line.split()[2])
+            if not states[channel].motion.started:
+                raise RuntimeError('{}: no motion started in {}'.format(name, channel))
+
+    # the testing bot runs handlers inline, so each dispatch is one line's work
+    dispatch = bot.dispatch
+    clock = time.perf_counter
+    latencies = []
+    started = clock()
+    for line in lines:
+        before = clock()
+        dispatch(line)
+        latencies.append(clock() - before)
+    elapsed = clock() - started
+
+    latencies.sort()
+    return {
+        'lines': len(lines),
+        'lines_per_sec': len(lines) / elapsed,
+        'p50_us': percentile(latencies, 50) * 1e6,
+        'p99_us': percentile(latencies, 99) * 1e6,
+        # kilobytes on linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_isolated(name, options):
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--run', name,
+        '--users', str(options.users), '--channels', str(options.channels),
+    ])
+    return json.loads(output.decode('utf-8'))
+
+
+def best_of(runs):
+    """Each measure at its best across ``runs``, to leave out noise from elsewhere."""
+    best = dict(runs[0])
+    for run in runs[1:]:
+        best['lines_per_sec'] = max(best['lines_per_sec'], run['lines_per_sec'])
+        for key in ('p50_us', 'p99_us', 'peak_rss_kb'):
+            best[key] = min(best[key], run[key])
+    return best
+
+
+def compare(results, baseline, tolerance):
+    """Return a description of every result worse than the baseline allows."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['lines_per_sec'] < base['lines_per_sec'] * (1 - tolerance):
+            regressions.append('{}: {:,.0f} lines/s, was {:,.0f}'.format(
+                name, result['lines_per_sec'], base['lines_per_sec']))
+        for key, unit in (('p99_us', 'us p99'), ('peak_rss_kb', 'KB peak RSS')):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append('{}: {:,.0f} {}, was {:,.0f}'.format(
+                    name, result[key], unit, base[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--scenario', action='append', choices=dict(SCENARIOS),
+                        help='run only this scenario; may be repeated')
+    parser.add_argument('--save', metavar='FILE', help='write results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='check results against a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown before --compare fails (default 0.2)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each scenario, keeping the best (default 3)')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.run:
+        print(json.dumps(run_scenario(options.run, options)))
+        return 0
+
+    results = {}
+    print('{:12} {:>9} {:>14} {:>10} {:>10} {:>12}'.format(
+        'scenario', 'lines', 'lines/s', 'p50 us', 'p99 us', 'peak RSS KB'))
+    for name, _ in SCENARIOS:
+        if options.scenario and name not in options.scenario:
+            continue
+        result = results[name] = best_of(
+            [run_isolated(name, options) for _ in range(options.repeat)])
+        print('{:12} {lines:>9,} {lines_per_sec:>14,.0f} {p50_us:>10.1f} '
+              '{p99_us:>10.1f} {peak_rss_kb:>12,}'.format(name, **result))
+
+    settings = {'users': options.users, 'channels': options.channels}
+    environment = {'python': platform.python_version(), 'machine': platform.machine(),
+                   'cpus': os.cpu_count()}
+    if options.save:
+        with open(options.save, 'w') as fd:
+            json.dump({'settings': settings, 'environment': environment, 'results': results},
+                      fd, indent=2, sort_keys=True)
+            fd.write('\n')
+
+    if options.compare:
+        with open(options.compare) as fd:
+            baseline = json.load(fd)
+        if baseline['settings'] != settings:
+            print('baseline was taken with {}, not {}'.format(baseline['settings'], settings))
+            return 2
+        if baseline.get('environment', environment) != environment:
+            print('baseline was taken on {}, not {}'.format(baseline['environment'], environment))
+        regressions = compare(results, baseline['results'], options.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Compare the old and new vote recognition on mixed channel chatter.
+
+    python benchmarks/votes.py [--messages 10000] [--votes 0.05]
+
+Each run replays the same generated messages with a motion running and with
+no motion running, and prints messages per second for both paths.
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import votematch  # noqa: E402
+
+WORDS = ('the', 'motion', 'is', 'fine', 'but', 'I', 'think', 'we', 'should', 'amend',
+         'clause', 'three', 'first', 'a', 'point', 'of', 'order', 'chair', 'please')
+VOTES = ('aye', 'Aye', 'AYE', 'nay', 'abstain', 'yes', '+1', 'no')
+
+
+def chatter(count, vote_ratio, seed=0):
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        if rng.random() < vote_ratio:
+            messages.append(rng.choice(VOTES))
+        else:
+            length = rng.randint(1, 30)
+            messages.append(' '.join(rng.choice(WORDS) for _ in range(length)))
+    # a few of the nasty cases
+    messages[:3] = ['', ' ', 'ayes']
+    return messages
+
+
+def old_path(messages, started):
+    # the pre-matcher code: fold and split first, check the motion after
+    matched = 0
+    for data in messages:
+        try:
+            cmd = data.casefold().split()[0]
+        except IndexError:
+            continue
+        if not started or cmd not in ('aye', 'nay', 'abstain'):
+            continue
+        matched += 1
+    return matched
+
+
+def new_path(messages, started, matcher):
+    matched = 0
+    match = matcher.match
+    for data in messages:
+        if not started:
+            continue
+        if match(data) is None:
+            continue
+        matched += 1
+    return matched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--votes', type=float, default=0.05,
+                        help='fraction of messages which are votes')
+    parser.add_argument('--repeat', type=int, default=5)
+    options = parser.parse_args()
+
+    messages = chatter(options.messages, options.votes)
+    matcher = votematch.VoteMatcher({
+        votematch.AYE: ('aye', 'yes', '+1'),
+        votematch.NAY: ('nay', 'no'),
+        votematch.ABSTAIN: ('abstain',),
+    })
+
+    for started in (True, False):
+        print('motion running: {}'.format(started))
+        for name, func in (('old', lambda: old_path(messages, started)),
+                           ('new', lambda: new_path(messages, started, matcher))):
+            best = min(timeit.repeat(func, number=1, repeat=options.repeat))
+            print('  {:4} {:>12,.0f} msgs/s'.format(name, len(messages) / best))
+
+
+if __name__ == '__main__':
+    main()
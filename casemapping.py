@@ -1,23 +1,73 @@
 # -*- coding: utf-8 -*-
-import functools
+"""Casefolding with the server's CASEMAPPING.
+
+``bot.casefold(name)`` returns a :class:`Folded` string: the folded form,
+which is what every plugin keys nicks and channels by, carrying the name as
+it was written in ``display``. Results are cached, so folding a name that's
+been seen before is a single dict lookup, and folding an already folded name
+returns it as is.
+"""
 import string
 
-from irc3 import event
 import irc3
 
+# forget every cached name once there are this many; most are seen again soon
+CACHE_SIZE = 50000
+
+
+class Folded(str):
+    """A casefolded nick or channel name, remembering how it was written.
+
+    .. code-block:: python
+
+        >>> name = Folded('nick{', 'Nick[')
+        >>> name == 'nick{', name.display
+        (True, 'Nick[')
+    """
+
+    def __new__(cls, folded, display):
+        self = str.__new__(cls, folded)
+        self.display = display
+        return self
+
+
+def display(name):
+    """Return the name as it was written, if it's a :class:`Folded`."""
+    return getattr(name, 'display', name)
+
+
+class FoldCache(dict):
+    """Maps names as written to their :class:`Folded` form, folding on a miss."""
+
+    def __init__(self, trans):
+        dict.__init__(self)
+        self.trans = trans
+
+    def __missing__(self, name):
+        if len(self) >= CACHE_SIZE:
+            self.clear()
+        if isinstance(name, Folded):
+            # already folded; it hashes and compares as its folded form
+            folded = name
+        else:
+            folded = Folded(name.translate(self.trans), name)
+        self[name] = folded
+        return folded
+
 
 @irc3.plugin
 class Casemapping(object):
 
     def __init__(self, bot):
         self.bot = bot
+        self.bot.include('isupport')
+        self.cache = None
         self.recalculate_casemaps()
-        self.bot.casefold = functools.partial(self.casefold)
+        self.bot.isupport.subscribe(self.recalculate_casemaps)
 
     # casemapping
-    @event(r'^:\S+ 005 \S+ .+CASEMAPPING.*')
     def recalculate_casemaps(self):
-        casemapping = self.bot.config['server_config'].get('CASEMAPPING', 'rfc1459')
+        casemapping = self.bot.isupport.casemapping
 
         if casemapping == 'rfc1459':
             lower_chars = string.ascii_lowercase + ''.join(chr(i) for i in range(123, 127))
@@ -33,6 +83,11 @@ class Casemapping(object):
 
         self._lower_trans = str.maketrans(upper_chars, lower_chars)
 
+        # names folded under the old mapping may fold differently now
+        self.cache = FoldCache(self._lower_trans)
+        # a bare dict lookup when the name is cached; no wrapper in between
+        self.bot.casefold = self.cache.__getitem__
+
     def casefold(self, in_str):
         """Casefold the given string, with the current server's casemapping."""
-        return in_str.translate(self._lower_trans)
+        return self.cache[in_str]
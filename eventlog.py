@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Structured JSON logging for the bot's plugins.
+
+Plugins log named events with keyword fields::
+
+    log = eventlog.EventLogger('rhythm.motions')
+    log.info('motion_started', channel=channel, text=text)
+
+Nothing is built or serialised unless the record will be written: the level
+check, the event filter and the sampler all run before a log record exists,
+and field values which are callables are only called by the formatter.
+
+Configure it from the ``[eventlog]`` section of the bot config::
+
+    [eventlog]
+    level = INFO
+    # only log these events; leave unset to log everything
+    events = motion_started motion_stopped vote
+    # log only one in every N of these events
+    sample = vote=10 PRIVMSG=100
+    # write here instead of stderr
+    file = rhythm.log
+"""
+import json
+import logging
+
+from irc3 import event
+import irc3
+
+
+class EventFilter(object):
+    """Decides which events are logged, sampling high-volume ones."""
+
+    def __init__(self, events=None, sample=None):
+        self.events = set(events) if events else None
+        self.sample = dict(sample or {})
+        self._counts = dict.fromkeys(self.sample, 0)
+
+    def accept(self, name):
+        if self.events is not None and name not in self.events:
+            return False
+
+        rate = self.sample.get(name)
+        if rate is None:
+            return True
+        if rate <= 0:
+            return False
+
+        # keep the first of every ``rate`` events
+        count = self._counts[name]
+        self._counts[name] = (count + 1) % rate
+        return count == 0
+
+    @classmethod
+    def from_config(cls, config):
+        events = config.get('events', '').split() or None
+        sample = {}
+        for item in config.get('sample', '').split():
+            name, _, rate = item.partition('=')
+            sample[name] = int(rate)
+        return cls(events=events, sample=sample)
+
+
+# shared by every EventLogger; replaced when the plugin reads its config
+event_filter = EventFilter()
+
+
+class JSONFormatter(logging.Formatter):
+    """Serialise a record's event and fields as one line of JSON."""
+
+    def format(self, record):
+        doc = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.msg,
+        }
+        for key, value in getattr(record, 'fields', {}).items():
+            if callable(value):
+                value = value()
+            doc[key] = value
+        if record.exc_info:
+            doc['exc'] = self.formatException(record.exc_info)
+        return json.dumps(doc, default=str, sort_keys=True)
+
+
+class EventLogger(object):
+    """Logs named events with structured fields."""
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    def log(self, level, event, **fields):
+        if self.logger.isEnabledFor(level) and event_filter.accept(event):
+            self.logger.log(level, event, extra={'fields': fields})
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+
+@irc3.plugin
+class EventLog(object):
+    """Sets up the ``rhythm`` loggers from the bot config."""
+
+    def __init__(self, bot):
+        global event_filter
+
+        self.bot = bot
+        config = bot.config.get('eventlog', {})
+
+        if config.get('file'):
+            handler = logging.FileHandler(config['file'])
+        else:
+            handler = logging.StreamHandler()
+        handler.setFormatter(JSONFormatter())
+
+        logger = logging.getLogger('rhythm')
+        logger.handlers = [handler]
+        logger.propagate = False
+        logger.setLevel(config.get('level', 'INFO').upper())
+
+        event_filter = EventFilter.from_config(config)
+        self.log = EventLogger('rhythm.irc')
+
+        # raw traffic is only worth a handler when it can actually be logged
+        if self.log.logger.isEnabledFor(logging.DEBUG):
+            bot.attach_events(event(r'^(:(?P<prefix>\S+) )?(?P<type>\S+) (?P<data>.*)',
+                                    callback=self.raw))
+
+    def raw(self, prefix=None, type=None, data=None):
+        self.log.debug(type, prefix=prefix, data=data)
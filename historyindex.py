@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""Indexed search over past motions and votes.
+
+The archive is a plain log, which suits writing minutes but means answering
+"how did alice vote on budget motions last year" would read every meeting
+ever held. :class:`HistoryIndex` keeps an SQLite index beside it: motions
+with a full-text index on their text, and votes indexed by voter, channel
+and date. It catches up with the archive by reading only the lines added
+since it last looked.
+
+Search from the command line::
+
+    python historyindex.py meetings.jsonl search budget --since 365d
+    python historyindex.py meetings.jsonl voted alice budget --page 2
+    python historyindex.py meetings.jsonl voted alice --all
+
+Results are read from the database a row at a time, a page at a time, so a
+large archive is never loaded into memory.
+"""
+import argparse
+import calendar
+import json
+import os
+import sqlite3
+import sys
+import time
+
+PAGE_SIZE = 20
+
+# lines of the archive indexed per transaction
+BATCH = 1000
+
+# archived voters are casefolded with the server's mapping; rfc1459 is the
+# usual one, and what the command line folds nicks with
+RFC1459 = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~',
+                        'abcdefghijklmnopqrstuvwxyz{}|^')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS progress ('
+    '  archive TEXT PRIMARY KEY,'
+    '  offset INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS motions ('
+    '  id INTEGER PRIMARY KEY,'
+    '  meeting TEXT, channel TEXT, ts REAL, text TEXT, put_by TEXT,'
+    '  result TEXT, ayes INTEGER, nays INTEGER, abstains INTEGER)',
+    'CREATE INDEX IF NOT EXISTS motions_channel ON motions (channel, ts)',
+    'CREATE INDEX IF NOT EXISTS motions_ts ON motions (ts)',
+    'CREATE VIRTUAL TABLE IF NOT EXISTS motion_text USING fts4 (text)',
+    # channel and ts are copied from the motion so voter queries by date or
+    # channel are answered from this table's index alone
+    'CREATE TABLE IF NOT EXISTS votes ('
+    '  motion INTEGER NOT NULL, voter TEXT NOT NULL, choice TEXT NOT NULL,'
+    '  ballot INTEGER NOT NULL, channel TEXT, ts REAL)',
+    'CREATE INDEX IF NOT EXISTS votes_voter ON votes (voter, ts)',
+    'CREATE INDEX IF NOT EXISTS votes_channel ON votes (channel, voter, ts)',
+)
+
+
+def fold(nick):
+    return nick.translate(RFC1459)
+
+
+def parse_since(value):
+    """Turn ``YYYY-MM-DD`` or ``<n>d`` (days ago) into a timestamp."""
+    if value.endswith('d') and value[:-1].isdigit():
+        return time.time() - int(value[:-1]) * 86400
+    try:
+        return calendar.timegm(time.strptime(value, '%Y-%m-%d'))
+    except ValueError:
+        raise ValueError('dates look like 2024-06-30, or 30d for 30 days ago')
+
+
+def match_query(words):
+    """Quote each word, so the search is for all of them and never a syntax error."""
+    # there's no escaping a quote inside one; it's punctuation to the tokenizer anyway
+    return ' '.join('"{}"'.format(word.replace('"', ' ')) for word in words)
+
+
+class HistoryIndex(object):
+    """An SQLite index of an archive's motions and votes. Blocking."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            with self._conn:
+                for statement in SCHEMA:
+                    self._conn.execute(statement)
+        return self._conn
+
+    def update(self, archive):
+        """Index the motions added to ``archive`` since the last update.
+
+        Returns how many were added.
+        """
+        key = os.path.abspath(archive)
+        row = self.conn.execute('SELECT offset FROM progress WHERE archive = ?',
+                                (key,)).fetchone()
+        offset = row[0] if row else 0
+        try:
+            size = os.path.getsize(archive)
+        except FileNotFoundError:
+            return 0
+        if size < offset:
+            # the archive was replaced; start over
+            self.clear()
+            offset = 0
+
+        added = 0
+        with open(archive, 'rb') as fd:
+            fd.seek(offset)
+            while True:
+                lines = []
+                for line in fd:
+                    # a line still being written; pick it up next time
+                    if not line.endswith(b'\n'):
+                        break
+                    lines.append(line)
+                    if len(lines) >= BATCH:
+                        break
+                if not lines:
+                    break
+                with self.conn:
+                    for line in lines:
+                        try:
+                            record = json.loads(line.decode('utf-8'))
+                        except ValueError:
+                            # blank, or mangled; either way there's no motion in it
+                            continue
+                        added += self._add(record)
+                    offset += sum(len(line) for line in lines)
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO progress (archive, offset) VALUES (?, ?)',
+                        (key, offset))
+        return added
+
+    def _add(self, record):
+        if record.get('kind') != 'motion':
+            return 0
+        cursor = self.conn.execute(
+            'INSERT INTO motions (meeting, channel, ts, text, put_by, result, ayes, nays,'
+            ' abstains) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (record.get('meeting'), record.get('channel'), record['ts'], record['text'],
+             record.get('put_by'), record.get('result'), record.get('ayes'),
+             record.get('nays'), record.get('abstains')))
+        motion = cursor.lastrowid
+        self.conn.execute('INSERT INTO motion_text (docid, text) VALUES (?, ?)',
+                          (motion, record['text']))
+        rows = []
+        for key, ballot in (('votes', 0), ('ballots', 1)):
+            for voter, choice in (record.get(key) or {}).items():
+                rows.append((motion, voter, choice, ballot, record.get('channel'), record['ts']))
+        self.conn.executemany(
+            'INSERT INTO votes (motion, voter, choice, ballot, channel, ts)'
+            ' VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return 1
+
+    def clear(self):
+        with self.conn:
+            for table in ('progress', 'motions', 'motion_text', 'votes'):
+                self.conn.execute('DELETE FROM ' + table)
+
+    def _filters(self, motion, table, words, channel, since, until):
+        """Build the conditions both queries take, given the motion id column."""
+        clauses = []
+        params = []
+        if words:
+            clauses.append(motion + ' IN (SELECT docid FROM motion_text'
+                           ' WHERE motion_text MATCH ?)')
+            params.append(match_query(words))
+        if channel:
+            clauses.append(table + '.channel = ?')
+            params.append(channel)
+        if since is not None:
+            clauses.append(table + '.ts >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append(table + '.ts < ?')
+            params.append(until)
+        return clauses, params
+
+    def search(self, words=(), channel=None, since=None, until=None,
+               limit=PAGE_SIZE, offset=0):
+        """Yield motions, newest first, whose text has all of ``words``.
+
+        A ``limit`` of None yields every match.
+        """
+        clauses, params = self._filters('motions.id', 'motions', words, channel, since, until)
+        query = ('SELECT id, meeting, channel, ts, text, put_by, result, ayes, nays, abstains'
+                 ' FROM motions' + (' WHERE ' + ' AND '.join(clauses) if clauses else '') +
+                 ' ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?')
+        cursor = self.conn.execute(query, params + [-1 if limit is None else limit, offset])
+        columns = [column[0] for column in cursor.description]
+        for row in cursor:
+            yield dict(zip(columns, row))
+
+    def voted(self, voter, words=(), channel=None, since=None, until=None,
+              limit=PAGE_SIZE, offset=0):
+        """Yield ``voter``'s votes, newest first, with the motions they were on.
+
+        ``voter`` must be casefolded, as the archive's voters are.
+        """
+        clauses, params = self._filters('votes.motion', 'votes', words, channel, since, until)
+        query = ('SELECT votes.choice, votes.ballot, motions.id, motions.meeting,'
+                 ' motions.channel, motions.ts, motions.text, motions.result'
+                 ' FROM votes JOIN motions ON motions.id = votes.motion'
+                 ' WHERE ' + ' AND '.join(['votes.voter = ?'] + clauses) +
+                 ' ORDER BY votes.ts DESC, votes.motion DESC LIMIT ? OFFSET ?')
+        cursor = self.conn.execute(
+            query, [voter] + params + [-1 if limit is None else limit, offset])
+        columns = ('choice', 'ballot', 'id', 'meeting', 'channel', 'ts', 'text', 'result')
+        for row in cursor:
+            yield dict(zip(columns, row))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def _when(ts):
+    return time.strftime('%Y-%m-%d', time.gmtime(ts))
+
+
+def format_motion(motion):
+    return '{} {}: {} ({}; {} ayes, {} nays, {} abstains)'.format(
+        _when(motion['ts']), motion['channel'], motion['text'], motion['result'],
+        motion['ayes'], motion['nays'], motion['abstains'])
+
+
+def format_vote(vote):
+    return '{} {}: {}{} on "{}" ({})'.format(
+        _when(vote['ts']), vote['channel'], vote['choice'],
+        ' by ballot' if vote['ballot'] else '', vote['text'], vote['result'])
+
+
+def main(argv=None):
+    # options shared by both commands, which may come after them
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--index', help='index file (default: <archive>.index)')
+    common.add_argument('--channel')
+    common.add_argument('--since', type=parse_since, help='YYYY-MM-DD, or 30d for 30 days ago')
+    common.add_argument('--until', type=parse_since)
+    common.add_argument('--page', type=int, default=1)
+    common.add_argument('--per-page', type=int, default=PAGE_SIZE)
+    common.add_argument('--all', action='store_true', help='print every result')
+
+    parser = argparse.ArgumentParser(description='Search past motions and votes.')
+    parser.add_argument('archive')
+    commands = parser.add_subparsers(dest='command')
+    search = commands.add_parser('search', parents=[common],
+                                 help='motions whose text has all the words')
+    search.add_argument('words', nargs='*')
+    voted = commands.add_parser('voted', parents=[common],
+                                help="a voter's votes, on motions with the words")
+    voted.add_argument('nick')
+    voted.add_argument('words', nargs='*')
+    options = parser.parse_args(argv)
+    if options.command is None:
+        parser.error('give a command: search or voted')
+
+    index = HistoryIndex(options.index or options.archive + '.index')
+    index.update(options.archive)
+
+    page = {
+        'channel': options.channel,
+        'since': options.since,
+        'until': options.until,
+        'limit': None if options.all else options.per_page,
+        'offset': 0 if options.all else (options.page - 1) * options.per_page,
+    }
+    if options.command == 'search':
+        results = map(format_motion, index.search(options.words, **page))
+    else:
+        results = map(format_vote, index.voted(fold(options.nick), options.words, **page))
+    for line in results:
+        print(line)
+    index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
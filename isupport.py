@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Lookup tables derived from the server's ISUPPORT (005) tokens.
+
+The tables are rebuilt whenever a 005 line arrives and are then shared by
+every plugin through ``bot.isupport``, instead of each plugin re-parsing
+``server_config`` on every call.
+"""
+from irc3 import event
+import irc3
+
+from mappinguserlist import mode_mask
+
+
+@irc3.plugin
+class ISupport(object):
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.listeners = []
+        self.recalculate()
+        self.bot.isupport = self
+
+    def subscribe(self, callback):
+        """Call ``callback()`` after the tables have been rebuilt."""
+        self.listeners.append(callback)
+
+    def connection_made(self, client=None):
+        # irc3 resets server_config to its defaults on each connection
+        self.recalculate()
+
+    @event(r'^:\S+ 005 \S+ .+')
+    def recalculate(self):
+        config = self.bot.config['server_config']
+
+        # PREFIX=(qaohv)~&@%+
+        modes, prefixes = config.get('PREFIX', '(ov)@+').lstrip('(').split(')', 1)
+        self.prefixes = prefixes
+        self.mode_to_prefix = dict(zip(modes, prefixes))
+        self.prefix_to_mode = dict(zip(prefixes, modes))
+
+        # we consider halfop/op and above admins
+        if '%' in prefixes:
+            admin_index = prefixes.index('%')
+        elif '@' in prefixes:
+            admin_index = prefixes.index('@')
+        else:
+            admin_index = 0
+        self.admin_prefixes = prefixes[:admin_index + 1]
+
+        # bitmasks for Channel.has_mode
+        self.admin_mask = mode_mask(self.admin_prefixes)
+        self.voice_mask = mode_mask(self.mode_to_prefix.get('v', '+'))
+
+        # CHANMODES=A,B,C,D; only type D modes never take an argument
+        self.chanmodes = config.get('CHANMODES', 'eIbq,k,flj,CFLMPQScgimnprstz').split(',')
+        self.noarg_modes = self.chanmodes[-1]
+
+        self.statusmsg = config.get('STATUSMSG', '+@')
+        self.chantypes = config.get('CHANTYPES', '#&')
+        self.casemapping = config.get('CASEMAPPING', 'rfc1459')
+
+        # MODES without a value means no limit; rfc1459 says three
+        max_modes = config.get('MODES', 3)
+        self.max_modes = 100 if max_modes is True else int(max_modes)
+
+        for callback in self.listeners:
+            callback()
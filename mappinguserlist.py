@@ -6,6 +6,10 @@ from irc3 import rfc
 from irc3.dec import event
 from irc3.utils import IrcString
 from collections import defaultdict
+from collections.abc import MutableSet
+
+import metrics
+
 __doc__ = '''
 ==============================================
 :mod:`irc3.plugins.userlist` User list plugin
@@ -40,7 +44,94 @@ Api
 '''
 
 
-class Channel(set):
+_MODE_BITS = {}
+
+
+def mode_bit(mode):
+    """Return the bit standing for a mode prefix, allocating one on first use."""
+    bit = _MODE_BITS.get(mode)
+    if bit is None:
+        bit = _MODE_BITS[mode] = 1 << len(_MODE_BITS)
+    return bit
+
+
+def mode_mask(modes):
+    """Return the bits standing for every mode prefix in ``modes``."""
+    mask = 0
+    for mode in modes:
+        mask |= mode_bit(mode)
+    return mask
+
+
+class ModeView(object):
+    """A live, set like view of the nicknames holding one mode on a channel."""
+
+    __slots__ = ('_members', '_bit')
+
+    def __init__(self, members, bit):
+        self._members = members
+        self._bit = bit
+
+    def __contains__(self, item):
+        return self._members.get(item, 0) & self._bit != 0
+
+    def __iter__(self):
+        bit = self._bit
+        return (nick for nick, bits in self._members.items() if bits & bit)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __bool__(self):
+        return any(True for _ in self)
+
+    def add(self, item):
+        # only members hold modes; a mode for someone not here is ignored
+        if item in self._members:
+            self._members[item] |= self._bit
+
+    def discard(self, item):
+        if item in self._members:
+            self._members[item] &= ~self._bit
+
+    def remove(self, item):
+        if item not in self:
+            raise KeyError(item)
+        self._members[item] &= ~self._bit
+
+    def __repr__(self):
+        return repr(sorted(self))
+
+
+class Modes(object):
+    """Maps mode prefixes to :class:`ModeView` objects, like a
+    ``defaultdict(set)`` that is computed from the member bitmasks."""
+
+    __slots__ = ('_members',)
+
+    def __init__(self, members):
+        self._members = members
+
+    def __getitem__(self, mode):
+        return ModeView(self._members, mode_bit(mode))
+
+    def keys(self):
+        bits = 0
+        for mask in self._members.values():
+            bits |= mask
+        return [mode for mode, bit in _MODE_BITS.items() if bits & bit]
+
+    def values(self):
+        return [self[mode] for mode in self.keys()]
+
+    def items(self):
+        return [(mode, self[mode]) for mode in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+class Channel(MutableSet):
     """A set like object which contains nicknames that are on the channel and
     user modes:
 
@@ -52,28 +143,77 @@ class Channel(set):
         True
         >>> 'gawel' in channel.modes['@']
         True
+        >>> channel.has_mode('gawel', mode_mask('@+'))
+        True
+        >>> channel.set_mode('bob', '+')
+        >>> 'bob' in channel
+        False
         >>> channel.remove('gawel')
         >>> 'gawel' in channel
         False
         >>> 'gawel' in channel.modes['@']
         False
+
+    Each nickname maps to a bitmask of its modes (see :func:`mode_bit`), so
+    permission checks, renames and removals are a single dict operation.
     """
 
+    __slots__ = ('members', 'modes', 'topic')
+
     def __init__(self):
-        set.__init__(self)
-        self.modes = defaultdict(set)
+        self.members = {}
+        self.modes = Modes(self.members)
         self.topic = None
 
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def __contains__(self, item):
+        return item in self.members
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
     def add(self, item, modes=''):
-        set.add(self, item)
-        for mode in modes:
-            self.modes[mode].add(item)
+        self.members[item] = self.members.get(item, 0) | mode_mask(modes)
+
+    def discard(self, item):
+        self.members.pop(item, None)
 
     def remove(self, item):
-        set.remove(self, item)
-        for items in self.modes.values():
-            if item in items:
-                items.remove(item)
+        del self.members[item]
+
+    def update(self, *others):
+        for other in others:
+            for item in other:
+                self.add(item)
+
+    def copy(self):
+        # like set.copy on a subclass of set: the nicknames, without modes
+        return set(self.members)
+
+    def union(self, *others):
+        return set(self.members).union(*others)
+
+    def rename(self, item, new_item):
+        self.members[new_item] = self.members.pop(item)
+
+    def set_mode(self, item, mode):
+        # a MODE for someone not on the channel doesn't make them a member
+        if item in self.members:
+            self.members[item] |= mode_bit(mode)
+
+    def unset_mode(self, item, mode):
+        if item in self.members:
+            self.members[item] &= ~mode_bit(mode)
+
+    def has_mode(self, item, mask):
+        """Whether ``item`` holds any of the modes in ``mask``."""
+        return self.members.get(item, 0) & mask != 0
 
     def __repr__(self):
         return repr(sorted(self))
@@ -85,6 +225,8 @@ class Userlist(object):
     def __init__(self, context):
         self.context = context
         self.context.include('casemapping')
+        self.isupport = self.context.isupport
+        self.listeners = []
         self.connection_lost()
 
     def connection_lost(self, client=None):
@@ -92,111 +234,169 @@ class Userlist(object):
         self.context.channels = self.channels
         self.nicks = {}
         self.context.nicks = self.nicks
+        # nick -> names of the channels it is on
+        self.nick_channels = {}
+        self.context.nick_channels = self.nick_channels
+
+    def subscribe(self, callback):
+        """Call ``callback(event, nick, channels, new_nick=None)`` when a user
+        joins, parts, quits or changes nick. ``event`` is one of ``'join'``,
+        ``'part'``, ``'quit'`` or ``'nick'``."""
+        self.listeners.append(callback)
+
+    def notify_listeners(self, event, nick, channels, new_nick=None):
+        for callback in self.listeners:
+            callback(event, nick, channels, new_nick=new_nick)
+
+    def track(self, nick, channel):
+        """Record that ``nick`` is on ``channel`` (a casefolded name)."""
+        self.nick_channels.setdefault(nick, set()).add(channel)
+
+    def untrack(self, nick, channel):
+        """Forget that ``nick`` is on ``channel``, returning the channels left."""
+        channels = self.nick_channels.get(nick)
+        if channels is None:
+            return ()
+        channels.discard(channel)
+        if not channels:
+            del self.nick_channels[nick]
+        return channels
 
     def broadcast(self, *args, **kwargs):
         # only usefull for servers
         pass
 
     @event(rfc.JOIN_PART_QUIT)
+    @metrics.timed
     def on_join_part_quit(self, mask=None, event=None, **kwargs):
         getattr(self, event.lower())(mask.nick, mask, **kwargs)
 
     @event(rfc.KICK)
+    @metrics.timed
     def on_kick(self, mask=None, event=None, target=None, **kwargs):
         self.part(target.nick, mask=None, **kwargs)
 
     def join(self, nick, mask, client=None, **kwargs):
-        channel = self.channels[self.context.casefold(kwargs['channel'])]
-        if nick != self.context.nick:
-            channel.add(mask.nick)
-            self.nicks[mask.nick] = client or mask
+        casefold = self.context.casefold
+        name = casefold(kwargs['channel'])
+        channel = self.channels[name]
+        nick = casefold(nick)
+        if nick != casefold(self.context.nick):
+            channel.add(nick)
+            self.track(nick, name)
+            self.nicks[nick] = client or mask
+            self.notify_listeners('join', nick, (name,))
             if client:
                 self.broadcast(client=client, clients=channel, **kwargs)
 
     def part(self, nick, mask=None, channel=None, client=None, **kwargs):
-        channel = self.context.casefold(channel)
-        if nick == self.context.nick:
-            del self.channels[channel]
+        casefold = self.context.casefold
+        name = casefold(channel)
+        nick = casefold(nick)
+        if nick == casefold(self.context.nick):
+            for member in self.channels.pop(name, ()):
+                self.untrack(member, name)
         else:
-            channel = self.channels[channel]
+            channel = self.channels[name]
             self.broadcast(client=client, clients=channel, **kwargs)
             channel.remove(nick)
-            if True not in [nick in c for c in self.channels.values()]:
+            if not self.untrack(nick, name):
                 del self.nicks[nick]
+            self.notify_listeners('part', nick, (name,))
 
     def quit(self, nick, mask, channel=None, client=None, **kwargs):
-        if nick == self.context.nick:
+        casefold = self.context.casefold
+        nick = casefold(nick)
+        if nick == casefold(self.context.nick):
             self.connection_lost()
         else:
             clients = set()
-            for channel in self.channels.values():
-                if nick in channel:
-                    clients.update(channel)
-                    channel.remove(nick)
+            names = self.nick_channels.pop(nick, ())
+            for name in names:
+                channel = self.channels[name]
+                clients.update(channel)
+                channel.remove(nick)
             self.broadcast(client=client, clients=clients, **kwargs)
-            del self.nicks[nick]
+            self.nicks.pop(nick, None)
+            self.notify_listeners('quit', nick, names)
 
     @event(rfc.NEW_NICK)
+    @metrics.timed
     def new_nick(self, nick=None, new_nick=None, client=None, **kwargs):
         """update list on new nick"""
+        casefold = self.context.casefold
         if client is None:
-            self.nicks[new_nick] = new_nick + '!' + nick.host
+            mask = new_nick + '!' + nick.host
             nick = nick.nick
+        new_nick = casefold(new_nick)
+        nick = casefold(nick)
+        if client is None:
+            self.nicks.pop(nick, None)
+            self.nicks[new_nick] = mask
         clients = set()
-        for channel in self.channels.values():
-            if nick in channel:
-                for nicknames in channel.modes.values():
-                    if nick in nicknames:
-                        nicknames.add(new_nick)
-                channel.remove(nick)
-                clients.update(channel)
-                channel.add(new_nick)
+        names = self.nick_channels.pop(nick, set())
+        for name in names:
+            channel = self.channels[name]
+            channel.rename(nick, new_nick)
+            clients.update(channel)
+        if names:
+            self.nick_channels[new_nick] = names
         self.broadcast(client=client, clients=clients, **kwargs)
+        self.notify_listeners('nick', nick, names, new_nick=new_nick)
 
     @event(rfc.RPL_NAMREPLY)
+    @metrics.timed
     def names(self, channel=None, data=None, **kwargs):
         """Initialise channel list and channel.modes"""
-        statusmsg = self.context.server_config['STATUSMSG']
+        statusmsg = self.isupport.statusmsg
         nicknames = data.split(' ')
-        channel = self.context.casefold(channel)
-        channel = self.channels[channel]
+        name = self.context.casefold(channel)
+        channel = self.channels[name]
+        casefold = self.context.casefold
         for item in nicknames:
-            nick = item.strip(statusmsg)
-            channel.add(nick, modes=item[:-len(nick)])
-            self.nicks[nick] = nick
+            nick = item.lstrip(statusmsg)
+            modes = item[:-len(nick)]
+            nick = casefold(nick)
+            channel.add(nick, modes=modes)
+            self.track(nick, name)
+            self.nicks.setdefault(nick, nick.display)
 
     @event(rfc.RPL_WHOREPLY)
+    @metrics.timed
     def who(self, channel=None, nick=None, username=None, server=None, **kw):
         """Set nick mask"""
         channel = self.context.casefold(channel)
-        self.channels[channel].add(nick)
         mask = IrcString(nick + '!' + username + '@' + server)
+        nick = self.context.casefold(nick)
+        self.channels[channel].add(nick)
+        self.track(nick, channel)
         self.nicks[nick] = mask
 
     @event(rfc.MODE)
+    @metrics.timed
     def mode(self, target=None, modes=None, data=None, client=None, **kw):
         """Add nicknames to channel.modes"""
-        if target[0] not in self.context.server_config['CHANTYPES'] \
+        if target[0] not in self.isupport.chantypes \
            or not data:
             # not a channel or no user target
             return
-        noargs = self.context.server_config['CHANMODES'].split(',')[-1]
         if not isinstance(data, list):
             data = [d for d in data.split(' ') if d]
         if not modes.startswith(('+', '-')):
             modes = '+' + modes
-        modes = utils.parse_modes(modes, data, noargs)
-        prefix = self.context.server_config['PREFIX']
-        prefix = dict(zip(*prefix.strip('(').split(')')))
+        modes = utils.parse_modes(modes, data, self.isupport.noarg_modes)
+        prefix = self.isupport.mode_to_prefix
         target = self.context.casefold(target)
         channel = self.channels[target]
         for char, mode, tgt in modes:
             if mode in prefix:
-                nicknames = channel.modes[prefix[mode]]
+                tgt = self.context.casefold(tgt)
                 if char == '+':
-                    nicknames.add(tgt)
-                elif tgt in nicknames:
-                    nicknames.remove(tgt)
+                    channel.set_mode(tgt, prefix[mode])
+                    if tgt in channel:
+                        self.track(tgt, target)
+                else:
+                    channel.unset_mode(tgt, prefix[mode])
                 if client is not None:
                     broadcast = (
                         ':{mask} MODE {target} {char}{mode} {tgt}').format(
@@ -206,6 +406,7 @@ class Userlist(object):
                                    clients=channel)
 
     @event(rfc.RPL_TOPIC)
+    @metrics.timed
     def topic(self, channel=None, data=None, client=None, **kwargs):
         channel = self.context.casefold(channel)
         self.channels[channel].topic = data
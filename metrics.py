@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Metrics in the Prometheus text format, served over HTTP.
+
+Metrics are collected all the time; counting a vote or timing a handler is a
+dict lookup and an add, cheap enough to leave on. The ``Metrics`` plugin
+serves them and measures event loop lag, and only runs if it's included::
+
+    [bot]
+    includes =
+        ...
+        metrics
+
+    [metrics]
+    host = 127.0.0.1
+    port = 9105
+    # seconds between event loop lag samples
+    lag_interval = 1
+
+Handlers are timed with the :func:`timed` decorator, which goes under the
+irc3 ``@event``/``@command`` decorators::
+
+    @event(irc3.rfc.JOIN)
+    @metrics.timed
+    def join_chan(self, mask=None, channel=None):
+        ...
+"""
+import asyncio
+import bisect
+import functools
+import time
+
+import irc3
+
+# seconds; handlers are expected to take well under a millisecond
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# every metric, in the order created
+REGISTRY = []
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                                             .replace('"', r'\"').replace('\n', r'\n'))
+                          for name, value in zip(names, values)) + '}'
+
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} {}'.format(self.name, self.kind)
+        for line in self.samples():
+            yield line
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A count which only goes up. Label values are passed positionally."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, *labels):
+        self.values[labels] = self.values.get(labels, 0) + 1
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield '{}{} {}'.format(self.name, _labels(self.labels, labels), value)
+
+
+class Gauge(Metric):
+    """A value read when scraped, from ``collect()``.
+
+    ``collect`` returns ``{(label values): value}``.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super(Gauge, self).__init__(name, help, labels)
+        self.collect = collect
+        self.values = {}
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        values = self.collect() if self.collect else self.values
+        for labels, value in sorted(values.items()):
+            yield '{}{} {}'.format(self.name, _labels(self.labels, labels), value)
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, _labels(names, labels + (bound,)),
+                                              cumulative)
+            yield '{}_sum{} {}'.format(self.name, _labels(self.labels, labels), total)
+            yield '{}_count{} {}'.format(self.name, _labels(self.labels, labels), cumulative)
+
+
+def render():
+    """Return every metric in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+handler_seconds = Histogram('rhythm_handler_seconds', 'Time spent in each event handler.',
+                            labels=('handler',))
+votes = Counter('rhythm_votes_total', 'Votes counted, by channel.', labels=('channel',))
+votes_suppressed = Counter('rhythm_votes_suppressed_total', 'Votes ignored, by channel and reason.',
+                           labels=('channel', 'reason'))
+store_seconds = Histogram('rhythm_store_call_seconds', 'Time taken by database calls.',
+                          labels=('call',))
+outbound_depth = Gauge('rhythm_outbound_depth', 'Messages waiting in each outbound lane.',
+                       labels=('lane',))
+loop_lag = Gauge('rhythm_loop_lag_last_seconds', 'How late the last event loop probe ran.')
+loop_lag_seconds = Histogram('rhythm_loop_lag_seconds', 'How late event loop probes ran.')
+
+
+def timed(func):
+    """Record how long each call to an event handler takes."""
+    name = func.__qualname__
+    clock = time.perf_counter
+    observe = handler_seconds.observe
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        @asyncio.coroutine
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return (yield from func(*args, **kwargs))
+            finally:
+                observe(clock() - start, name)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(clock() - start, name)
+    return wrapper
+
+
+@irc3.plugin
+class Metrics(object):
+    """Serves the metrics over HTTP and samples event loop lag."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.loop = bot.loop
+        config = bot.config.get('metrics', {})
+        self.host = config.get('host', '127.0.0.1')
+        self.port = int(config.get('port', 9105))
+        self.lag_interval = float(config.get('lag_interval', 1))
+        self.server = None
+
+        outbound_depth.collect = self.outbound_depth
+
+        self.expected = self.loop.time() + self.lag_interval
+        self.loop.call_later(self.lag_interval, self.sample_lag)
+        self.bot.create_task(self.start())
+
+    @asyncio.coroutine
+    def start(self):
+        self.server = yield from asyncio.start_server(self.serve, self.host, self.port,
+                                                      loop=self.loop)
+
+    def outbound_depth(self):
+        outbound = getattr(self.bot, 'outbound', None)
+        if outbound is None:
+            return {}
+        return dict(((lane,), depth) for lane, depth in enumerate(outbound.depth()))
+
+    def sample_lag(self):
+        now = self.loop.time()
+        lag = max(0.0, now - self.expected)
+        loop_lag.set(lag)
+        loop_lag_seconds.observe(lag)
+        self.expected = now + self.lag_interval
+        self.loop.call_later(self.lag_interval, self.sample_lag)
+
+    @asyncio.coroutine
+    def serve(self, reader, writer):
+        try:
+            request = yield from reader.readline()
+            # the headers don't matter, but read them so the client is happy
+            while (yield from reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', render()
+            else:
+                status, body = '404 Not Found', 'Not found; try /metrics\n'
+
+            body = body.encode('utf-8')
+            writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         'Content-Length: {}\r\n\r\n'.format(status, len(body)).encode('ascii'))
+            writer.write(body)
+            yield from writer.drain()
+        finally:
+            writer.close()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""Flood-aware outbound message queue.
+
+Messages are queued in priority lanes and sent as fast as a server-wide and
+a per-target token bucket allow. Queued messages to the same target are
+coalesced into as few lines as fit in the server's line length, so a burst
+of notices costs one or two lines instead of one line each. MODE changes
+share the buckets but are sent one per line, as queued.
+
+Configure it from the ``[outbound]`` section of the bot config::
+
+    [outbound]
+    # lines per second, and how many may go out at once, for the whole bot
+    rate = 1
+    burst = 5
+    # the same, for any one channel or nick
+    target_rate = 0.5
+    target_burst = 3
+    # joins coalesced messages
+    separator = " | "
+"""
+import collections
+
+import irc3
+
+# lanes, most urgent first
+RESULT = 0
+NORMAL = 1
+COURTESY = 2
+LANES = (RESULT, NORMAL, COURTESY)
+
+# room left for the ":nick!user@host " prefix the server adds when relaying
+PREFIX_ALLOWANCE = 100
+
+# how many recent send latencies to keep for the stats
+LATENCY_SAMPLES = 1000
+
+
+def split_text(text, budget):
+    """Yield pieces of ``text`` of at most ``budget`` utf-8 bytes, breaking
+    on spaces where possible."""
+    line = []
+    size = 0
+    for word in text.split(' '):
+        word_size = len(word.encode('utf-8'))
+        while word_size > budget:
+            # a single word that doesn't fit anywhere; cut it up
+            if line:
+                yield ' '.join(line)
+                line, size = [], 0
+            cut = budget
+            while len(word[:cut].encode('utf-8')) > budget:
+                cut -= 1
+            yield word[:cut]
+            word = word[cut:]
+            word_size = len(word.encode('utf-8'))
+        if line and size + 1 + word_size > budget:
+            yield ' '.join(line)
+            line, size = [], 0
+        size += word_size + (1 if line else 0)
+        line.append(word)
+    if line:
+        yield ' '.join(line)
+
+
+class TokenBucket(object):
+    """Allows ``rate`` events per second, with bursts of up to ``burst``."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self, now):
+        """Seconds until a token is available; zero if one is now."""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+@irc3.plugin
+class Outbound(object):
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.loop = bot.loop
+        config = bot.config.get('outbound', {})
+        self.rate = float(config.get('rate', 1))
+        self.burst = int(config.get('burst', 5))
+        self.target_rate = float(config.get('target_rate', 0.5))
+        self.target_burst = int(config.get('target_burst', 3))
+        self.separator = config.get('separator', ' | ').strip('"')
+        self.max_length = int(bot.config.get('max_length', 512))
+
+        # each lane maps (command, target) -> queued (text, queued at), in
+        # the order targets were first queued; targets are served round robin
+        self.lanes = [collections.OrderedDict() for _ in LANES]
+        self.bucket = TokenBucket(self.rate, self.burst, self.loop.time())
+        self.target_buckets = {}
+        self.handle = None
+        self.wake_at = None
+
+        self.sent = 0
+        self.coalesced = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+        self.bot.outbound = self
+
+    def connection_lost(self, client=None):
+        # nothing queued for the old connection makes sense on a new one
+        for lane in self.lanes:
+            lane.clear()
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    # api
+    def notice(self, target, message, priority=NORMAL):
+        self.queue('NOTICE', target, message, priority)
+
+    def privmsg(self, target, message, priority=NORMAL):
+        self.queue('PRIVMSG', target, message, priority)
+
+    def mode(self, target, modes, priority=NORMAL):
+        """Queue ``MODE <target> <modes>``; ``modes`` holds the arguments too."""
+        self.queue('MODE', target, modes, priority)
+
+    def queue(self, command, target, message, priority=NORMAL):
+        if not message:
+            return
+        key = (command, target)
+        lane = self.lanes[priority]
+        if key not in lane:
+            lane[key] = collections.deque()
+        lane[key].append((message, self.loop.time()))
+        self.wake()
+
+    def depth(self):
+        """Number of messages waiting in each lane."""
+        return [sum(len(messages) for messages in lane.values()) for lane in self.lanes]
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            'depth': self.depth(),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'latency_p50': latencies[len(latencies) // 2] if latencies else 0.0,
+            'latency_max': latencies[-1] if latencies else 0.0,
+        }
+
+    # scheduling
+    def wake(self, delay=0):
+        """Make sure the queue is drained within ``delay`` seconds."""
+        when = self.loop.time() + delay
+        if self.handle is not None:
+            if self.wake_at <= when:
+                return
+            self.handle.cancel()
+        self.wake_at = when
+        self.handle = self.loop.call_later(delay, self.drain)
+
+    def target_bucket(self, target, now):
+        bucket = self.target_buckets.get(target)
+        if bucket is None:
+            if len(self.target_buckets) > 1000:
+                self.prune(now)
+            bucket = self.target_buckets[target] = TokenBucket(
+                self.target_rate, self.target_burst, now)
+        return bucket
+
+    def prune(self, now):
+        """Forget buckets which have refilled; they'd be recreated full anyway."""
+        for target, bucket in list(self.target_buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.target_buckets[target]
+
+    def drain(self):
+        self.handle = None
+        now = self.loop.time()
+        next_wait = None
+
+        for lane in self.lanes:
+            for key in list(lane):
+                wait = self.bucket.wait(now)
+                if wait:
+                    # the whole bot is out of tokens; come back when it isn't
+                    self.wake(wait)
+                    return
+
+                bucket = self.target_bucket(key[1], now)
+                wait = bucket.wait(now)
+                if not wait:
+                    messages = lane.pop(key)
+                    self.send(key, messages, now)
+                    self.bucket.take(now)
+                    bucket.take(now)
+                    if not messages:
+                        continue
+
+                    # back of the line for this target
+                    lane[key] = messages
+                    wait = bucket.wait(now)
+
+                next_wait = wait if next_wait is None else min(next_wait, wait)
+
+        if next_wait is not None:
+            self.wake(next_wait)
+
+    def send(self, key, messages, now):
+        """Send one line made of as many queued messages as fit."""
+        command, target = key
+        if command == 'MODE':
+            # arguments can't be joined up like text
+            modes, queued_at = messages.popleft()
+            self.latencies.append(now - queued_at)
+            self.sent += 1
+            self.bot.send_line('MODE {} {}'.format(target, modes))
+            return
+
+        budget = self.max_length - PREFIX_ALLOWANCE - len(
+            '{} {} :\r\n'.format(command, target).encode('utf-8'))
+        separator_size = len(self.separator.encode('utf-8'))
+
+        parts = []
+        size = 0
+        while messages:
+            message, queued_at = messages[0]
+            message_size = len(message.encode('utf-8'))
+            if message_size > budget:
+                if parts:
+                    break
+                # too long for any line; send the first piece, keep the rest
+                pieces = list(split_text(message, budget))
+                message = pieces[0]
+                messages[0] = (' '.join(pieces[1:]), queued_at)
+                parts.append(message)
+                self.latencies.append(now - queued_at)
+                break
+            if parts and size + separator_size + message_size > budget:
+                break
+            messages.popleft()
+            parts.append(message)
+            size += message_size + (separator_size if len(parts) > 1 else 0)
+            self.latencies.append(now - queued_at)
+
+        self.coalesced += len(parts) - 1
+        self.sent += 1
+        self.bot.send_line('{} {} :{}'.format(command, target, self.separator.join(parts)))
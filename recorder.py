@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Record every line the server sends, to replay later.
+
+Only runs if it's included::
+
+    [bot]
+    includes =
+        ...
+        recorder
+
+    [recorder]
+    # strftime codes are filled in when the bot starts
+    file = captures/rhythm-%Y%m%d-%H%M%S.gz
+
+Each line is written as ``<unix time> <line>`` to a gzip file by a
+background thread, which compresses and writes lines as they come and makes
+everything readable at least once a second; the event loop never waits on
+the disk. ``python replay.py <capture>`` feeds a capture back through the
+bot, offline.
+
+Captures hold private messages sent to the bot; keep them somewhere private.
+"""
+import gzip
+import os
+import queue
+import threading
+import time
+
+import irc3
+from irc3 import event
+
+# tells the writer thread to finish up
+_CLOSE = object()
+
+
+def read(path):
+    """Yield ``(timestamp, line)`` from a capture.
+
+    A capture from a bot which was killed just stops after the last line
+    made readable.
+    """
+    with gzip.open(path, 'rt', encoding='utf-8', newline='\n') as fd:
+        try:
+            for record in fd:
+                if not record.endswith('\n'):
+                    return
+                ts, _, line = record[:-1].partition(' ')
+                yield float(ts), line
+        except EOFError:
+            return
+
+
+@irc3.plugin
+class Recorder(object):
+    """Writes raw inbound lines to a compressed capture file."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        config = bot.config.get('recorder', {})
+        self.path = time.strftime(config.get('file', 'rhythm-%Y%m%d-%H%M%S.gz'))
+        # seconds between making what's been written readable
+        self.flush_interval = float(config.get('flush_interval', 1))
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+        bot.attach_events(event(r'^(?P<raw>.+)', callback=self.record))
+
+    def record(self, raw=None):
+        self.queue.put((time.time(), raw))
+
+    def close(self):
+        """Write out everything queued and finish the file."""
+        self.queue.put(_CLOSE)
+        self.thread.join()
+
+    def SIGINT(self):
+        """irc3 calls this as the bot stops; finish the capture."""
+        self.close()
+
+    def _run(self):
+        with gzip.open(self.path, 'wt', encoding='utf-8', newline='\n') as fd:
+            written = False
+            flushed = time.monotonic()
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = None
+                if item is _CLOSE:
+                    return
+                if item is not None:
+                    fd.write('{:.6f} {}\n'.format(*item))
+                    written = True
+                if written and time.monotonic() - flushed >= self.flush_interval:
+                    # a sync flush, so a reader sees every line up to here
+                    fd.flush()
+                    written = False
+                    flushed = time.monotonic()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""Replay a capture from the recorder through the bot, offline.
+
+    python replay.py capture.gz [--config config.ini] [--speed 1]
+    python replay.py capture.gz --profile cprofile --since 2024-06-30T19:02:00
+    python replay.py capture.gz --profile sample --interval 0.001 --until 1719774300
+
+Lines are fed to a bot running the Rhythm plugins (``Motions``,
+``Userlist``, ``Casemapping`` and what they include) on a real event loop,
+with no connection; anything it sends is dropped. The config's database,
+archive, history and state settings are ignored, so a replay never touches
+real data.
+
+By default lines go in as fast as the bot takes them; ``--speed 1`` keeps
+the original gaps between them and ``--speed 10`` plays ten times faster.
+
+Every event handler and command is timed on its own; time spent in a handler
+called from another counts only to the inner one. ``--profile cprofile``
+gives each handler its own profiler, and ``--profile sample`` samples the
+stack every ``--interval`` seconds, so the report shows where each handler's
+time went. ``--since`` and ``--until`` limit timing and profiling to the
+window of an incident; earlier lines are still replayed, at full speed, to
+get the bot into the state it was in.
+"""
+import argparse
+import asyncio
+import calendar
+import collections
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+import time
+
+import recorder
+
+# settings which would have a replay write somewhere real
+IGNORED = ('database', 'archive', 'history', 'state_dir', 'ballot_dir')
+
+
+class Handlers(object):
+    """Times, and optionally profiles, each event handler separately."""
+
+    def __init__(self, profile=None):
+        self.profile = profile
+        self.clock = time.perf_counter
+        # only record while true; set for the window being looked at
+        self.active = True
+        # [name, time it last started running, time it's run so far, recording]
+        self.stack = []
+        self.runs = collections.Counter()
+        self.seconds = collections.Counter()
+        self.longest = collections.Counter()
+        self.profiles = collections.defaultdict(cProfile.Profile)
+
+    def enter(self, name):
+        now = self.clock()
+        if self.stack:
+            outer = self.stack[-1]
+            outer[2] += now - outer[1]
+            if outer[3] and self.profile == 'cprofile':
+                self.profiles[outer[0]].disable()
+        self.stack.append([name, now, 0.0, self.active])
+        if self.active and self.profile == 'cprofile':
+            self.profiles[name].enable()
+
+    def exit(self):
+        name, started, elapsed, recording = self.stack.pop()
+        now = self.clock()
+        if recording:
+            if self.profile == 'cprofile':
+                self.profiles[name].disable()
+            elapsed += now - started
+            self.runs[name] += 1
+            self.seconds[name] += elapsed
+            self.longest[name] = max(self.longest[name], elapsed)
+        if self.stack:
+            outer = self.stack[-1]
+            outer[1] = now
+            if outer[3] and self.profile == 'cprofile':
+                self.profiles[outer[0]].enable()
+
+    def call(self, name, callback, args, kwargs):
+        self.enter(name)
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            self.exit()
+
+    def steps(self, name, coro):
+        """Run a coroutine handler, timing each step it takes on the loop."""
+        value = error = None
+        while True:
+            self.enter(name)
+            try:
+                if error is None:
+                    future = coro.send(value)
+                else:
+                    future = coro.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.exit()
+            try:
+                value, error = (yield future), None
+            except BaseException as exc:
+                value, error = None, exc
+
+    def wrap(self, callback):
+        name = getattr(callback, '__qualname__', None) or repr(callback)
+        if asyncio.iscoroutinefunction(callback):
+            @functools.wraps(callback)
+            @asyncio.coroutine
+            def wrapper(*args, **kwargs):
+                return (yield from self.steps(name, callback(*args, **kwargs)))
+        else:
+            @functools.wraps(callback)
+            def wrapper(*args, **kwargs):
+                return self.call(name, callback, args, kwargs)
+        return wrapper
+
+    def instrument(self, bot):
+        """Wrap every inbound event handler and command the bot has."""
+        from irc3.plugins.command import Commands
+
+        for events in bot.registry.events['in'].values():
+            for handler in events:
+                handler.callback = self.wrap(handler.callback)
+        commands = bot.get_plugin(Commands)
+        for name, (predicates, callback) in list(commands.items()):
+            commands[name] = (predicates, self.wrap(callback))
+
+
+class Sampler(threading.Thread):
+    """Samples the main thread's stack, filed under the handler running."""
+
+    def __init__(self, handlers, interval):
+        super(Sampler, self).__init__(name='sampler')
+        self.daemon = True
+        self.handlers = handlers
+        self.interval = interval
+        self.target = threading.get_ident()
+        self.stopped = threading.Event()
+        self.samples = collections.Counter()
+        # handler -> function -> samples it was running in / on top of the stack
+        self.total = collections.defaultdict(collections.Counter)
+        self.own = collections.defaultdict(collections.Counter)
+        # where the handler frames end and the replay's own begin
+        self.boundary = (Handlers.call.__code__, Handlers.steps.__code__)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                name, _, _, recording = self.handlers.stack[-1]
+            except IndexError:
+                continue
+            frame = sys._current_frames().get(self.target)
+            if not recording or frame is None:
+                continue
+            self.samples[name] += 1
+            seen = set()
+            while frame is not None and frame.f_code not in self.boundary:
+                code = frame.f_code
+                function = (code.co_filename, code.co_firstlineno, code.co_name)
+                if not seen:
+                    self.own[name][function] += 1
+                if function not in seen:
+                    seen.add(function)
+                    self.total[name][function] += 1
+                frame = frame.f_back
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def parse_time(value):
+    """Turn a unix timestamp or ``YYYY-MM-DDTHH:MM:SS`` (UTC) into a timestamp."""
+    try:
+        return float(value)
+    except ValueError:
+        return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+
+
+def make_bot(options, loop):
+    import irc3.utils
+    from irc3.testing import IrcBot
+
+    config = {}
+    if options.config:
+        config = irc3.utils.parse_config('bot', options.config)
+    for key in IGNORED:
+        config.pop(key, None)
+        config.get('Rhythm', {}).pop(key, None)
+    config['includes'] = ['irc3.plugins.command', 'Rhythm']
+    if options.nick:
+        config['nick'] = options.nick
+    return IrcBot(loop=loop, **config)
+
+
+@asyncio.coroutine
+def replay(bot, lines, handlers, options):
+    """Dispatch each line, giving the handlers it schedules a turn before the next."""
+    loop = bot.loop
+    count = 0
+    first = None
+    for ts, line in lines:
+        if options.until is not None and ts >= options.until:
+            break
+        handlers.active = options.since is None or ts >= options.since
+        if options.speed and handlers.active:
+            if first is None:
+                first = ts, loop.time()
+            delay = first[1] + (ts - first[0]) / options.speed - loop.time()
+            yield from asyncio.sleep(max(0, delay))
+        else:
+            yield from asyncio.sleep(0)
+        bot.dispatch(line)
+        count += 1
+    yield from asyncio.sleep(0)
+    return count
+
+
+def _where(function):
+    filename, line, name = function
+    return '{}:{}({})'.format(os.path.relpath(filename), line, name)
+
+
+def report(handlers, sampler, options, out=sys.stdout):
+    names = sorted(handlers.seconds, key=handlers.seconds.get, reverse=True)
+    out.write('{:40} {:>8} {:>10} {:>10} {:>10}\n'.format(
+        'handler', 'runs', 'total ms', 'mean us', 'max ms'))
+    for name in names:
+        runs = handlers.runs[name]
+        out.write('{:40} {:>8} {:>10.1f} {:>10.1f} {:>10.2f}\n'.format(
+            name, runs, handlers.seconds[name] * 1e3, handlers.seconds[name] / runs * 1e6,
+            handlers.longest[name] * 1e3))
+
+    for name in names[:options.handlers]:
+        if options.profile == 'cprofile':
+            out.write('\n=== {}\n'.format(name))
+            stats = pstats.Stats(handlers.profiles[name], stream=out)
+            stats.sort_stats('cumulative').print_stats(options.top)
+            if options.output:
+                stats.dump_stats(os.path.join(options.output, name + '.prof'))
+        elif options.profile == 'sample' and sampler.samples[name]:
+            samples = sampler.samples[name]
+            out.write('\n=== {} ({} samples)\n'.format(name, samples))
+            out.write('{:>7} {:>7}  function\n'.format('own %', 'total %'))
+            for function, count in sampler.total[name].most_common(options.top):
+                out.write('{:>7.1f} {:>7.1f}  {}\n'.format(
+                    sampler.own[name][function] * 100 / samples, count * 100 / samples,
+                    _where(function)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('capture')
+    parser.add_argument('--config', help="the bot's config, for its nick, votes and commands")
+    parser.add_argument('--nick', help="the bot's nick in the capture")
+    parser.add_argument('--speed', type=float, default=0,
+                        help='1 for the original timing, 0 (the default) for full speed')
+    parser.add_argument('--since', type=parse_time,
+                        help='time and profile from here: unix time or YYYY-MM-DDTHH:MM:SS UTC')
+    parser.add_argument('--until', type=parse_time, help='stop here')
+    parser.add_argument('--profile', choices=('cprofile', 'sample'))
+    parser.add_argument('--interval', type=float, default=0.001,
+                        help='seconds between samples (default 0.001)')
+    parser.add_argument('--handlers', type=int, default=5,
+                        help='profile the slowest this many handlers (default 5)')
+    parser.add_argument('--top', type=int, default=15, help='functions shown per handler')
+    parser.add_argument('--output', help='also write each cProfile profile to this directory')
+    options = parser.parse_args(argv)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = make_bot(options, loop)
+    handlers = Handlers(options.profile)
+    handlers.instrument(bot)
+
+    sampler = None
+    if options.profile == 'sample':
+        # the sampler can only look when it gets the GIL
+        sys.setswitchinterval(min(sys.getswitchinterval(), options.interval / 2))
+        sampler = Sampler(handlers, options.interval)
+        sampler.start()
+    if options.output and not os.path.isdir(options.output):
+        os.makedirs(options.output)
+
+    started = time.perf_counter()
+    count = loop.run_until_complete(
+        replay(bot, recorder.read(options.capture), handlers, options))
+    elapsed = time.perf_counter() - started
+    if sampler is not None:
+        sampler.stop()
+
+    print('{:,} lines in {:.2f}s\n'.format(count, elapsed))
+    report(handlers, sampler, options)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
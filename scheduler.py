@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""One timer queue for the whole bot.
+
+Timed motions need a close and a few reminders each, in every channel. They
+all go on one heap, ordered by when they're due, with a single loop callback
+armed for the earliest; scheduling or cancelling a timer is a heap push or a
+flag, never another ``call_later``.
+
+Times are unix timestamps rather than loop time, so deadlines kept with a
+channel's state mean the same thing after a restart. A timer whose time has
+already passed runs as soon as the loop gets to it.
+"""
+import heapq
+import itertools
+import re
+import time
+
+import irc3
+
+import eventlog
+
+# rebuild the heap once this many cancelled timers are in it, and they're
+# more than half of it
+COMPACT_AFTER = 64
+
+DURATION = re.compile(r'^(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?$')
+
+
+def parse_duration(text):
+    """Turn ``90s``, ``5m``, ``1h30m`` or a bare number of minutes into seconds."""
+    text = text.strip().lower()
+    if text.isdigit():
+        return int(text) * 60
+    match = DURATION.match(text)
+    if not text or match is None:
+        raise ValueError('not a duration: {!r}; try 90s, 5m or 1h30m'.format(text))
+    hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def format_duration(seconds):
+    """The reverse of :func:`parse_duration`, to the second: ``1h30m``, ``2m5s``."""
+    seconds = int(round(seconds))
+    if seconds <= 0:
+        return '0s'
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return ''.join('{}{}'.format(value, unit) for value, unit in
+                   ((hours, 'h'), (minutes, 'm'), (seconds, 's')) if value)
+
+
+class Timer(object):
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled', 'scheduler')
+
+    def __init__(self, scheduler, when, callback, args):
+        self.scheduler = scheduler
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # left on the heap, and skipped when it comes up
+        if not self.cancelled:
+            self.cancelled = True
+            self.scheduler.cancelled += 1
+
+
+@irc3.plugin
+class Scheduler(object):
+
+    def __init__(self, bot):
+        bot.include('eventlog')
+        self.bot = bot
+        self.loop = bot.loop
+        self.log = eventlog.EventLogger('rhythm.scheduler')
+        # (when, seq, timer); seq keeps timers due at once in the order given
+        self.heap = []
+        self.seq = itertools.count()
+        self.cancelled = 0
+        self.handle = None
+        self.armed_at = None
+        self.bot.scheduler = self
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def call_at(self, when, callback, *args):
+        """Call ``callback(*args)`` at unix time ``when``; returns a cancellable timer."""
+        timer = Timer(self, when, callback, args)
+        heapq.heappush(self.heap, (when, next(self.seq), timer))
+        if self.armed_at is None or when < self.armed_at:
+            self.arm()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def arm(self):
+        """Have the loop wake us for the earliest timer, and only that."""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+            self.armed_at = None
+        if self.heap:
+            self.armed_at = self.heap[0][0]
+            self.handle = self.loop.call_later(max(0, self.armed_at - time.time()), self.run)
+
+    def run(self):
+        self.handle = None
+        self.armed_at = None
+        now = time.time()
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+            # done with; cancelling it now mustn't count against the heap
+            timer.cancelled = True
+            try:
+                timer.callback(*timer.args)
+            except Exception as exc:
+                self.log.error('timer_failed', callback=repr(timer.callback), error=repr(exc))
+        if self.cancelled > COMPACT_AFTER and self.cancelled * 2 > len(heap):
+            self.heap = heap = [entry for entry in heap if not entry[2].cancelled]
+            heapq.heapify(heap)
+            self.cancelled = 0
+        self.arm()
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""Run the bot's channels across several processes.
+
+One busy channel's vote flood holds up every channel sharing its event loop.
+In sharded mode a coordinator starts several worker processes, each an
+ordinary bot with its own nick and IRC connection, and gives each channel to
+exactly one of them::
+
+    python shard.py config.ini
+
+    [shard]
+    workers = 4
+    # each worker's nick; {nick} is the bot's nick and {worker} its number
+    nick = {nick}{worker}
+    # where the coordinator listens for its workers, on localhost
+    port = 9106
+    # seconds between load reports, and between rebalancing
+    interval = 10
+    # move a channel off a worker with this many times the average load
+    imbalance = 1.5
+    # where channel assignments are kept across restarts
+    assignments = shards.json
+
+Channels are placed by rendezvous hashing, so adding a worker moves only the
+channels it takes. Workers report how many lines each channel sees; when one
+worker is carrying much more than the average, the coordinator moves one of
+its quieter channels to the least loaded worker. A channel with a meeting in
+progress is never moved, since its meeting state lives in that worker.
+
+Workers must share a database (sqlite or mongodb, not memory) for recognised
+lists, and see each other's changes within ``database_poll`` seconds. They
+share the archive too, which is written under a file lock, but keep their own
+``state_dir``, ``history`` index and metrics port.
+"""
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import signal
+import sys
+
+import irc3
+from irc3 import event
+
+import eventlog
+import Rhythm
+
+# seconds before restarting a worker which exited
+RESTART_DELAY = 5
+
+
+def owner(channel, workers):
+    """The worker a channel hashes to, out of ``workers``."""
+    return max(range(workers), key=lambda worker: hashlib.md5(
+        '{}/{}'.format(worker, channel).encode('utf-8')).digest())
+
+
+def assign(channels, workers, previous=None):
+    """Place channels on workers, keeping earlier placements which still fit."""
+    previous = previous or {}
+    assignment = {}
+    for channel in channels:
+        worker = previous.get(channel)
+        if worker is None or worker >= workers:
+            worker = owner(channel, workers)
+        assignment[channel] = worker
+    return assignment
+
+
+def choose_move(loads, rates, busy, imbalance):
+    """Pick a channel to move, as ``(channel, from, to)``, or None.
+
+    ``loads`` is each worker's total rate, ``rates`` each worker's per
+    channel rates and ``busy`` each worker's channels which mustn't move.
+    """
+    mean = sum(loads.values()) / len(loads)
+    hot = max(loads, key=loads.get)
+    cold = min(loads, key=loads.get)
+    if not mean or loads[hot] <= mean * imbalance:
+        return None
+
+    # the channel which comes nearest to evening the two out, without
+    # making the cold worker the new hot one
+    gap = loads[hot] - loads[cold]
+    candidates = [(abs(gap / 2 - rate), channel)
+                  for channel, rate in rates.get(hot, {}).items()
+                  if 0 < rate < gap and channel not in busy.get(hot, ())]
+    if not candidates:
+        return None
+    return min(candidates)[1], hot, cold
+
+
+def worker_config(config, worker):
+    """Turn the bot's config into worker ``worker``'s."""
+    config = dict(config)
+    shard = dict(config.get('shard', {}), worker=worker)
+    config['shard'] = shard
+
+    if str(config.get('database', '')).startswith('memory:'):
+        raise ValueError('sharded workers need a shared database, not memory://')
+
+    config['nick'] = shard.get('nick', '{nick}{worker}').format(
+        nick=config.get('nick', 'Rhythm'), worker=worker)
+    # the coordinator decides what each worker joins
+    config['autojoins'] = []
+    includes = [name for name in irc3.utils.as_list(config.get('includes', []))
+                if name != 'irc3.plugins.autojoins']
+    config['includes'] = includes + ['shard']
+
+    rhythm = config['Rhythm'] = dict(config.get('Rhythm', {}))
+    if rhythm.get('state_dir'):
+        rhythm['state_dir'] = os.path.join(rhythm['state_dir'], 'worker{}'.format(worker))
+    if rhythm.get('history'):
+        rhythm['history'] = '{}.worker{}'.format(rhythm['history'], worker)
+    if 'metrics' in includes:
+        metrics = config['metrics'] = dict(config.get('metrics', {}))
+        metrics['port'] = int(metrics.get('port', 9105)) + worker
+    if 'recorder' in includes:
+        recorder = config['recorder'] = dict(config.get('recorder', {}))
+        root, ext = os.path.splitext(recorder.get('file', 'rhythm-%Y%m%d-%H%M%S.gz'))
+        recorder['file'] = '{}-worker{}{}'.format(root, worker, ext)
+    return config
+
+
+class Coordinator(object):
+    """Starts the workers, tells them their channels and rebalances them."""
+
+    def __init__(self, config_path, config, loop):
+        self.config_path = config_path
+        self.loop = loop
+        shard = config.get('shard', {})
+        self.workers = int(shard.get('workers', 2))
+        self.port = int(shard.get('port', 9106))
+        self.interval = float(shard.get('interval', 10))
+        self.imbalance = float(shard.get('imbalance', 1.5))
+        self.path = shard.get('assignments', 'shards.json')
+        self.log = eventlog.EventLogger('rhythm.shard')
+
+        previous = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as fd:
+                previous = json.load(fd)
+        channels = irc3.utils.as_list(config.get('autojoins', []))
+        self.assignment = assign([irc3.utils.as_channel(c) for c in channels],
+                                 self.workers, previous)
+        self.save()
+
+        # worker -> its control connection's writer
+        self.connections = {}
+        # worker -> {channel: lines per second}, and the channels it can't give up
+        self.rates = {}
+        self.busy = {}
+        self.processes = {}
+        # channel -> the worker it's going to, once its old one has parted
+        self.moving = {}
+        self.stopping = False
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fd:
+            json.dump(self.assignment, fd, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def channels(self, worker):
+        return sorted(c for c, w in self.assignment.items() if w == worker)
+
+    @asyncio.coroutine
+    def start(self):
+        self.server = yield from asyncio.start_server(
+            self.serve, '127.0.0.1', self.port, loop=self.loop)
+        for worker in range(self.workers):
+            self.loop.create_task(self.run_worker(worker))
+        self.loop.call_later(self.interval, self.rebalance)
+
+    @asyncio.coroutine
+    def run_worker(self, worker):
+        """Run a worker process, restarting it whenever it exits."""
+        while not self.stopping:
+            process = yield from asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), self.config_path,
+                '--worker', str(worker), loop=self.loop)
+            self.processes[worker] = process
+            self.log.info('worker_started', worker=worker, pid=process.pid,
+                          channels=len(self.channels(worker)))
+            code = yield from process.wait()
+            if self.stopping:
+                return
+            self.log.warning('worker_exited', worker=worker, code=code)
+            yield from asyncio.sleep(RESTART_DELAY, loop=self.loop)
+
+    def send(self, worker, op, **fields):
+        writer = self.connections.get(worker)
+        if writer is not None:
+            fields['op'] = op
+            writer.write(json.dumps(fields).encode('utf-8') + b'\n')
+
+    @asyncio.coroutine
+    def serve(self, reader, writer):
+        """Talk to one worker: send its channels, then take its load reports."""
+        worker = None
+        try:
+            while True:
+                line = yield from reader.readline()
+                if not line:
+                    return
+                message = json.loads(line.decode('utf-8'))
+                if message['op'] == 'hello':
+                    worker = message['worker']
+                    self.connections[worker] = writer
+                    for channel in self.channels(worker):
+                        self.send(worker, 'join', channel=channel)
+                elif message['op'] == 'load':
+                    self.rates[worker] = message['rates']
+                    self.busy[worker] = set(message['busy'])
+                elif message['op'] == 'parted':
+                    self.parted(worker, message['channel'], message['ok'])
+        finally:
+            if worker is not None and self.connections.get(worker) is writer:
+                del self.connections[worker]
+                self.rates.pop(worker, None)
+            writer.close()
+
+    def rebalance(self):
+        self.loop.call_later(self.interval, self.rebalance)
+        # only move channels with every worker's load in hand
+        if len(self.rates) < self.workers:
+            return
+        loads = dict((worker, sum(self.rates[worker].values()))
+                     for worker in range(self.workers))
+        move = choose_move(loads, self.rates, self.busy, self.imbalance)
+        if move is None:
+            return
+
+        # the old worker parts first, so two never answer in one channel
+        channel, hot, cold = move
+        self.log.info('channel_moving', channel=channel, worker=hot, to=cold,
+                      rate=self.rates[hot][channel], loads=loads)
+        self.moving[channel] = cold
+        self.send(hot, 'part', channel=channel)
+        # the move changes both loads; wait for fresh reports before another
+        self.rates.pop(hot, None)
+        self.rates.pop(cold, None)
+
+    def parted(self, worker, channel, ok):
+        cold = self.moving.pop(channel, None)
+        if cold is None:
+            return
+        if not ok:
+            # a meeting started since the worker last reported
+            self.log.info('channel_kept', channel=channel, worker=worker)
+            return
+        self.assignment[channel] = cold
+        self.save()
+        self.send(cold, 'join', channel=channel)
+        self.log.info('channel_moved', channel=channel, worker=worker, to=cold)
+
+    def stop(self):
+        self.stopping = True
+        for process in self.processes.values():
+            if process.returncode is None:
+                # not terminate(): irc3 only shuts plugins down on SIGINT
+                process.send_signal(signal.SIGINT)
+
+
+@irc3.plugin
+class Shard(object):
+    """The worker's end: joins and parts as told, and reports channel load."""
+
+    def __init__(self, bot):
+        bot.include('casemapping')
+        self.bot = bot
+        config = bot.config.get('shard', {})
+        self.worker = int(config['worker'])
+        self.port = int(config.get('port', 9106))
+        self.interval = float(config.get('interval', 10))
+        self.log = eventlog.EventLogger('rhythm.shard')
+        # what we've been given, casefolded -> as written
+        self.channels = {}
+        self.ready = False
+        self.counts = collections.Counter()
+        self.writer = None
+        self.bot.create_task(self.control())
+
+    def server_ready(self):
+        self.ready = True
+        for channel in self.channels.values():
+            self.bot.join(channel)
+
+    def connection_lost(self, client=None):
+        self.ready = False
+
+    @event(r'^:\S+ (PRIVMSG|NOTICE|JOIN|PART|KICK|MODE) :?(?P<channel>[#&]\S+)')
+    def count(self, channel=None):
+        self.counts[self.bot.casefold(channel)] += 1
+
+    @asyncio.coroutine
+    def control(self):
+        """Follow the coordinator's instructions; without it, stop."""
+        reader, self.writer = yield from asyncio.open_connection(
+            '127.0.0.1', self.port, loop=self.bot.loop)
+        self.send('hello', worker=self.worker)
+        self.bot.loop.call_later(self.interval, self.report)
+        while True:
+            line = yield from reader.readline()
+            if not line:
+                break
+            message = json.loads(line.decode('utf-8'))
+            channel = message['channel']
+            folded = self.bot.casefold(channel)
+            if message['op'] == 'join':
+                self.channels[folded] = channel
+                if self.ready:
+                    self.bot.join(channel)
+            elif message['op'] == 'part':
+                ok = channel not in self.busy()
+                if ok:
+                    self.channels.pop(folded, None)
+                    if self.ready:
+                        self.bot.part(channel)
+                self.send('parted', channel=channel, ok=ok)
+            self.log.info('shard_' + message['op'], channel=folded)
+
+        # another worker will get our channels when the coordinator restarts
+        self.log.warning('coordinator_lost')
+        # as on ctrl-c, so plugins get to write out what they hold
+        self.bot.SIGINT()
+
+    def send(self, op, **fields):
+        fields['op'] = op
+        self.writer.write(json.dumps(fields).encode('utf-8') + b'\n')
+
+    # the coordinator knows channels as they're written in the config
+    def report(self):
+        self.bot.loop.call_later(self.interval, self.report)
+        rates = dict((channel, self.counts[folded] / self.interval)
+                     for folded, channel in self.channels.items())
+        self.counts.clear()
+        self.send('load', rates=rates, busy=self.busy())
+
+    def busy(self):
+        """Our channels with a meeting going, which mustn't move."""
+        states = self.bot.get_plugin(Rhythm.Motions).states
+        return [channel for folded, channel in self.channels.items()
+                if folded in states and states[folded].meeting.started]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) not in (1, 3) or (len(argv) == 3 and argv[1] != '--worker'):
+        print('usage: python shard.py <config> [--worker <n>]')
+        return 1
+    config = irc3.utils.parse_config('bot', argv[0])
+
+    if len(argv) == 3:
+        bot = irc3.IrcBot.from_config(worker_config(config, int(argv[2])))
+        bot.run(forever=True)
+        return 0
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(eventlog.JSONFormatter())
+    logger = logging.getLogger('rhythm')
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    loop = asyncio.get_event_loop()
+    coordinator = Coordinator(argv[0], config, loop)
+    loop.run_until_complete(coordinator.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        coordinator.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
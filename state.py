@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""What the bot knows about each channel's meeting and motion.
+
+Every channel the bot is in has a :class:`ChannelState`, which is read on
+every message and vote, so these are small ``__slots__`` classes rather than
+nested dicts. ``dump`` and ``load`` turn them into and out of the plain dicts
+:mod:`statelog` saves.
+"""
+import collections
+
+import tally
+
+
+class Meeting(object):
+
+    __slots__ = ('id', 'name', 'started', 'quorum', 'link')
+
+    def __init__(self, id='', name='', started=False, quorum=0, link=''):
+        self.id = id
+        self.name = name
+        self.started = started
+        self.quorum = quorum
+        # the channel a linked meeting is run from, this one included; '' if not linked
+        self.link = link
+
+    def dump(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'started': self.started,
+            'quorum': self.quorum,
+            'link': self.link,
+        }
+
+    @classmethod
+    def load(cls, saved):
+        return cls(**saved)
+
+
+class Motion(object):
+
+    __slots__ = ('text', 'put_by', 'started', 'extra_ayes', 'extra_nays', 'closes_at', 'tally',
+                 'keys', 'rejected', 'suppressed')
+
+    def __init__(self, text='', put_by='', started=False, extra_ayes=0, extra_nays=0,
+                 closes_at=0):
+        self.text = text
+        self.put_by = put_by
+        self.started = started
+        # votes cast outside the channel, set by ops
+        self.extra_ayes = extra_ayes
+        self.extra_nays = extra_nays
+        # unix time a timed motion closes by itself; 0 if it waits for !stop
+        self.closes_at = closes_at
+        self.tally = tally.Tally()
+        # nick -> [who cast that vote across linked channels, their user@host,
+        # and when]; kept with the votes, since after a restart the userlist
+        # can't say who they were, nor the tallies which vote was last
+        self.keys = tally.EMPTY
+        # not kept across restarts: nicks told they can't vote on this
+        # motion, and how many votes were ignored, by reason; None until
+        # the first, as most motions have none
+        self.rejected = None
+        self.suppressed = None
+
+    def keep_key(self, nick, key, when):
+        """Remember who cast ``nick``'s vote, and when."""
+        if self.keys is tally.EMPTY:
+            self.keys = {}
+        self.keys[nick] = [key, when]
+
+    def reject(self, nick):
+        """Remember telling ``nick`` they can't vote; False if they were told already."""
+        if self.rejected is None:
+            self.rejected = set()
+        elif nick in self.rejected:
+            return False
+        self.rejected.add(nick)
+        return True
+
+    def suppress(self, reason):
+        """Count a vote ignored for ``reason``."""
+        if self.suppressed is None:
+            self.suppressed = collections.Counter()
+        self.suppressed[reason] += 1
+
+    def header(self):
+        """Everything but the votes."""
+        return {
+            'text': self.text,
+            'put_by': self.put_by,
+            'started': self.started,
+            'extra_ayes': self.extra_ayes,
+            'extra_nays': self.extra_nays,
+            'closes_at': self.closes_at,
+        }
+
+    def dump(self):
+        saved = self.header()
+        saved.update(self.tally.dump())
+        saved['keys'] = dict(self.keys)
+        return saved
+
+    @classmethod
+    def load(cls, saved):
+        saved = dict(saved)
+        votes = saved.pop('votes', {})
+        departed = saved.pop('departed', {})
+        ballots = saved.pop('ballots', {})
+        keys = saved.pop('keys', {})
+        motion = cls(**saved)
+        motion.tally = tally.Tally.load(votes, departed, ballots)
+        if keys:
+            motion.keys = keys
+        return motion
+
+
+class Link(object):
+    """Channels sharing one meeting, motion and tally, run from ``home``."""
+
+    __slots__ = ('home', 'channels', 'tally')
+
+    def __init__(self, home):
+        self.home = home
+        self.channels = set()
+        self.tally = tally.LinkedTally()
+
+    def new_motion(self):
+        """Forget the last motion's votes, all at once."""
+        self.tally = tally.LinkedTally()
+
+
+class ChannelState(object):
+
+    __slots__ = ('recognised', 'meeting', 'motion')
+
+    def __init__(self, meeting=None, motion=None):
+        # normalised user@hosts who are voiced on join
+        self.recognised = set()
+        self.meeting = meeting or Meeting()
+        self.motion = motion or Motion()
+
+    def dump(self):
+        """Return the meeting and motion as plain, JSON-friendly dicts."""
+        return {'meeting': self.meeting.dump(), 'motion': self.motion.dump()}
+
+    @classmethod
+    def load(cls, saved):
+        return cls(Meeting.load(saved['meeting']), Motion.load(saved['motion']))
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Crash-safe storage for the bot's per-channel meeting state.
+
+State is kept as a compact snapshot plus a write-ahead log of the changes
+made since. Each change is appended to the log as one JSON line as it
+happens; every so often the whole state is written to a new snapshot and
+the log is started afresh. On startup the snapshot is loaded and the log
+replayed over it, and the result written as a new snapshot, so the bot
+starts with a clean log rather than appending after a line the crash cut
+short.
+
+Both work on plain, JSON-friendly channel dicts::
+
+    {
+        'meeting': {'id': ..., 'name': ..., 'started': ..., 'quorum': ...,
+                    'link': ...},
+        'motion': {'text': ..., 'put_by': ..., 'started': ...,
+                   'extra_ayes': ..., 'extra_nays': ..., 'closes_at': ...,
+                   'votes': {nick: choice}, 'departed': {nick: choice},
+                   'ballots': {delegate: choice}, 'keys': {nick: [user@host, when]}},
+    }
+"""
+import json
+import os
+
+SNAPSHOT = 'snapshot.json'
+WAL = 'wal.jsonl'
+OLD_WAL = 'wal.old.jsonl'
+
+
+def empty_motion():
+    return {
+        'text': '',
+        'put_by': '',
+        'started': False,
+        'extra_ayes': 0,
+        'extra_nays': 0,
+        'closes_at': 0,
+        'votes': {},
+        'departed': {},
+        'ballots': {},
+        'keys': {},
+    }
+
+
+def apply(channels, entry):
+    """Apply one log entry to a dict of channel states."""
+    op = entry['op']
+    state = channels.setdefault(entry['channel'], {
+        'meeting': {'id': '', 'name': '', 'started': False, 'quorum': 0, 'link': ''},
+        'motion': empty_motion(),
+    })
+    motion = state['motion']
+    # saved before there were ballots, or voters' keys
+    ballots = motion.setdefault('ballots', {})
+    keys = motion.setdefault('keys', {})
+
+    if op == 'meeting':
+        state['meeting'] = entry['meeting']
+    elif op == 'motion':
+        if entry.get('reset'):
+            state['motion'] = motion = empty_motion()
+        motion.update(entry['motion'])
+    elif op == 'vote':
+        ballots.pop(entry['nick'], None)
+        motion['departed'].pop(entry['nick'], None)
+        motion['votes'][entry['nick']] = entry['choice']
+        if 'key' in entry:
+            keys[entry['nick']] = [entry['key'], entry['when']]
+    elif op == 'ballots':
+        for delegate, choice in entry['ballots'].items():
+            if delegate not in motion['votes']:
+                ballots[delegate] = choice
+    elif op == 'depart':
+        if entry['nick'] in motion['votes']:
+            motion['departed'][entry['nick']] = motion['votes'].pop(entry['nick'])
+    elif op == 'rejoin':
+        if entry['nick'] in motion['departed']:
+            ballots.pop(entry['nick'], None)
+            motion['votes'][entry['nick']] = motion['departed'].pop(entry['nick'])
+    elif op == 'rename':
+        if entry['nick'] in motion['votes']:
+            ballots.pop(entry['new_nick'], None)
+        for votes in (motion['votes'], motion['departed'], keys):
+            if entry['nick'] in votes:
+                votes[entry['new_nick']] = votes.pop(entry['nick'])
+
+
+class StateLog(object):
+    """Snapshot and write-ahead log kept in one directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.seq = 0
+        self.wal = None
+        self.dirty = False
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def restore(self):
+        """Load the snapshot and replay the log over it; returns the channels.
+
+        Blocking; call it before the loop starts.
+        """
+        channels = {}
+        seq = 0
+        try:
+            with open(self.path(SNAPSHOT), encoding='utf-8') as fd:
+                snapshot = json.load(fd)
+            channels = snapshot['channels']
+            seq = snapshot['seq']
+        except FileNotFoundError:
+            pass
+
+        self.seq = seq
+        logs = [name for name in (OLD_WAL, WAL) if os.path.exists(self.path(name))]
+        for name in logs:
+            for entry in self._read(self.path(name)):
+                # a crash while folding the logs together leaves some entries in both
+                if entry['seq'] > self.seq:
+                    apply(channels, entry)
+                    self.seq = entry['seq']
+        if logs:
+            self.write_snapshot(self.seq, channels)
+            try:
+                os.remove(self.path(WAL))
+            except FileNotFoundError:
+                pass
+        return channels
+
+    def _read(self, path):
+        try:
+            fd = open(path, encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with fd:
+            for line in fd:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # a line cut short by the crash; nothing after it was written
+                    return
+
+    def append(self, channel, op, **fields):
+        """Log a change to a channel's state."""
+        if self.wal is None:
+            self.wal = open(self.path(WAL), 'a', encoding='utf-8')
+        self.seq += 1
+        fields.update(seq=self.seq, channel=channel, op=op)
+        self.wal.write(json.dumps(fields) + '\n')
+        # flushed to the os, so it survives the bot dying; fsync is periodic
+        self.wal.flush()
+        self.dirty = True
+
+    def sync(self):
+        """fsync the log. Blocking; run it in an executor."""
+        wal = self.wal
+        if wal is not None:
+            try:
+                os.fsync(wal.fileno())
+            except (OSError, ValueError):
+                # rotated away underneath us; the snapshot covers it
+                pass
+
+    def rotate(self):
+        """Start a new log, returning the sequence number the snapshot covers.
+
+        Call this on the loop, immediately before serialising the state, so
+        that no change can fall between the two.
+        """
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+        if os.path.exists(self.path(WAL)):
+            if os.path.exists(self.path(OLD_WAL)):
+                # the last snapshot never made it to disk; keep both logs
+                with open(self.path(OLD_WAL), 'a', encoding='utf-8') as old, \
+                        open(self.path(WAL), encoding='utf-8') as new:
+                    old.write(new.read())
+                os.remove(self.path(WAL))
+            else:
+                os.replace(self.path(WAL), self.path(OLD_WAL))
+        self.dirty = False
+        return self.seq
+
+    def write_snapshot(self, seq, channels):
+        """Durably write a snapshot and drop the log it supersedes. Blocking."""
+        tmp = self.path(SNAPSHOT + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as fd:
+            json.dump({'seq': seq, 'channels': channels}, fd, separators=(',', ':'))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp, self.path(SNAPSHOT))
+        try:
+            os.remove(self.path(OLD_WAL))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+"""Persistence backends for the recognised-user lists.
+
+Reads are coroutines which run the blocking driver call in an executor, so
+the irc3 loop never waits on a database round trip. Writes are queued and
+flushed in batches shortly afterwards (write-behind), and whatever is still
+queued when the bot stops is written out then.
+
+The backend is picked from the scheme of the ``database`` uri::
+
+    mongodb://localhost:27017/
+    sqlite:///var/lib/rhythm/rhythm.db
+    memory://
+
+Each channel's list has a version, bumped by every write. Stores which can
+be shared between bots (sqlite and mongodb) poll the versions, so a list
+changed by another bot, such as another worker of a sharded bot, is reloaded
+within ``poll_interval`` seconds.
+
+Every backend call goes through a :class:`CircuitBreaker`. When the database
+stops answering, calls fail fast with :class:`StoreUnavailable` instead of
+tying up the executor; reads are left to the caller's in-memory copy, and
+writes wait in a bounded queue until a periodic probe finds the database
+back, when they are replayed.
+"""
+import asyncio
+import concurrent.futures
+import sqlite3
+import time
+
+import eventlog
+import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class StoreUnavailable(Exception):
+    """The store can't be reached, or the breaker is open."""
+
+
+class CircuitBreaker(object):
+    """Stops calling a failing backend until it has had time to recover.
+
+    While closed, calls go through; ``threshold`` failures in a row open it.
+    While open, calls are refused until ``reset_timeout`` seconds have
+    passed, then one is let through as a probe (half-open). The breaker
+    closes if the probe works and opens again if it doesn't.
+    """
+
+    def __init__(self, threshold, reset_timeout, clock):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+
+    def allow(self):
+        """Whether a call may go ahead now."""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and self.retry_in() == 0:
+            self.state = HALF_OPEN
+            return True
+        return False
+
+    def retry_in(self):
+        """Seconds until the breaker lets a probe through."""
+        if self.state == CLOSED:
+            return 0
+        return max(0, self.opened_at + self.reset_timeout - self.clock())
+
+    def succeeded(self):
+        """Record a working call; returns True if the breaker just closed."""
+        recovered = self.state != CLOSED
+        self.state = CLOSED
+        self.failures = 0
+        return recovered
+
+    def failed(self, error):
+        """Record a failed call; returns True if the breaker just opened."""
+        self.failures += 1
+        self.last_error = error
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+            opened = self.state == CLOSED
+            self.state = OPEN
+            self.opened_at = self.clock()
+            return opened
+        return False
+
+
+class Store(object):
+    """Base class for stores.
+
+    Subclasses implement the blocking ``_get_recognised``, ``_write_recognised``
+    and ``_close`` methods; this class takes care of running them off the loop
+    and of batching writes.
+    """
+
+    # seconds to wait before writing queued updates
+    flush_delay = 0.5
+    # whether other bots may write to the same lists
+    shared = True
+
+    def __init__(self, name, loop=None, executor=None, timeout=5, threshold=3,
+                 reset_timeout=30, max_pending=10000, poll_interval=10):
+        self.name = name
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = executor
+        self.listeners = []
+        self._pending = {}
+        self._flush_handle = None
+        # batches being written; a list read meanwhile may not show them yet
+        self._flushing = []
+        # channel -> version of the list we last read
+        self.versions = {}
+        self.poll_interval = poll_interval
+        self._poll_handle = None
+        if self.shared and poll_interval:
+            self._poll_handle = self.loop.call_later(poll_interval, self._poll_later)
+
+        # seconds a backend call may take before it counts as failed
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(threshold, reset_timeout, clock=self.loop.time)
+        self._probe_handle = None
+        # most queued writes to hold while the store is down; more are dropped
+        self.max_pending = max_pending
+        self.dropped = 0
+        # channels whose list couldn't be read; reloaded on recovery
+        self.stale = set()
+        self.log = eventlog.EventLogger('rhythm.storage')
+
+    def run(self, func, *args):
+        """Run a blocking call in the executor, returning a future."""
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    @asyncio.coroutine
+    def call(self, func, *args):
+        """Run a backend call through the circuit breaker, with a timeout."""
+        if not self.breaker.allow():
+            raise StoreUnavailable(self.breaker.last_error)
+        start = time.perf_counter()
+        try:
+            result = yield from asyncio.wait_for(self.run(func, *args), self.timeout)
+        except Exception as exc:
+            self._failed(exc)
+            raise StoreUnavailable(exc)
+        finally:
+            metrics.store_seconds.observe(time.perf_counter() - start, func.__name__)
+        self._succeeded()
+        return result
+
+    def status(self):
+        return {
+            'state': self.breaker.state,
+            'failures': self.breaker.failures,
+            'retry_in': self.breaker.retry_in(),
+            'last_error': str(self.breaker.last_error or ''),
+            'queued': self.queued(),
+            'dropped': self.dropped,
+        }
+
+    def queued(self):
+        """Number of writes waiting to be flushed."""
+        return sum(len(users) for users in self._pending.values())
+
+    @asyncio.coroutine
+    def get_recognised(self, channel):
+        """Return the list of recognised userhosts for a channel.
+
+        Raises :class:`StoreUnavailable` if the store can't be read; the
+        channel's subscribers are told to reload it once it can.
+        """
+        try:
+            users, self.versions[channel] = yield from self.call(self._get_recognised, channel)
+        except StoreUnavailable:
+            self.stale.add(channel)
+            raise
+        # writes which haven't landed yet are still ours to see; those being
+        # written first, then those queued since, so the latest wins
+        pending = {}
+        for batch in self._flushing + [self._pending]:
+            pending.update(batch.get(channel, {}))
+        users = [u for u in users if pending.get(u, True)]
+        for userhost, added in pending.items():
+            if added and userhost not in users:
+                users.append(userhost)
+        return users
+
+    def push_recognised(self, channel, *userhosts):
+        """Queue userhosts to be appended to a channel's recognised list."""
+        self._queue(channel, userhosts, True)
+
+    def pull_recognised(self, channel, *userhosts):
+        """Queue userhosts to be removed from a channel's recognised list."""
+        self._queue(channel, userhosts, False)
+
+    def _queue(self, channel, userhosts, added):
+        pending = self._pending.setdefault(channel, {})
+        room = self.max_pending - self.queued()
+        for userhost in userhosts:
+            if userhost not in pending and room <= 0:
+                self.dropped += 1
+                self.log.warning('write_dropped', channel=channel, userhost=userhost)
+                continue
+            room -= userhost not in pending
+            pending[userhost] = added
+        self._schedule_flush()
+
+    def subscribe(self, callback):
+        """Call ``callback(channel)`` whenever a channel's list changes elsewhere."""
+        self.listeners.append(callback)
+
+    def changed(self, channel):
+        """Tell subscribers that a channel's list was changed by another writer,
+        or couldn't be read before."""
+        for callback in self.listeners:
+            callback(channel)
+
+    def _schedule_flush(self):
+        # while the store is down, the probe replays writes when it's back
+        if self._flush_handle is None and self.breaker.state == CLOSED:
+            self._flush_handle = self.loop.call_later(self.flush_delay, self._flush_later)
+
+    def _flush_later(self):
+        self._flush_handle = None
+        self.loop.create_task(self.flush())
+
+    @asyncio.coroutine
+    def flush(self):
+        """Write out every queued update in one batch."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, {}
+        if pending:
+            self._flushing.append(pending)
+            try:
+                yield from self.call(self._write_recognised, self._updates(pending))
+            except StoreUnavailable:
+                self._requeue(pending)
+            finally:
+                self._flushing.remove(pending)
+
+    @staticmethod
+    def _updates(pending):
+        # collapse to what each channel gains and loses; the last write wins
+        updates = {}
+        for channel, users in pending.items():
+            updates[channel] = (
+                [u for u, added in users.items() if added],
+                [u for u, added in users.items() if not added],
+            )
+        return updates
+
+    def _requeue(self, pending):
+        """Put writes which failed back in the queue, under any made since."""
+        for channel, users in pending.items():
+            users.update(self._pending.get(channel, {}))
+            self._pending[channel] = users
+        self._schedule_flush()
+
+    def _poll_later(self):
+        self._poll_handle = self.loop.call_later(self.poll_interval, self._poll_later)
+        self.loop.create_task(self.poll())
+
+    @asyncio.coroutine
+    def poll(self):
+        """Reload the lists we've read which another writer has changed since.
+
+        Our own writes bump the version too, so each is read back once; that's
+        one read per batch of ``!add``, and it picks up anything written
+        alongside it.
+        """
+        if not self.versions:
+            return
+        try:
+            versions = yield from self.call(self._get_versions)
+        except StoreUnavailable:
+            # recovery reloads anything we couldn't read; nothing more to do
+            return
+        for channel, seen in list(self.versions.items()):
+            version = versions.get(channel, 0)
+            if version != seen:
+                # so a slow reload isn't asked for again
+                self.versions[channel] = version
+                self.changed(channel)
+
+    # health
+    def _failed(self, error):
+        if self.breaker.failed(error):
+            self.log.warning('store_unavailable', error=str(error),
+                             retry_in=self.breaker.reset_timeout)
+        if self.breaker.state == OPEN:
+            self._schedule_probe()
+
+    def _succeeded(self):
+        if not self.breaker.succeeded():
+            return
+        self.log.info('store_recovered', queued=self.queued(), stale=len(self.stale))
+        if self._probe_handle is not None:
+            self._probe_handle.cancel()
+            self._probe_handle = None
+        # replay what was written while we were down, and re-read what we couldn't
+        if self._pending:
+            self._schedule_flush()
+        stale, self.stale = self.stale, set()
+        for channel in stale:
+            self.changed(channel)
+
+    def _schedule_probe(self):
+        if self._probe_handle is None:
+            self._probe_handle = self.loop.call_later(self.breaker.retry_in(), self._probe_later)
+
+    def _probe_later(self):
+        self._probe_handle = None
+        self.loop.create_task(self.probe())
+
+    @asyncio.coroutine
+    def probe(self):
+        """Check whether the store is reachable; reopens or closes the breaker."""
+        try:
+            yield from self.call(self._ping)
+        except StoreUnavailable:
+            if self.breaker.state != CLOSED:
+                self._schedule_probe()
+            return False
+        return True
+
+    @asyncio.coroutine
+    def close(self):
+        yield from self.flush()
+        yield from self.run(self._close)
+
+    def shutdown(self):
+        """Write out queued updates and close, blocking; for when the loop is stopping."""
+        for handle in (self._flush_handle, self._probe_handle, self._poll_handle):
+            if handle is not None:
+                handle.cancel()
+        self._flush_handle = self._probe_handle = self._poll_handle = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            try:
+                self._write_recognised(self._updates(pending))
+            except Exception as exc:
+                self.log.error('writes_lost', queued=sum(len(u) for u in pending.values()),
+                               error=str(exc))
+        self._close()
+
+    # backend api
+    def _ping(self):
+        """Raise if the backend can't be reached."""
+
+    def _get_recognised(self, channel):
+        """Return a channel's ``(userhosts, version)``."""
+        raise NotImplementedError
+
+    def _get_versions(self):
+        """Return ``{channel: version}`` for every channel with a list."""
+        raise NotImplementedError
+
+    def _write_recognised(self, updates):
+        """Apply ``{channel: (added, removed)}`` to the backend, bumping each
+        channel's version."""
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+
+class MemoryStore(Store):
+    """Keeps everything in a dict. Useful for tests and throwaway bots."""
+
+    # nobody else can see the dict, so there's nothing to poll for
+    shared = False
+
+    def __init__(self, name, loop=None, **options):
+        super(MemoryStore, self).__init__(name, loop=loop, **options)
+        self.recognised = {}
+        self.list_versions = {}
+
+    def run(self, func, *args):
+        # nothing here blocks, so skip the executor entirely
+        future = asyncio.Future(loop=self.loop)
+        try:
+            future.set_result(func(*args))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    def _get_recognised(self, channel):
+        return list(self.recognised.get(channel, ())), self.list_versions.get(channel, 0)
+
+    def _get_versions(self):
+        return dict(self.list_versions)
+
+    def _write_recognised(self, updates):
+        for channel, (added, removed) in updates.items():
+            users = self.recognised.setdefault(channel, [])
+            users[:] = [u for u in users if u not in removed]
+            # a batch replayed after a timeout mustn't add anyone twice
+            users.extend(u for u in added if u not in users)
+            self.list_versions[channel] = self.list_versions.get(channel, 0) + 1
+
+
+class SQLiteStore(Store):
+    """Stores recognised lists in a local SQLite file."""
+
+    def __init__(self, name, path, loop=None, **options):
+        # sqlite connections belong to one thread, so use exactly one
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        super(SQLiteStore, self).__init__(name, loop=loop, executor=executor, **options)
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS recognised ('
+                '  bot TEXT NOT NULL,'
+                '  channel TEXT NOT NULL,'
+                '  userhost TEXT NOT NULL,'
+                '  PRIMARY KEY (bot, channel, userhost))'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS versions ('
+                '  bot TEXT NOT NULL,'
+                '  channel TEXT NOT NULL,'
+                '  version INTEGER NOT NULL,'
+                '  PRIMARY KEY (bot, channel))'
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _ping(self):
+        self.conn.execute('SELECT 1')
+
+    def _get_recognised(self, channel):
+        # the version first: a write landing in between makes us read it twice,
+        # never miss it
+        row = self.conn.execute(
+            'SELECT version FROM versions WHERE bot = ? AND channel = ?',
+            (self.name, channel),
+        ).fetchone()
+        rows = self.conn.execute(
+            'SELECT userhost FROM recognised WHERE bot = ? AND channel = ? ORDER BY rowid',
+            (self.name, channel),
+        )
+        return [row[0] for row in rows], row[0] if row else 0
+
+    def _get_versions(self):
+        return dict(self.conn.execute(
+            'SELECT channel, version FROM versions WHERE bot = ?', (self.name,)))
+
+    def _write_recognised(self, updates):
+        with self.conn:
+            self.conn.executemany(
+                'DELETE FROM recognised WHERE bot = ? AND channel = ? AND userhost = ?',
+                [(self.name, channel, userhost)
+                 for channel, (added, removed) in updates.items()
+                 for userhost in removed],
+            )
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO recognised (bot, channel, userhost) VALUES (?, ?, ?)',
+                [(self.name, channel, userhost)
+                 for channel, (added, removed) in updates.items()
+                 for userhost in added],
+            )
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO versions (bot, channel, version) VALUES (?, ?, 0)',
+                [(self.name, channel) for channel in updates],
+            )
+            self.conn.executemany(
+                'UPDATE versions SET version = version + 1 WHERE bot = ? AND channel = ?',
+                [(self.name, channel) for channel in updates],
+            )
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class MongoStore(Store):
+    """Stores recognised lists in MongoDB, one document per channel."""
+
+    def __init__(self, name, uri, loop=None, **options):
+        from pymongo import MongoClient
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        super(MongoStore, self).__init__(name, loop=loop, executor=executor, **options)
+        # give up on an unreachable server about when the breaker would
+        timeout_ms = int(self.timeout * 1000)
+        self.client = MongoClient(uri, serverSelectionTimeoutMS=timeout_ms,
+                                  connectTimeoutMS=timeout_ms, socketTimeoutMS=timeout_ms)
+        self.db = self.client.motionbot
+
+    def _ping(self):
+        self.client.admin.command('ping')
+
+    def _get_recognised(self, channel):
+        doc = self.db.recognised.find_one({
+            'bot': self.name,
+            'channel': channel,
+        })
+
+        if doc:
+            return doc['users'], doc.get('version', 0)
+
+        self.db.recognised.insert_one({
+            'bot': self.name,
+            'channel': channel,
+            'users': [],
+            'version': 0,
+        })
+        return [], 0
+
+    def _get_versions(self):
+        docs = self.db.recognised.find({'bot': self.name}, {'channel': True, 'version': True})
+        return dict((doc['channel'], doc.get('version', 0)) for doc in docs)
+
+    def _write_recognised(self, updates):
+        from pymongo import UpdateOne
+
+        requests = []
+        for channel, (added, removed) in updates.items():
+            query = {
+                'bot': self.name,
+                'channel': channel,
+            }
+            # $pull and $addToSet can't touch the same field in one update
+            if removed:
+                requests.append(UpdateOne(query, {
+                    '$pull': {
+                        'users': {'$in': removed},
+                    },
+                    '$inc': {'version': 1},
+                }))
+            if added:
+                # a set, so a batch replayed after a timeout adds nobody twice
+                requests.append(UpdateOne(query, {
+                    '$addToSet': {
+                        'users': {'$each': added},
+                    },
+                    '$inc': {'version': 1},
+                }, upsert=True))
+
+        self.db.recognised.bulk_write(requests)
+
+    def _close(self):
+        self.client.close()
+
+
+def from_uri(uri, name, loop=None, **options):
+    """Return the store for the given database uri.
+
+    ``options`` are the :class:`Store` circuit breaker and queue settings.
+    """
+    scheme, _, path = uri.partition('://')
+
+    if scheme == 'memory':
+        return MemoryStore(name, loop=loop, **options)
+    elif scheme == 'sqlite':
+        return SQLiteStore(name, path or ':memory:', loop=loop, **options)
+    elif scheme.startswith('mongodb'):
+        return MongoStore(name, uri, loop=loop, **options)
+
+    raise ValueError('Unknown database uri: {}'.format(uri))
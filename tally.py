@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""Running vote counts for a motion.
+
+The tally is updated as votes are cast and as voters change nick, leave or
+come back, so reading the counts never needs a pass over every vote. Only
+the list of who voted which way, wanted once when the motion stops, does.
+
+Ballots cast outside the channel are counted alongside, keyed by delegate
+name. Someone who votes in the channel is only counted once: their channel
+vote replaces any ballot under the same name.
+
+A meeting linked across channels keeps a :class:`LinkedTally` as well, fed
+the same changes as each channel's tally, which counts each voter once
+across all of them.
+"""
+import types
+
+from votematch import AYE, NAY, ABSTAIN, NAMES, Vote
+
+CHOICES = (AYE, NAY, ABSTAIN)
+# what a tally has until someone leaves after voting, or a ballot is cast;
+# most motions see neither, so they share these rather than each have their own
+EMPTY = types.MappingProxyType({})
+NO_BALLOTS = (0,) * len(CHOICES)
+
+
+class Tally(object):
+    """Votes for one motion, grouped by choice.
+
+    .. code-block:: python
+
+        >>> tally = Tally()
+        >>> tally.cast('alice', AYE)
+        >>> tally.cast('bob', NAY)
+        >>> tally.cast('bob', AYE)
+        >>> tally.count(AYE), tally.count(NAY)
+        (2, 0)
+        >>> tally.depart('alice')
+        >>> tally.count(AYE)
+        1
+        >>> tally.rejoin('alice')
+        >>> tally.voters(AYE)
+        ['alice', 'bob']
+        >>> tally.cast_ballot('carol', NAY), tally.cast_ballot('bob', NAY)
+        (True, False)
+        >>> tally.count(NAY)
+        1
+    """
+
+    __slots__ = ('votes', 'departed', 'ballots', 'counts', 'ballot_tally')
+
+    def __init__(self):
+        # nick -> choice, for voters still in the channel
+        self.votes = {}
+        # nick -> choice, for voters who left; their votes don't count
+        self.departed = EMPTY
+        # delegate -> choice, for ballots cast outside the channel
+        self.ballots = EMPTY
+        # indexed by choice; the ballots' share of counts kept apart too
+        self.counts = [0] * len(CHOICES)
+        self.ballot_tally = NO_BALLOTS
+
+    def cast(self, nick, choice):
+        previous = self.votes.get(nick)
+        if previous == choice:
+            return
+        if previous is not None:
+            self.counts[previous] -= 1
+        elif self.ballots:
+            # only someone yet to vote in the channel can have a ballot
+            ballot = self.ballots.pop(nick, None)
+            if ballot is not None:
+                self.counts[ballot] -= 1
+                self.ballot_tally[ballot] -= 1
+        if self.departed:
+            self.departed.pop(nick, None)
+        self.votes[nick] = choice
+        self.counts[choice] += 1
+
+    def cast_ballot(self, delegate, choice):
+        """Count a ballot, replacing any earlier one from ``delegate``.
+
+        Returns False, counting nothing, if ``delegate`` has voted in the
+        channel; that vote stands.
+        """
+        if delegate in self.votes:
+            return False
+        if self.ballots is EMPTY:
+            self.ballots = {}
+            self.ballot_tally = list(NO_BALLOTS)
+        previous = self.ballots.get(delegate)
+        if previous is not None:
+            self.counts[previous] -= 1
+            self.ballot_tally[previous] -= 1
+        self.ballots[delegate] = choice
+        self.counts[choice] += 1
+        self.ballot_tally[choice] += 1
+        return True
+
+    def depart(self, nick):
+        choice = self.votes.pop(nick, None)
+        if choice is not None:
+            self.counts[choice] -= 1
+            if self.departed is EMPTY:
+                self.departed = {}
+            self.departed[nick] = choice
+
+    def rejoin(self, nick):
+        if nick in self.departed:
+            self.cast(nick, self.departed.pop(nick))
+
+    def rename(self, nick, new_nick):
+        if nick in self.votes:
+            self.votes[new_nick] = self.votes.pop(nick)
+            if new_nick in self.ballots:
+                ballot = self.ballots.pop(new_nick)
+                self.counts[ballot] -= 1
+                self.ballot_tally[ballot] -= 1
+        elif nick in self.departed:
+            self.departed[new_nick] = self.departed.pop(nick)
+
+    def dump(self):
+        """Return the votes with choices by name, for saving."""
+        return {
+            'votes': dict((nick, NAMES[choice]) for nick, choice in self.votes.items()),
+            'departed': dict((nick, NAMES[choice]) for nick, choice in self.departed.items()),
+            'ballots': dict((name, NAMES[choice]) for name, choice in self.ballots.items()),
+        }
+
+    @classmethod
+    def load(cls, votes, departed, ballots=None):
+        tally = cls()
+        for delegate, choice in (ballots or {}).items():
+            tally.cast_ballot(delegate, int(Vote.parse(choice)))
+        for nick, choice in votes.items():
+            tally.cast(nick, int(Vote.parse(choice)))
+        if departed:
+            tally.departed = dict(
+                (nick, int(Vote.parse(choice))) for nick, choice in departed.items())
+        return tally
+
+    def count(self, choice):
+        return self.counts[choice]
+
+    def voters(self, choice):
+        """Return the sorted nicks which voted ``choice``."""
+        return sorted(nick for nick, vote in self.votes.items() if vote == choice)
+
+    def ballot_counts(self):
+        """Return how many ballots there are for each choice, indexed by choice."""
+        return list(self.ballot_tally)
+
+    def __len__(self):
+        return len(self.votes)
+
+
+class LinkedTally(object):
+    """Votes from several channels, counting each voter once.
+
+    Voters are told apart by a key, their recognised ``user@host``, so the
+    same person voting in two channels, under any nick, counts once, with
+    the vote they cast last. Their vote counts while they're in any of the
+    channels they voted in. Votes may be given the time they were cast,
+    so that which was last survives rebuilding the tally after a restart.
+
+    .. code-block:: python
+
+        >>> linked = LinkedTally()
+        >>> linked.cast('#north', 'alice', 'alice@home', AYE)
+        >>> linked.cast('#south', 'alice_', 'alice@home', NAY)
+        >>> linked.cast('#south', 'bob', 'bob@work', AYE)
+        >>> linked.count(AYE), linked.count(NAY)
+        (1, 1)
+        >>> linked.depart('#south', 'alice_')
+        >>> linked.count(AYE), linked.count(NAY)
+        (2, 0)
+        >>> linked.rename('#south', 'alice_', 'alice')
+        >>> linked.rejoin('#south', 'alice')
+        >>> linked.count(AYE), linked.count(NAY)
+        (1, 1)
+        >>> linked.drop_channel('#south')
+        >>> linked.count(AYE), linked.count(NAY)
+        (1, 0)
+    """
+
+    __slots__ = ('entries', 'voters', 'choices', 'counts', 'seq')
+
+    def __init__(self):
+        # (channel, nick) -> [key, choice, (when cast, seq), still in the channel]
+        self.entries = {}
+        # key -> the (channel, nick) entries it has
+        self.voters = {}
+        # key -> the choice counted for it, for voters who count
+        self.choices = {}
+        self.counts = [0] * len(CHOICES)
+        self.seq = 0
+
+    def _recount(self, key):
+        """Count ``key`` by its latest vote still present; one voter's few entries."""
+        previous = self.choices.pop(key, None)
+        if previous is not None:
+            self.counts[previous] -= 1
+        latest = None
+        for name in self.voters.get(key, ()):
+            entry = self.entries[name]
+            if entry[3] and (latest is None or entry[2] > latest[2]):
+                latest = entry
+        if latest is not None:
+            self.choices[key] = latest[1]
+            self.counts[latest[1]] += 1
+
+    def cast(self, channel, nick, key, choice, when=0):
+        name = (channel, nick)
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] != key:
+            self.discard(channel, nick)
+            entry = None
+        self.seq += 1
+        if entry is None:
+            self.entries[name] = [key, choice, (when, self.seq), True]
+            self.voters.setdefault(key, set()).add(name)
+        else:
+            entry[1:] = [choice, (when, self.seq), True]
+        self._recount(key)
+
+    def _present(self, channel, nick, present):
+        entry = self.entries.get((channel, nick))
+        if entry is not None and entry[3] != present:
+            entry[3] = present
+            self._recount(entry[0])
+
+    def depart(self, channel, nick):
+        self._present(channel, nick, False)
+
+    def rejoin(self, channel, nick):
+        self._present(channel, nick, True)
+
+    def rename(self, channel, nick, new_nick):
+        entry = self.entries.pop((channel, nick), None)
+        if entry is None:
+            return
+        self.discard(channel, new_nick)
+        names = self.voters[entry[0]]
+        names.discard((channel, nick))
+        names.add((channel, new_nick))
+        self.entries[(channel, new_nick)] = entry
+
+    def discard(self, channel, nick):
+        entry = self.entries.pop((channel, nick), None)
+        if entry is None:
+            return
+        names = self.voters[entry[0]]
+        names.discard((channel, nick))
+        if not names:
+            del self.voters[entry[0]]
+        self._recount(entry[0])
+
+    def drop_channel(self, channel):
+        """Forget every vote from ``channel``."""
+        for name in [name for name in self.entries if name[0] == channel]:
+            self.discard(*name)
+
+    def count(self, choice):
+        return self.counts[choice]
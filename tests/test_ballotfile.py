@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from irc3.testing import IrcBot
+
+import ballotfile
+import Rhythm
+from votematch import AYE, NAY, ABSTAIN, VoteMatcher
+
+CSV = '''delegate,vote
+alice,aye
+bob
+carol,maybe
+,nay
+dave,Nay
+'''
+
+JSONL = '''{"delegate": "alice", "vote": "aye"}
+not json
+
+["bob", "nay"]
+{"delegate": "carol"}
+{"delegate": "dave", "vote": "abstain"}
+'''
+
+
+class BallotReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='rhythm-ballots-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.matcher = VoteMatcher()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as fd:
+            fd.write(text)
+        return path
+
+    def read_all(self, path, size=2):
+        reader = ballotfile.BallotReader(path, self.matcher)
+        self.addCleanup(reader.close)
+        ballots = []
+        while not reader.done:
+            ballots.extend(reader.read(size))
+        return ballots, reader.invalid
+
+    def test_csv_skips_bad_rows(self):
+        ballots, invalid = self.read_all(self.write('ballots.csv', CSV))
+        self.assertEqual(ballots, [('alice', AYE), ('dave', NAY)])
+        self.assertEqual(invalid, 3)
+
+    def test_jsonl_skips_bad_lines(self):
+        ballots, invalid = self.read_all(self.write('ballots.jsonl', JSONL))
+        self.assertEqual(ballots, [('alice', AYE), ('dave', ABSTAIN)])
+        self.assertEqual(invalid, 3)
+
+    def test_undecodable_file_stops_the_import(self):
+        path = os.path.join(self.directory, 'ballots.csv')
+        with open(path, 'wb') as fd:
+            fd.write(b'alice,aye\n\xff\xfe,nay\n')
+        reader = ballotfile.BallotReader(path, self.matcher)
+        self.addCleanup(reader.close)
+        with self.assertRaises(ballotfile.BallotError):
+            reader.read(10)
+        self.assertTrue(reader.done)
+
+    def test_unknown_type(self):
+        with self.assertRaises(ballotfile.BallotError):
+            ballotfile.BallotReader(self.write('ballots.txt', CSV), self.matcher)
+
+    def test_resolve_stays_in_the_directory(self):
+        self.assertEqual(ballotfile.resolve(self.directory, 'ballots.csv'),
+                         os.path.join(os.path.realpath(self.directory), 'ballots.csv'))
+        with self.assertRaises(ballotfile.BallotError):
+            ballotfile.resolve(self.directory, '../ballots.csv')
+
+    def test_parse_entry(self):
+        self.assertEqual(ballotfile.parse_entry('alice:aye', self.matcher), ('alice', AYE))
+        self.assertEqual(ballotfile.parse_entry('bob=Nay', self.matcher), ('bob', NAY))
+        self.assertIsNone(ballotfile.parse_entry('carol', self.matcher))
+        self.assertIsNone(ballotfile.parse_entry('carol:maybe', self.matcher))
+
+
+class BallotsCommandTestCase(unittest.TestCase):
+    """!ballots with the real plugins."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='rhythm-ballots-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.bot = IrcBot(nick='motionbot', loop=loop,
+                          includes=['irc3.plugins.command', 'Rhythm'],
+                          Rhythm={'state_dir': self.directory, 'ballot_dir': self.directory},
+                          outbound={'rate': '1000', 'burst': '1000',
+                                    'target_rate': '1000', 'target_burst': '1000'})
+        self.bot.config['irc3.plugins.command'] = {'cmd': '!'}
+        self.motions = self.bot.get_plugin(Rhythm.Motions)
+        self.addCleanup(self.motions.statelog.close)
+
+        self.send(':motionbot!bot@localhost JOIN :#chan')
+        self.send(':chair!chair@example.org JOIN :#chan')
+        self.send(':irc.example.org MODE #chan +o chair')
+        self.say('!start meeting')
+        self.say('!motion we adopt the budget')
+        self.say('!start motion')
+        self.bot.sent
+
+    def send(self, line):
+        self.bot.dispatch(line)
+        self.wait()
+
+    def wait(self):
+        self.bot.loop.run_until_complete(asyncio.sleep(0.05, loop=self.bot.loop))
+
+    def say(self, text):
+        self.send(':chair!chair@example.org PRIVMSG #chan :' + text)
+
+    def test_bad_lines_are_counted_and_skipped(self):
+        with open(os.path.join(self.directory, 'ballots.csv'), 'w', encoding='utf-8') as fd:
+            fd.write(CSV)
+        self.say('!ballots ballots.csv')
+        # the file is read in the executor
+        sent = []
+        for _ in range(40):
+            sent.extend(self.bot.sent)
+            if any('Ballots counted from' in line for line in sent):
+                break
+            self.wait()
+
+        counts = self.motions.count_votes('#chan')
+        self.assertEqual((counts['ayes'], counts['nays']), (1, 1))
+        notices = ' | '.join(sent)
+        self.assertIn('*** Ballots counted from ballots.csv: 2; already voted here: 0; '
+                      'not understood: 3', notices)
+
+
+if __name__ == '__main__':
+    unittest.main()
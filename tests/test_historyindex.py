@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from irc3.testing import IrcBot
+
+import historyindex
+import Rhythm
+
+DAY = 86400
+
+RECORDS = [
+    {'kind': 'meeting', 'meeting': 'm1', 'channel': '#chan', 'ts': 10 * DAY},
+    {'kind': 'motion', 'meeting': 'm1', 'channel': '#chan', 'ts': 10 * DAY,
+     'text': 'we adopt the budget', 'put_by': 'chair', 'result': 'carried',
+     'ayes': 2, 'nays': 1, 'abstains': 0,
+     'votes': {'alice': 'aye', 'bob': 'nay'}, 'ballots': {'carol': 'aye'}},
+    {'kind': 'motion', 'meeting': 'm1', 'channel': '#chan', 'ts': 11 * DAY,
+     'text': 'we amend the budget by "5%" (pre-audit)', 'put_by': 'chair',
+     'result': 'lost', 'ayes': 0, 'nays': 1, 'abstains': 0, 'votes': {'alice': 'nay'}},
+    {'kind': 'motion', 'meeting': 'm2', 'channel': '#other', 'ts': 12 * DAY,
+     'text': 'we hold a picnic', 'put_by': 'chair', 'result': 'carried',
+     'ayes': 1, 'nays': 0, 'abstains': 0, 'votes': {'alice': 'aye'}},
+]
+
+# each is the search syntax of fts3/4 somewhere, and should be searched for as text
+AWKWARD = ['"budget', 'budget*', '-budget', 'NEAR', 'budget NEAR/2 adopt', '(pre-audit)',
+           'budget OR picnic', 'AND', 'NOT', '5%', '^budget', 'text:budget', "'", '*']
+
+
+def write_archive(path, records):
+    with open(path, 'a', encoding='utf-8') as fd:
+        for record in records:
+            fd.write(json.dumps(record) + '\n')
+
+
+class HistoryIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='rhythm-history-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.archive = os.path.join(self.directory, 'meetings.jsonl')
+        write_archive(self.archive, RECORDS)
+        self.index = historyindex.HistoryIndex(os.path.join(self.directory, 'meetings.index'))
+        self.addCleanup(self.index.close)
+        self.assertEqual(self.index.update(self.archive), 3)
+
+    def texts(self, results):
+        return [result['text'] for result in results]
+
+    def test_search(self):
+        self.assertEqual(self.texts(self.index.search(['budget'])), [
+            'we amend the budget by "5%" (pre-audit)', 'we adopt the budget'])
+        self.assertEqual(self.texts(self.index.search(['budget', 'adopt'])),
+                         ['we adopt the budget'])
+        self.assertEqual(self.texts(self.index.search(channel='#other')), ['we hold a picnic'])
+        self.assertEqual(self.texts(self.index.search(since=11 * DAY, until=12 * DAY)),
+                         ['we amend the budget by "5%" (pre-audit)'])
+        self.assertEqual(self.texts(self.index.search(limit=1, offset=2)),
+                         ['we adopt the budget'])
+
+    def test_voted(self):
+        votes = list(self.index.voted('alice', ['budget']))
+        self.assertEqual([(vote['choice'], vote['ballot']) for vote in votes],
+                         [('nay', 0), ('aye', 0)])
+        votes = list(self.index.voted('carol'))
+        self.assertEqual([(vote['choice'], vote['ballot']) for vote in votes], [('aye', 1)])
+
+    def test_query_syntax_is_searched_as_text(self):
+        for words in AWKWARD:
+            list(self.index.search(words.split()))
+            list(self.index.voted('alice', words.split()))
+        self.assertEqual(self.texts(self.index.search(['(pre-audit)'])),
+                         ['we amend the budget by "5%" (pre-audit)'])
+        self.assertEqual(self.texts(self.index.search(['budget', 'OR', 'picnic'])), [])
+
+    def test_update_reads_only_new_lines(self):
+        self.assertEqual(self.index.update(self.archive), 0)
+        write_archive(self.archive, [dict(RECORDS[-1], ts=13 * DAY, text='we hold a barbecue')])
+        self.assertEqual(self.index.update(self.archive), 1)
+        self.assertEqual(self.texts(self.index.search(['we'], limit=1)), ['we hold a barbecue'])
+
+
+class HistoryCommandTestCase(unittest.TestCase):
+    """!history and !voted with the real plugins."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='rhythm-history-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        path = os.path.join(self.directory, 'meetings.jsonl')
+        write_archive(path, RECORDS)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.bot = IrcBot(nick='motionbot', loop=loop,
+                          includes=['irc3.plugins.command', 'Rhythm'],
+                          Rhythm={'archive': path,
+                                  'history': os.path.join(self.directory, 'meetings.index')},
+                          outbound={'rate': '1000', 'burst': '1000',
+                                    'target_rate': '1000', 'target_burst': '1000'})
+        self.bot.config['irc3.plugins.command'] = {'cmd': '!'}
+        self.motions = self.bot.get_plugin(Rhythm.Motions)
+        self.addCleanup(self.motions.archive.close)
+        self.addCleanup(self.motions.history_executor.shutdown)
+        self.addCleanup(self.motions.history_index.close)
+        self.errors = []
+        loop.set_exception_handler(lambda loop, context: self.errors.append(context))
+
+        self.send(':motionbot!bot@localhost JOIN :#chan')
+        self.send(':alice!alice@example.org JOIN :#chan')
+        self.bot.sent
+
+    def send(self, line):
+        self.bot.dispatch(line)
+        self.wait()
+
+    def wait(self):
+        self.bot.loop.run_until_complete(asyncio.sleep(0.05, loop=self.bot.loop))
+
+    def ask(self, text):
+        """Say ``text`` in the channel, and return what's sent back."""
+        self.send(':alice!alice@example.org PRIVMSG #chan :' + text)
+        # the index is searched in the executor
+        sent = []
+        for _ in range(40):
+            sent.extend(self.bot.sent)
+            if sent:
+                break
+            self.wait()
+        self.wait()
+        sent.extend(self.bot.sent)
+        self.assertEqual(self.errors, [])
+        return sent
+
+    def notices(self, text):
+        """The notices ``text`` gets back, one result each."""
+        sent = [line.partition(' :')[2] for line in self.ask(text)
+                if line.startswith('NOTICE alice ')]
+        return ' | '.join(sent).split(' | ')
+
+    def test_history(self):
+        self.assertEqual(self.notices('!history budget'), [
+            '1970-01-12 #chan: we amend the budget by "5%" (pre-audit) '
+            '(lost; 0 ayes, 1 nays, 0 abstains)',
+            '1970-01-11 #chan: we adopt the budget (carried; 2 ayes, 1 nays, 0 abstains)',
+        ])
+        self.assertEqual(self.notices('!history budget --since=1970-01-12'), [
+            '1970-01-12 #chan: we amend the budget by "5%" (pre-audit) '
+            '(lost; 0 ayes, 1 nays, 0 abstains)',
+        ])
+        self.assertEqual(self.notices('!history minutes'), ['*** Nothing found.'])
+
+    def test_voted(self):
+        self.assertEqual(self.notices('!voted Carol'), [
+            '1970-01-11 #chan: aye by ballot on "we adopt the budget" (carried)',
+        ])
+
+    def test_query_syntax_does_not_raise(self):
+        # an answer each, if only docopt's about a word starting with a dash
+        for words in AWKWARD:
+            self.assertTrue(self.ask('!history ' + words), words)
+        self.assertEqual(self.notices('!history "5%" (pre-audit)'), [
+            '1970-01-12 #chan: we amend the budget by "5%" (pre-audit) '
+            '(lost; 0 ayes, 1 nays, 0 abstains)',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import shutil
+import tempfile
+import unittest
+
+from irc3.testing import IrcBot
+
+import Rhythm
+import tally
+from votematch import AYE, NAY, ABSTAIN
+
+USERS = {
+    'chair': 'chair@example.org',
+    'alice': 'alice@home.example.org',
+    'alice_': 'alice@home.example.org',
+    'bob': 'bob@work.example.org',
+}
+
+
+class LinkedTallyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tally = tally.LinkedTally()
+
+    def counts(self):
+        return [self.tally.count(choice) for choice in (AYE, NAY, ABSTAIN)]
+
+    def test_counts_each_voter_once_by_their_latest_vote(self):
+        self.tally.cast('#north', 'alice', 'alice@home', AYE)
+        self.tally.cast('#south', 'alice_', 'alice@home', NAY)
+        self.tally.cast('#south', 'bob', 'bob@work', ABSTAIN)
+        self.assertEqual(self.counts(), [0, 1, 1])
+        self.tally.cast('#north', 'alice', 'alice@home', AYE)
+        self.assertEqual(self.counts(), [1, 0, 1])
+
+    def test_departed_votes_fall_back_to_those_still_present(self):
+        self.tally.cast('#north', 'alice', 'alice@home', AYE)
+        self.tally.cast('#south', 'alice_', 'alice@home', NAY)
+        self.tally.depart('#south', 'alice_')
+        self.assertEqual(self.counts(), [1, 0, 0])
+        self.tally.depart('#north', 'alice')
+        self.assertEqual(self.counts(), [0, 0, 0])
+        self.tally.rejoin('#south', 'alice_')
+        self.assertEqual(self.counts(), [0, 1, 0])
+
+    def test_rename_keeps_the_vote(self):
+        self.tally.cast('#north', 'alice', 'alice@home', AYE)
+        self.tally.rename('#north', 'alice', 'alice_')
+        self.tally.depart('#north', 'alice')
+        self.assertEqual(self.counts(), [1, 0, 0])
+        self.tally.depart('#north', 'alice_')
+        self.assertEqual(self.counts(), [0, 0, 0])
+
+    def test_a_new_voter_under_a_voted_nick(self):
+        self.tally.cast('#north', 'alice', 'alice@home', AYE)
+        self.tally.cast('#north', 'alice', 'mallory@elsewhere', NAY)
+        self.assertEqual(self.counts(), [0, 1, 0])
+        self.assertEqual(self.tally.voters, {'mallory@elsewhere': {('#north', 'alice')}})
+
+    def test_drop_channel(self):
+        self.tally.cast('#north', 'alice', 'alice@home', AYE)
+        self.tally.cast('#south', 'alice_', 'alice@home', NAY)
+        self.tally.cast('#south', 'bob', 'bob@work', NAY)
+        self.tally.drop_channel('#south')
+        self.assertEqual(self.counts(), [1, 0, 0])
+        self.assertEqual(set(self.tally.entries), {('#north', 'alice')})
+        self.assertEqual(set(self.tally.voters), {'alice@home'})
+
+
+class LinkTestCase(unittest.TestCase):
+    """!link and !unlink, with the real plugins."""
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp(prefix='rhythm-link-')
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.bot, self.motions = self.start_bot()
+
+    def start_bot(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        bot = IrcBot(nick='motionbot', loop=loop,
+                     includes=['irc3.plugins.command', 'Rhythm'],
+                     Rhythm={'state_dir': self.state_dir})
+        bot.config['irc3.plugins.command'] = {'cmd': '!'}
+        motions = bot.get_plugin(Rhythm.Motions)
+        self.addCleanup(motions.statelog.close)
+        return bot, motions
+
+    def send(self, line, bot=None):
+        bot = bot or self.bot
+        bot.dispatch(line)
+        bot.loop.run_until_complete(asyncio.sleep(0.01, loop=bot.loop))
+
+    def join(self, nick, channel, mode=None, bot=None):
+        self.send(':{}!{} JOIN :{}'.format(nick, USERS.get(nick, 'bot@localhost'), channel), bot)
+        if mode:
+            self.send(':irc.example.org MODE {} +{} {}'.format(channel, mode, nick), bot)
+
+    def say(self, nick, channel, text, bot=None):
+        self.send(':{}!{} PRIVMSG {} :{}'.format(nick, USERS[nick], channel, text), bot)
+
+    def counts(self, channel, motions=None):
+        counts = (motions or self.motions).count_votes(channel)
+        return [counts['ayes'], counts['nays'], counts['abstains']]
+
+    def link_meeting(self):
+        for channel in ('#north', '#south'):
+            self.join('motionbot', channel)
+            self.join('chair', channel, 'o')
+        self.join('alice', '#north', 'v')
+        self.join('alice_', '#south', 'v')
+        self.join('bob', '#south', 'v')
+        self.say('chair', '#north', '!start meeting')
+        self.say('chair', '#north', '!link #south')
+        self.say('chair', '#north', '!motion we adopt the budget')
+        self.say('chair', '#north', '!start motion')
+        self.say('alice', '#north', 'aye')
+        self.say('alice_', '#south', 'nay')
+        self.say('bob', '#south', 'aye')
+
+    def test_link_counts_each_voter_once(self):
+        self.link_meeting()
+        self.assertEqual(self.motions.linked('#north'), ['#north', '#south'])
+        self.assertTrue(self.motions.states['#south'].motion.started)
+        # alice's later vote, under another nick, replaces her first
+        self.assertEqual(self.counts('#north'), [1, 1, 0])
+        self.assertEqual(self.counts('#south'), [1, 1, 0])
+
+    def test_linked_channels_follow_the_home_channel(self):
+        self.link_meeting()
+        self.say('chair', '#south', '!motion something else')
+        self.assertEqual(self.motions.states['#south'].motion.text, 'we adopt the budget')
+        self.say('chair', '#north', '!cancel motion')
+        self.assertFalse(self.motions.states['#south'].motion.started)
+
+    def test_unlink_drops_the_channels_votes(self):
+        self.link_meeting()
+        self.say('chair', '#north', '!unlink #south')
+        self.assertEqual(self.motions.linked('#north'), ['#north'])
+        self.assertEqual(self.motions.links, {})
+        self.assertFalse(self.motions.states['#south'].meeting.started)
+        self.assertFalse(self.motions.states['#south'].motion.started)
+        self.assertEqual(self.counts('#north'), [1, 0, 0])
+
+    def test_restart_keeps_voters_apart_by_user_host(self):
+        self.link_meeting()
+        self.motions.statelog.close()
+
+        # the restarted bot rebuilds the link as it joins, before it knows who's there
+        bot, motions = self.start_bot()
+        for channel in ('#south', '#north'):
+            self.join('motionbot', channel, bot=bot)
+        self.assertEqual(motions.linked('#north'), ['#north', '#south'])
+        self.assertEqual(self.counts('#north', motions), [1, 1, 0])
+
+        # and alice changing her mind still replaces her one vote
+        for channel in ('#north', '#south'):
+            self.join('chair', channel, 'o', bot=bot)
+        self.join('alice', '#north', 'v', bot=bot)
+        self.say('alice', '#north', 'abstain', bot=bot)
+        self.assertEqual(self.counts('#north', motions), [1, 0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
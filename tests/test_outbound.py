@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import unittest
+
+import outbound
+
+
+class Handle(object):
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Loop(object):
+    """Just enough of an event loop, on a clock the test moves."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.calls = []
+        self.seq = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, func):
+        handle = Handle()
+        heapq.heappush(self.calls, (self.now + delay, next(self.seq), handle, func))
+        return handle
+
+    def advance(self, seconds):
+        until = self.now + seconds
+        while self.calls and self.calls[0][0] <= until:
+            when, _, handle, func = heapq.heappop(self.calls)
+            self.now = max(self.now, when)
+            if not handle.cancelled:
+                func()
+        self.now = until
+
+
+class Bot(object):
+
+    def __init__(self, **config):
+        self.loop = Loop()
+        self.config = config
+        self.lines = []
+
+    def send_line(self, line):
+        self.lines.append((self.loop.now, line))
+
+
+class OutboundTestCase(unittest.TestCase):
+
+    def queue(self, max_length=512, **config):
+        self.bot = Bot(outbound=dict((k, str(v)) for k, v in config.items()),
+                       max_length=str(max_length))
+        return outbound.Outbound(self.bot)
+
+    def sent(self):
+        return [line for when, line in self.bot.lines]
+
+    def test_never_exceeds_the_budget(self):
+        out = self.queue(rate=2, burst=3, target_rate=1, target_burst=2)
+        # too long for two to share a line, so each is a line of its own
+        for i in range(40):
+            out.notice('#chan{}'.format(i % 4), '{} {}'.format(i, 'x' * 250))
+        for _ in range(300):
+            self.bot.loop.advance(0.1)
+        self.assertEqual(out.depth(), [0, 0, 0])
+        self.assertEqual(len(self.bot.lines), 40)
+
+        times = [when for when, line in self.bot.lines]
+        for start in times:
+            for window in (0.5, 1, 5, 10):
+                # a full bucket, and what it refills meanwhile
+                sent = sum(1 for when in times if start <= when <= start + window)
+                self.assertLessEqual(sent, 3 + 2 * window, (start, window))
+        for target in ('#chan0', '#chan1'):
+            times = [when for when, line in self.bot.lines if line.startswith('NOTICE ' + target)]
+            for start in times:
+                sent = sum(1 for when in times if start <= when <= start + 4)
+                self.assertLessEqual(sent, 2 + 1 * 4, target)
+
+    def test_lines_fit_max_length(self):
+        out = self.queue(max_length=200, rate=100, burst=100, target_rate=100, target_burst=100)
+        words = ' '.join('word{}'.format(i) for i in range(100))
+        out.notice('#chan', words)
+        out.notice('#chan', 'x' * 300)
+        self.bot.loop.advance(10)
+
+        for line in self.sent():
+            size = len(line.encode('utf-8')) + len('\r\n') + outbound.PREFIX_ALLOWANCE
+            self.assertLessEqual(size, 200, line)
+        text = ' '.join(line.partition(' :')[2] for line in self.sent())
+        self.assertEqual(text.split().count('word99'), 1)
+        self.assertEqual(text.count('x'), 300)
+
+    def test_coalesces_and_splits_at_max_length(self):
+        out = self.queue(max_length=200, rate=100, burst=100, target_rate=100, target_burst=100)
+        # 200 - 100 for the prefix - 'NOTICE #chan :\r\n' leaves 84 bytes a line
+        out.notice('#chan', 'a' * 40)
+        out.notice('#chan', 'b' * 40)
+        out.notice('#chan', 'c' * 40)
+        out.notice('#other', 'hello')
+        self.bot.loop.advance(1)
+
+        self.assertEqual(self.sent(), [
+            'NOTICE #chan :{} | {}'.format('a' * 40, 'b' * 40),
+            'NOTICE #other :hello',
+            'NOTICE #chan :' + 'c' * 40,
+        ])
+        self.assertEqual(out.coalesced, 1)
+
+    def test_long_message_is_split_on_spaces(self):
+        out = self.queue(max_length=200, rate=100, burst=100, target_rate=100, target_burst=100)
+        text = ' '.join(['word'] * 40)
+        out.notice('#chan', text)
+        self.bot.loop.advance(1)
+
+        texts = [line.partition(' :')[2] for line in self.sent()]
+        self.assertEqual(len(texts), 3)
+        for piece in texts:
+            self.assertLessEqual(len(piece.encode('utf-8')), 84)
+            self.assertFalse(piece.startswith(' ') or piece.endswith(' '))
+        self.assertEqual(' '.join(texts), text)
+
+    def test_modes_are_not_coalesced(self):
+        out = self.queue(rate=100, burst=100, target_rate=100, target_burst=100)
+        out.mode('#chan', '+vv alice bob')
+        out.mode('#chan', '+v carol')
+        self.bot.loop.advance(1)
+        self.assertEqual(self.sent(), ['MODE #chan +vv alice bob', 'MODE #chan +v carol'])
+
+    def test_results_go_before_courtesy_messages(self):
+        out = self.queue(rate=1, burst=1, target_rate=1, target_burst=1)
+        out.privmsg('alice', 'You are not recognised', priority=outbound.COURTESY)
+        out.notice('#chan', 'something', priority=outbound.NORMAL)
+        out.notice('#chan', '*** Votes', priority=outbound.RESULT)
+        self.bot.loop.advance(10)
+        self.assertEqual(self.sent(), [
+            'NOTICE #chan :*** Votes',
+            'NOTICE #chan :something',
+            'PRIVMSG alice :You are not recognised',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from irc3.testing import IrcBot
+
+import recorder
+
+LINES = [
+    ':alice!alice@example.org JOIN :#chan',
+    ':alice!alice@example.org PRIVMSG #chan :hello',
+    ':alice!alice@example.org PART #chan',
+]
+
+
+class RecorderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp(prefix='rhythm-recorder-')
+        self.addCleanup(shutil.rmtree, tmp)
+        self.path = os.path.join(tmp, 'capture.gz')
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        # nothing is flushed while the test runs; shutting down has to do it
+        self.bot = IrcBot(nick='motionbot', loop=loop, includes=['recorder'],
+                          recorder={'file': self.path, 'flush_interval': '60'})
+
+    def test_shutdown_finishes_the_capture(self):
+        for line in LINES:
+            self.bot.dispatch(line)
+        self.bot.loop.run_until_complete(asyncio.sleep(0.01, loop=self.bot.loop))
+        self.bot.notify('SIGINT')
+
+        self.assertEqual([line for ts, line in recorder.read(self.path)], LINES)
+        # and the gzip stream is complete, trailer and all
+        with gzip.open(self.path, 'rt', encoding='utf-8') as fd:
+            self.assertEqual(len(fd.read().splitlines()), len(LINES))
+
+
+if __name__ == '__main__':
+    unittest.main()
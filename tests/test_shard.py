@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import shard
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import ircserver  # noqa: E402
+import sharding  # noqa: E402
+
+
+def channels_of(worker, prefix, count, workers=2):
+    """The first ``count`` channels named ``prefix<n>`` which hash to ``worker``."""
+    names = ('{}{}'.format(prefix, i) for i in range(1000))
+    found = [name for name in names if shard.owner(name, workers) == worker]
+    return found[:count]
+
+
+class AssignTestCase(unittest.TestCase):
+
+    def test_keeps_previous_placements(self):
+        channels = ['#a', '#b', '#c']
+        assignment = shard.assign(channels, 2)
+        moved = dict(assignment, **{'#a': 1 - assignment['#a']})
+        self.assertEqual(shard.assign(channels, 2, moved), moved)
+
+    def test_replaces_placements_on_workers_gone(self):
+        assignment = shard.assign(['#a'], 2, {'#a': 5})
+        self.assertEqual(assignment, {'#a': shard.owner('#a', 2)})
+
+    def test_moves_nearest_half_the_gap(self):
+        loads = {0: 30, 1: 0}
+        rates = {0: {'#a': 16, '#b': 9, '#c': 5}, 1: {}}
+        self.assertEqual(shard.choose_move(loads, rates, {}, 1.5), ('#a', 0, 1))
+
+    def test_busy_channels_stay(self):
+        loads = {0: 30, 1: 0}
+        rates = {0: {'#a': 16, '#b': 9, '#c': 5}, 1: {}}
+        self.assertEqual(shard.choose_move(loads, rates, {0: {'#a'}}, 1.5), ('#b', 0, 1))
+
+    def test_balanced_workers_stay(self):
+        loads = {0: 12, 1: 10}
+        rates = {0: {'#a': 12}, 1: {'#b': 10}}
+        self.assertIsNone(shard.choose_move(loads, rates, {}, 1.5))
+
+
+class ShardTestCase(unittest.TestCase):
+    """The coordinator and two workers, against benchmarks/ircserver.py."""
+
+    interval = 1
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='rhythm-shard-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.server = self.run_until(ircserver.Server(port=0, loop=self.loop).start())
+        self.addCleanup(self.server.close)
+        self.clients = []
+        self.addCleanup(self.disconnect)
+        self.coordinator = None
+        self.addCleanup(self.stop)
+
+        # two channels which will be busy, and one quiet, all on worker 0
+        self.hot = channels_of(0, '#hot', 2)
+        self.quiet = channels_of(1, '#quiet', 1)
+        self.channels = self.hot + self.quiet
+        self.path = os.path.join(self.tmp, 'config.ini')
+        with open(self.path, 'w', encoding='utf-8') as fd:
+            fd.write(sharding.CONFIG.format(
+                bot=sharding.BOT, irc_port=self.server.port, tmp=self.tmp, workers=2,
+                shard_port=sharding.free_port(), interval=self.interval,
+                autojoins='\n'.join('    ' + c.lstrip('#') for c in self.channels)))
+
+    def run_until(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def connect(self, nick):
+        client = sharding.Client(nick, self.server.port, self.loop)
+        self.run_until(client.connect())
+        self.clients.append(client)
+        return client
+
+    def disconnect(self):
+        for client in self.clients:
+            client.writer.close()
+        # let the server see them go
+        self.run_until(asyncio.sleep(0.1, loop=self.loop))
+
+    def start(self):
+        self.log = open(os.path.join(self.tmp, 'shard.log'), 'a')
+        self.coordinator = subprocess.Popen(
+            [sys.executable, 'shard.py', self.path], cwd=ROOT,
+            stdout=self.log, stderr=subprocess.STDOUT)
+
+    def stop(self):
+        if self.coordinator is not None:
+            self.coordinator.send_signal(signal.SIGINT)
+            self.coordinator.wait()
+            self.coordinator = None
+            self.log.close()
+
+    def settle(self, timeout=30):
+        return self.run_until(sharding.settle(
+            self.server, self.channels, timeout, self.loop))
+
+    def assignment(self):
+        with open(os.path.join(self.tmp, 'shards.json'), encoding='utf-8') as fd:
+            return json.load(fd)
+
+    def assertPlaced(self, assignment):
+        for channel, worker in assignment.items():
+            self.assertEqual(sharding.bots(self.server, channel),
+                             ['{}{}'.format(sharding.BOT, worker)], channel)
+
+    @asyncio.coroutine
+    def chatter(self, users, duration):
+        """Have ``users`` talk in the hot channels, ten lines a second each."""
+        deadline = self.loop.time() + duration
+        while self.loop.time() < deadline:
+            for user in users:
+                for channel in self.hot:
+                    user.send('PRIVMSG {} :just talking'.format(channel))
+            yield from asyncio.sleep(0.1, loop=self.loop)
+
+    @asyncio.coroutine
+    def wait_for_move(self, timeout):
+        deadline = self.loop.time() + timeout
+        while self.loop.time() < deadline:
+            if self.assignment() != self.before:
+                return
+            yield from asyncio.sleep(0.2, loop=self.loop)
+
+    def test_assigns_moves_and_keeps_channels(self):
+        # the chair gets there first, so it's an op everywhere
+        chair = self.connect(sharding.CHAIR)
+        chair.send('JOIN ' + ','.join(self.channels))
+
+        self.start()
+        self.assertEqual(self.settle(), {})
+        self.before = self.assignment()
+        self.assertEqual(self.before, dict([(c, 0) for c in self.hot] +
+                                           [(c, 1) for c in self.quiet]))
+        self.assertPlaced(self.before)
+
+        # a meeting ties the first hot channel to its worker; the other can go
+        held, movable = self.hot
+        chair.send('PRIVMSG {} :!start meeting'.format(held))
+        users = [self.connect('user{}'.format(i)) for i in range(3)]
+        for user in users:
+            user.send('JOIN ' + ','.join(self.hot))
+        self.run_until(asyncio.gather(
+            self.chatter(users, self.interval * 8), self.wait_for_move(self.interval * 8),
+            loop=self.loop))
+
+        after = self.assignment()
+        self.assertEqual(after, dict(self.before, **{movable: 1}))
+        self.assertEqual(self.settle(), {})
+        self.assertPlaced(after)
+
+        # a restarted coordinator puts everything back where it was
+        self.stop()
+        self.run_until(asyncio.sleep(2, loop=self.loop))
+        self.assertEqual(sum(len(sharding.bots(self.server, c)) for c in self.channels), 0)
+        self.start()
+        self.assertEqual(self.settle(), {})
+        self.assertEqual(self.assignment(), after)
+        self.assertPlaced(after)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import statelog
+
+
+class StateLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def log(self):
+        log = statelog.StateLog(self.directory)
+        self.addCleanup(log.close)
+        return log
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def start_motion(self, log, channel='#chan'):
+        log.append(channel, 'motion', reset=True, motion={'text': 'cake', 'started': True})
+
+    def snapshot(self, log, channels):
+        seq = log.rotate()
+        log.write_snapshot(seq, channels)
+
+    def votes(self, channels, channel='#chan'):
+        return channels[channel]['motion']['votes']
+
+    def test_restore_empty(self):
+        self.assertEqual(self.log().restore(), {})
+
+    def test_replays_log(self):
+        log = self.log()
+        self.start_motion(log)
+        log.append('#chan', 'vote', nick='alice', choice='aye')
+        log.append('#chan', 'vote', nick='bob', choice='nay')
+        log.append('#chan', 'rename', nick='bob', new_nick='bob_')
+        log.close()
+
+        channels = self.log().restore()
+        self.assertEqual(channels['#chan']['motion']['text'], 'cake')
+        self.assertEqual(self.votes(channels), {'alice': 'aye', 'bob_': 'nay'})
+
+    def test_replays_log_over_snapshot(self):
+        log = self.log()
+        self.start_motion(log)
+        log.append('#chan', 'vote', nick='alice', choice='aye')
+        self.snapshot(log, self.log().restore())
+        log.append('#chan', 'vote', nick='bob', choice='nay')
+        log.close()
+
+        restored = self.log()
+        channels = restored.restore()
+        self.assertEqual(self.votes(channels), {'alice': 'aye', 'bob': 'nay'})
+        self.assertEqual(restored.seq, 3)
+
+    def test_crash_between_rotate_and_snapshot(self):
+        log = self.log()
+        self.start_motion(log)
+        log.append('#chan', 'vote', nick='alice', choice='aye')
+        # the snapshot never gets written; the old log must still be replayed
+        log.rotate()
+        log.append('#chan', 'vote', nick='bob', choice='nay')
+        log.close()
+        self.assertTrue(os.path.exists(self.path(statelog.OLD_WAL)))
+
+        channels = self.log().restore()
+        self.assertEqual(self.votes(channels), {'alice': 'aye', 'bob': 'nay'})
+
+    def test_crash_between_two_rotations(self):
+        log = self.log()
+        self.start_motion(log)
+        log.append('#chan', 'vote', nick='alice', choice='aye')
+        log.rotate()
+        log.append('#chan', 'vote', nick='bob', choice='nay')
+        # the second rotation folds the new log into the old one
+        log.rotate()
+        log.append('#chan', 'depart', nick='alice')
+        log.close()
+
+        channels = self.log().restore()
+        self.assertEqual(self.votes(channels), {'bob': 'nay'})
+        self.assertEqual(channels['#chan']['motion']['departed'], {'alice': 'aye'})
+
+    def test_crash_while_folding_logs(self):
+        log = self.log()
+        self.start_motion(log)
+        log.append('#chan', 'vote', nick='alice', choice='aye')
+        log.rotate()
+        log.append('#chan', 'vote', nick='alice', choice='nay')
+        log.append('#chan', 'depart', nick='alice')
+        log.close()
+        # the new log was copied onto the old one, but not removed
+        with open(self.path(statelog.WAL), encoding='utf-8') as new, \
+                open(self.path(statelog.OLD_WAL), 'a', encoding='utf-8') as old:
+            old.write(new.read())
+
+        restored = self.log()
+        channels = restored.restore()
+        self.assertEqual(self.votes(channels), {})
+        self.assertEqual(channels['#chan']['motion']['departed'], {'alice': 'nay'})
+        self.assertEqual(restored.seq, 4)
+
+    def test_crash_with_snapshot_half_written(self):
+        log = self.log()
+        self.start_motion(log)
+        log.append('#chan', 'vote', nick='alice', choice='aye')
+        log.rotate()
+        log.close()
+        with open(self.path(statelog.SNAPSHOT + '.tmp'), 'w', encoding='utf-8') as fd:
+            fd.write('{"seq": 2, "chann')
+
+        channels = self.log().restore()
+        self.assertEqual(self.votes(channels), {'alice': 'aye'})
+
+    def test_truncated_last_line(self):
+        log = self.log()
+        self.start_motion(log)
+        log.append('#chan', 'vote', nick='alice', choice='aye')
+        log.close()
+        with open(self.path(statelog.WAL), 'a', encoding='utf-8') as fd:
+            fd.write('{"seq": 3, "channel": "#chan", "op": "vo')
+
+        restored = self.log()
+        channels = restored.restore()
+        self.assertEqual(self.votes(channels), {'alice': 'aye'})
+        self.assertEqual(restored.seq, 2)
+
+    def test_appends_after_truncated_line_are_kept(self):
+        log = self.log()
+        self.start_motion(log)
+        log.close()
+        with open(self.path(statelog.WAL), 'a', encoding='utf-8') as fd:
+            fd.write('{"seq": 2, "channel": "#chan", "op": "vo')
+
+        # the restarted bot carries on logging, then crashes again
+        restarted = self.log()
+        restarted.restore()
+        restarted.append('#chan', 'vote', nick='bob', choice='nay')
+        restarted.close()
+
+        channels = self.log().restore()
+        self.assertEqual(self.votes(channels), {'bob': 'nay'})
+
+    def test_old_log_entries_are_upgraded(self):
+        # logged before ballots, links and timed motions
+        with open(self.path(statelog.WAL), 'w', encoding='utf-8') as fd:
+            fd.write(json.dumps({'seq': 1, 'channel': '#chan', 'op': 'vote',
+                                 'nick': 'alice', 'choice': 'aye'}) + '\n')
+
+        channels = self.log().restore()
+        self.assertEqual(self.votes(channels), {'alice': 'aye'})
+        self.assertEqual(channels['#chan']['motion']['ballots'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+import storage
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = storage.CircuitBreaker(2, 30, self.clock)
+
+    def test_opens_after_threshold_failures(self):
+        self.assertFalse(self.breaker.failed(IOError('down')))
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.failed(IOError('down')))
+        self.assertEqual(self.breaker.state, storage.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_in(), 30)
+
+    def test_success_resets_the_count(self):
+        self.breaker.failed(IOError('down'))
+        self.assertFalse(self.breaker.succeeded())
+        self.breaker.failed(IOError('down'))
+        self.assertEqual(self.breaker.state, storage.CLOSED)
+
+    def test_open_half_open_closed(self):
+        self.breaker.failed(IOError('down'))
+        self.breaker.failed(IOError('down'))
+        self.clock.now = 29
+        self.assertFalse(self.breaker.allow())
+        self.clock.now = 30
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, storage.HALF_OPEN)
+        # only the one probe goes through
+        self.assertFalse(self.breaker.allow())
+        self.assertTrue(self.breaker.succeeded())
+        self.assertEqual(self.breaker.state, storage.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_again(self):
+        self.breaker.failed(IOError('down'))
+        self.breaker.failed(IOError('down'))
+        self.clock.now = 30
+        self.assertTrue(self.breaker.allow())
+        # already counted as open, so not news
+        self.assertFalse(self.breaker.failed(IOError('still down')))
+        self.assertEqual(self.breaker.state, storage.OPEN)
+        self.assertEqual(self.breaker.retry_in(), 30)
+
+
+class FlakyStore(storage.MemoryStore):
+    """A memory store which can be taken down."""
+
+    flush_delay = 0.01
+
+    def __init__(self, *args, **options):
+        super(FlakyStore, self).__init__(*args, **options)
+        self.down = False
+
+    def check(self):
+        if self.down:
+            raise IOError('down')
+
+    def _ping(self):
+        self.check()
+
+    def _get_recognised(self, channel):
+        self.check()
+        return super(FlakyStore, self)._get_recognised(channel)
+
+    def _write_recognised(self, updates):
+        self.check()
+        super(FlakyStore, self)._write_recognised(updates)
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.changed = []
+
+    def run_until(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def wait(self, seconds):
+        self.run_until(asyncio.sleep(seconds, loop=self.loop))
+
+    def subscribe(self, store):
+        store.subscribe(self.changed.append)
+        return store
+
+    def test_failed_writes_are_replayed_in_order(self):
+        store = self.subscribe(FlakyStore('bot', loop=self.loop, threshold=1, reset_timeout=0.05))
+        store.down = True
+        store.push_recognised('#chan', 'a@h', 'b@h', 'c@h')
+        self.run_until(store.flush())
+        self.assertEqual(store.breaker.state, storage.OPEN)
+        self.assertEqual(store.queued(), 3)
+        with self.assertRaises(storage.StoreUnavailable):
+            self.run_until(store.get_recognised('#chan'))
+
+        # written while down, so it lands over the failed batch
+        store.pull_recognised('#chan', 'a@h')
+        store.push_recognised('#chan', 'd@h')
+        store.down = False
+        self.wait(0.2)
+
+        self.assertEqual(store.breaker.state, storage.CLOSED)
+        self.assertEqual(store.queued(), 0)
+        self.assertEqual(store.recognised['#chan'], ['b@h', 'c@h', 'd@h'])
+        # the list it couldn't read is to be reloaded
+        self.assertEqual(self.changed, ['#chan'])
+
+    def test_reads_see_queued_writes(self):
+        store = FlakyStore('bot', loop=self.loop)
+        store.push_recognised('#chan', 'a@h', 'b@h')
+        self.run_until(store.flush())
+        store.pull_recognised('#chan', 'a@h')
+        store.push_recognised('#chan', 'c@h')
+        self.assertEqual(self.run_until(store.get_recognised('#chan')), ['b@h', 'c@h'])
+        self.assertEqual(store.recognised['#chan'], ['a@h', 'b@h'])
+
+    def test_full_queue_drops_writes(self):
+        store = FlakyStore('bot', loop=self.loop, max_pending=2)
+        store.push_recognised('#chan', 'a@h', 'b@h', 'c@h')
+        self.assertEqual((store.queued(), store.dropped), (2, 1))
+
+
+class BackendTestCase(unittest.TestCase):
+    """Recognised lists through each backend, and back after a restart."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='rhythm-storage-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_until(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def sqlite(self):
+        store = storage.from_uri('sqlite://' + os.path.join(self.tmp, 'rhythm.db'), 'bot',
+                                 loop=self.loop, poll_interval=0)
+        self.addCleanup(store.executor.shutdown)
+        return store
+
+    def round_trip(self, store):
+        store.push_recognised('#chan', 'a@h', 'b@h')
+        store.push_recognised('#other', 'c@h')
+        self.run_until(store.flush())
+        store.pull_recognised('#chan', 'a@h')
+        # a batch replayed after a timeout adds nobody twice
+        store.push_recognised('#chan', 'b@h', 'd@h')
+        self.run_until(store.flush())
+        self.assertEqual(self.run_until(store.get_recognised('#chan')), ['b@h', 'd@h'])
+        self.assertEqual(self.run_until(store.get_recognised('#other')), ['c@h'])
+
+    def test_memory(self):
+        store = storage.from_uri('memory://', 'bot', loop=self.loop)
+        self.assertIsInstance(store, storage.MemoryStore)
+        self.round_trip(store)
+
+    def test_sqlite(self):
+        store = self.sqlite()
+        self.round_trip(store)
+        # queued when the bot stops, and written as it does
+        store.push_recognised('#chan', 'e@h')
+        store.shutdown()
+
+        store = self.sqlite()
+        self.assertEqual(self.run_until(store.get_recognised('#chan')), ['b@h', 'd@h', 'e@h'])
+        store.shutdown()
+
+    def test_sqlite_poll_reloads_lists_changed_elsewhere(self):
+        ours, theirs = self.sqlite(), self.sqlite()
+        changed = []
+        ours.subscribe(changed.append)
+        self.run_until(ours.get_recognised('#chan'))
+        self.run_until(ours.get_recognised('#quiet'))
+        self.run_until(ours.poll())
+        self.assertEqual(changed, [])
+
+        theirs.push_recognised('#chan', 'a@h')
+        self.run_until(theirs.flush())
+        self.run_until(ours.poll())
+        self.assertEqual(changed, ['#chan'])
+        self.assertEqual(self.run_until(ours.get_recognised('#chan')), ['a@h'])
+
+        # and only once
+        self.run_until(ours.poll())
+        self.assertEqual(changed, ['#chan'])
+        ours.shutdown()
+        theirs.shutdown()
+
+    def test_unknown_uri(self):
+        with self.assertRaises(ValueError):
+            storage.from_uri('postgres://localhost/', 'bot', loop=self.loop)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+
+from irc3.testing import IrcBot
+
+import mappinguserlist
+
+
+class UserlistTestCase(unittest.TestCase):
+
+    def setUp(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        # handlers run as loop callbacks, so their errors only reach here
+        self.errors = []
+        loop.set_exception_handler(lambda loop, context: self.errors.append(context))
+        self.bot = IrcBot(nick='motionbot', loop=loop, includes=['mappinguserlist'])
+        self.userlist = self.bot.get_plugin(mappinguserlist.Userlist)
+
+    def send(self, line):
+        self.bot.dispatch(line)
+        self.bot.loop.run_until_complete(asyncio.sleep(0.01, loop=self.bot.loop))
+
+    def test_mode_tracks_members(self):
+        self.send(':alice!a@h JOIN #chan')
+        self.send(':irc.example.org MODE #chan +v alice')
+        self.assertIn('alice', self.bot.channels['#chan'].modes['+'])
+        self.assertEqual(self.userlist.nick_channels, {'alice': {'#chan'}})
+        self.assertEqual(self.errors, [])
+
+    def test_mode_on_non_member_then_quit(self):
+        self.send(':alice!a@h JOIN #chan')
+        self.send(':irc.example.org MODE #chan +v ghost')
+        self.assertNotIn('ghost', self.bot.channels['#chan'])
+        self.assertNotIn('ghost', self.userlist.nick_channels)
+        self.send(':ghost!g@h QUIT :gone')
+        self.send(':alice!a@h QUIT :gone')
+        self.assertEqual(list(self.bot.channels['#chan']), [])
+        self.assertEqual(self.userlist.nick_channels, {})
+        self.assertEqual(self.bot.nicks, {})
+        self.assertEqual(self.errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
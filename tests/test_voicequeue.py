@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+
+from irc3.testing import IrcBot
+
+
+class VoiceQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.bot = IrcBot(nick='motionbot', loop=loop, includes=['irc3.plugins.core', 'voicequeue'],
+                          voicequeue={'delay': '0.05'},
+                          outbound={'rate': '1000', 'burst': '1000',
+                                    'target_rate': '1000', 'target_burst': '1000'})
+        self.queue = self.bot.voicequeue
+        # irc3's core plugin only reads 005 lines once connected
+        self.bot.notify('connection_made')
+        self.send(':irc.example.org 005 motionbot MODES=4 PREFIX=(ov)@+ '
+                  ':are supported by this server')
+        self.send(':motionbot!bot@localhost JOIN :#chan')
+        self.nicks = ['user{}'.format(i) for i in range(10)]
+        for nick in self.nicks:
+            self.send(':{0}!{0}@example.org JOIN :#chan'.format(nick))
+        self.bot.sent
+
+    def send(self, line):
+        self.bot.dispatch(line)
+        self.wait(0.001)
+
+    def wait(self, seconds):
+        self.bot.loop.run_until_complete(asyncio.sleep(seconds, loop=self.bot.loop))
+
+    def modes(self):
+        return [line for line in self.bot.sent if line.startswith('MODE')]
+
+    def test_batches_by_isupport_modes(self):
+        for nick in self.nicks:
+            self.queue.voice('#chan', nick)
+        self.assertEqual(self.modes(), [])
+        self.wait(0.1)
+        self.assertEqual(self.modes(), [
+            'MODE #chan +vvvv user0 user1 user2 user3',
+            'MODE #chan +vvvv user4 user5 user6 user7',
+            'MODE #chan +vv user8 user9',
+        ])
+
+    def test_skips_nicks_gone_or_voiced(self):
+        for nick in self.nicks[:4]:
+            self.queue.voice('#chan', nick)
+        self.queue.voice('#chan', 'user0')
+        self.send(':user1!user1@example.org PART #chan')
+        self.send(':irc.example.org MODE #chan +v user2')
+        self.wait(0.1)
+        self.assertEqual(self.modes(), ['MODE #chan +vv user0 user3'])
+
+    def test_batches_fit_max_length(self):
+        self.queue.max_length = 130
+        nicks = ['n{:>07}'.format(i) for i in range(12)]
+        batches = list(self.queue.batches(nicks))
+        # 30 bytes after the allowance; a "v" and a space besides each nick
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 3, 3])
+        self.assertEqual(sum(batches, []), nicks)
+
+
+if __name__ == '__main__':
+    unittest.main()
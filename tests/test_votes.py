@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import shutil
+import tempfile
+import unittest
+
+from irc3.testing import IrcBot
+
+import Rhythm
+
+
+class SuppressedTestCase(unittest.TestCase):
+    """Votes which are ignored, and !suppressed."""
+
+    def setUp(self):
+        state_dir = tempfile.mkdtemp(prefix='rhythm-votes-')
+        self.addCleanup(shutil.rmtree, state_dir)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.bot = IrcBot(nick='motionbot', loop=loop,
+                          includes=['irc3.plugins.command', 'Rhythm'],
+                          Rhythm={'state_dir': state_dir},
+                          outbound={'rate': '1000', 'burst': '1000',
+                                    'target_rate': '1000', 'target_burst': '1000'})
+        self.bot.config['irc3.plugins.command'] = {'cmd': '!'}
+        self.motions = self.bot.get_plugin(Rhythm.Motions)
+        self.addCleanup(self.motions.statelog.close)
+
+        self.send(':motionbot!bot@localhost JOIN :#chan')
+        self.send(':chair!chair@example.org JOIN :#chan')
+        self.send(':irc.example.org MODE #chan +o chair')
+        self.send(':alice!alice@example.org JOIN :#chan')
+        self.send(':irc.example.org MODE #chan +v alice')
+        self.send(':mallory!mallory@example.org JOIN :#chan')
+        self.say('chair', '!start meeting')
+        self.say('chair', '!motion we adopt the budget')
+        self.say('chair', '!start motion')
+        self.bot.sent
+
+    def send(self, line):
+        self.bot.dispatch(line)
+        self.bot.loop.run_until_complete(asyncio.sleep(0.01, loop=self.bot.loop))
+
+    def say(self, nick, text):
+        self.send(':{0}!{0}@example.org PRIVMSG #chan :{1}'.format(nick, text))
+
+    def notices(self):
+        return ' | '.join(line for line in self.bot.sent if line.startswith('NOTICE #chan'))
+
+    def test_nothing_suppressed(self):
+        motion = self.motions.states['#chan'].motion
+        self.say('alice', 'aye')
+        self.assertIsNone(motion.rejected)
+        self.assertIsNone(motion.suppressed)
+        self.say('chair', '!suppressed')
+        self.assertIn('*** Votes ignored: 0 over the rate limit, 0 more from unrecognised '
+                      'users, 0 repeats; unrecognised users told: 0', self.notices())
+
+    def test_counts_ignored_votes(self):
+        self.say('alice', 'aye')
+        self.say('alice', 'aye')
+        self.say('mallory', 'nay')
+        self.say('mallory', 'nay')
+        self.assertEqual(self.motions.count_votes('#chan')['ayes'], 1)
+        self.assertEqual(self.motions.count_votes('#chan')['nays'], 0)
+        self.say('chair', '!suppressed')
+        self.assertIn('*** Votes ignored: 0 over the rate limit, 1 more from unrecognised '
+                      'users, 1 repeats; unrecognised users told: 1', self.notices())
+
+
+if __name__ == '__main__':
+    unittest.main()
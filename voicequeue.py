@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Debounced, batched voicing.
+
+When a netsplit heals or a meeting opens, many recognised users join within
+a few seconds. Instead of one ``MODE +v`` line each, nicks to voice are
+queued per channel for a short window and then sent as few MODE lines as the
+server's ``MODES=`` limit allows. Nicks which have left, or have been voiced
+meanwhile, are dropped when the queue is sent.
+
+Configure it from the ``[voicequeue]`` section of the bot config::
+
+    [voicequeue]
+    # seconds to collect nicks before voicing them
+    delay = 1
+"""
+import collections
+
+import irc3
+
+from casemapping import display
+
+# room left for "MODE <channel> " and the line ending
+MODE_ALLOWANCE = 100
+
+
+@irc3.plugin
+class VoiceQueue(object):
+
+    def __init__(self, bot):
+        bot.include('isupport')
+        bot.include('mappinguserlist')
+        bot.include('outbound')
+        self.bot = bot
+        self.loop = bot.loop
+        config = bot.config.get('voicequeue', {})
+        self.delay = float(config.get('delay', 1))
+        self.max_length = int(bot.config.get('max_length', 512))
+        # casefolded channel -> nicks to voice, in the order queued
+        self.pending = {}
+        self.handles = {}
+        self.bot.voicequeue = self
+
+    def connection_lost(self, client=None):
+        self.pending.clear()
+        for handle in self.handles.values():
+            handle.cancel()
+        self.handles.clear()
+
+    def voice(self, channel, nick):
+        """Voice ``nick`` on ``channel`` (both casefolded) shortly."""
+        pending = self.pending.get(channel)
+        if pending is None:
+            pending = self.pending[channel] = collections.OrderedDict()
+            self.handles[channel] = self.loop.call_later(self.delay, self.flush, channel)
+        pending[nick] = True
+
+    def flush(self, channel):
+        """Send the queued voices for a channel."""
+        self.handles.pop(channel, None)
+        nicks = self.pending.pop(channel, ())
+        if channel not in self.bot.channels:
+            return
+
+        members = self.bot.channels[channel]
+        voice_mask = self.bot.isupport.voice_mask
+        nicks = [display(nick) for nick in nicks
+                 if nick in members and not members.has_mode(nick, voice_mask)]
+
+        for batch in self.batches(nicks):
+            self.bot.outbound.mode(channel, '+{} {}'.format('v' * len(batch), ' '.join(batch)))
+
+    def batches(self, nicks):
+        """Split nicks into groups that fit in one MODE line each."""
+        max_modes = self.bot.isupport.max_modes
+        budget = self.max_length - MODE_ALLOWANCE
+        batch = []
+        size = 0
+        for nick in nicks:
+            # a "v" and a space besides the nick
+            nick_size = len(nick.encode('utf-8')) + 2
+            if batch and (len(batch) >= max_modes or size + nick_size > budget):
+                yield batch
+                batch, size = [], 0
+            batch.append(nick)
+            size += nick_size
+        if batch:
+            yield batch
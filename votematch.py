@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Recognise votes in channel messages.
+
+Most channel messages are chatter, so :class:`VoteMatcher` is built to turn
+them away as cheaply as possible: it looks at the first character, then at a
+bounded prefix of the message, and only casefolds the one word it finds there.
+"""
+import enum
+
+
+class Vote(enum.IntEnum):
+    """A vote, by name, for saving and showing.
+
+    Everything on the vote path (the matcher, tallies) passes the plain ints
+    below instead, which are cheaper to index and compare; ``NAMES`` has
+    their names.
+    """
+
+    AYE = 0
+    NAY = 1
+    ABSTAIN = 2
+
+    def __str__(self):
+        return self.name.lower()
+
+    @classmethod
+    def parse(cls, name):
+        """Return the vote called ``name``, as written by ``str``."""
+        return cls[name.upper()]
+
+
+AYE = int(Vote.AYE)
+NAY = int(Vote.NAY)
+ABSTAIN = int(Vote.ABSTAIN)
+# indexed by choice
+NAMES = tuple(str(vote) for vote in Vote)
+
+DEFAULT_KEYWORDS = {
+    AYE: ('aye',),
+    NAY: ('nay',),
+    ABSTAIN: ('abstain',),
+}
+
+
+class VoteMatcher(object):
+    """Map the first word of a message to a vote.
+
+    .. code-block:: python
+
+        >>> matcher = VoteMatcher({AYE: ['aye', 'yes', '+1'], NAY: ['nay']})
+        >>> matcher.match('YES, obviously')
+        >>> Vote(matcher.match('Yes obviously'))
+        <Vote.AYE: 0>
+        >>> matcher.match('+1') == AYE
+        True
+        >>> matcher.match('yesterday was fun')
+        >>> matcher.match('')
+    """
+
+    __slots__ = ('words', 'prefix_len', 'first_chars')
+
+    def __init__(self, keywords=None):
+        keywords = keywords or DEFAULT_KEYWORDS
+        self.words = {}
+        for vote, words in keywords.items():
+            for word in words:
+                self.words[word.casefold()] = int(vote)
+
+        # one more than the longest keyword, so longer words never match
+        self.prefix_len = max(len(word) for word in self.words) + 1
+        self.first_chars = frozenset(
+            c for word in self.words for c in (word[0], word[0].upper())
+        )
+
+    def match(self, data):
+        """Return the vote the message starts with, as an int, or None."""
+        if not data:
+            return None
+
+        first = data[0]
+        if first not in self.first_chars:
+            if not first.isspace():
+                return None
+            data = data.lstrip()
+
+        head = data[:self.prefix_len].split(None, 1)
+        if not head:
+            return None
+        return self.words.get(head[0].casefold())
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a matcher from ``aye``/``nay``/``abstain`` config keys."""
+        keywords = {}
+        for vote, words in DEFAULT_KEYWORDS.items():
+            keywords[vote] = config.get(str(Vote(vote)), ' '.join(words)).split()
+        return cls(keywords)